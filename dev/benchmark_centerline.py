@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Micro-benchmark of the construction of msct_types.Centerline (lengths, coordinate systems, plane parameters and
+# KDTree), for centerlines of 1e4 to 1e5 points such as the ones produced by NURBS fitting.
+#
+# Usage: python benchmark_centerline.py [number of repetitions]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import sys
+import time
+import numpy as np
+
+# Append path that contains scripts, to be able to load modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+from msct_types import Centerline
+
+
+def generate_centerline(number_of_points):
+    """
+    Generate a smooth curved centerline along z, with its derivatives.
+    """
+    t = np.linspace(0.0, 1.0, number_of_points)
+    x, y, z = 10.0 * np.sin(3.0 * t), 5.0 * np.cos(2.0 * t), 300.0 * t
+    return x, y, z, np.gradient(x), np.gradient(y), np.gradient(z)
+
+
+def main(nb_repetitions=5):
+    for number_of_points in [10000, 20000, 50000, 100000]:
+        x, y, z, dx, dy, dz = generate_centerline(number_of_points)
+        timings = []
+        for i in range(nb_repetitions):
+            start = time.time()
+            Centerline(x, y, z, dx, dy, dz)
+            timings.append(time.time() - start)
+        print('{0:>7d} points: best {1:.4f} s, mean {2:.4f} s'.format(number_of_points, min(timings),
+                                                                         sum(timings) / len(timings)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
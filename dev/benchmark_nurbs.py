@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Micro-benchmark of the NURBS fitting of centerlines (msct_nurbs.NURBS), with the search of the number of control
+# points (nbControl=None), for noisy centerlines of 100 to 1000 points. The search trace is displayed for each size.
+# The selection of the number of control points is first checked against a regression case.
+#
+# Usage: python benchmark_nurbs.py [number of repetitions]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import sys
+import time
+import numpy as np
+
+# Append path that contains scripts, to be able to load modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+from msct_nurbs import NURBS
+
+
+def generate_centerline(number_of_points):
+    """
+    Generate a noisy curved centerline, with one point per slice.
+    """
+    np.random.seed(0)
+    z = np.arange(number_of_points, dtype=float)
+    x = 30.0 + 5.0 * np.sin(z / 20.0) + 0.3 * np.random.randn(number_of_points)
+    y = 40.0 + 3.0 * np.cos(z / 30.0) + 0.3 * np.random.randn(number_of_points)
+    return [[x[i], y[i], z[i]] for i in range(number_of_points)]
+
+
+def check_control_point_selection():
+    """
+    Regression case for the automatic selection of the number of control points, on a 60-point centerline.
+    When the basis functions were memoized in the module-level Nik_temp, the memo leaked from one candidate to the
+    next: the fits with 6 and 7 control points failed ("NURBS instability") and 11 control points were selected.
+    All candidates now fit, the search stops after 8 and 6 control points give the smallest error.
+    """
+    nurbs = NURBS(3, 1000, generate_centerline(60), nbControl=None, verbose=0)
+    assert [nb for nb, error in nurbs.search_trace] == [5, 6, 7, 8], nurbs.search_trace
+    assert None not in [error for nb, error in nurbs.search_trace], nurbs.search_trace
+    assert min(nurbs.search_trace, key=lambda trace: trace[1])[0] == 6, nurbs.search_trace
+    print('Selection of the number of control points: OK')
+
+
+def main(nb_repetitions=3):
+    check_control_point_selection()
+    for number_of_points in [100, 200, 500, 1000]:
+        data = generate_centerline(number_of_points)
+        timings = []
+        for i in range(nb_repetitions):
+            start = time.time()
+            nurbs = NURBS(3, 3000, data, nbControl=None, verbose=0)
+            timings.append(time.time() - start)
+        print('{0:>5d} points: best {1:.3f} s, mean {2:.3f} s'.format(number_of_points, min(timings),
+                                                                       sum(timings) / len(timings)))
+        print('  search trace: ' + ', '.join('{0} ({1:.3f})'.format(nb, error) for nb, error in nurbs.search_trace if error is not None))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark of the reorientation of a 4D series (e.g., fMRI): in-memory reorientation done by
+# sct_image.set_orientation versus the previous implementation, which split the series into one file per volume,
+# reoriented each file with isct_orientation3d and merged the volumes back. The reoriented data are compared.
+# Requires the SCT binaries (isct_orientation3d) to be in the PATH.
+#
+# Usage: python benchmark_orientation.py [number of volumes]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+# Append path that contains scripts, to be able to load modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+from msct_image import Image
+from sct_image import set_orientation, split_data, concat_data
+from sct_utils import run
+
+
+def set_orientation_legacy(im, orientation):
+    """
+    Previous implementation of the reorientation of 4D images, through files and isct_orientation3d.
+    """
+    fname_list = []
+    for im_split in split_data(im, 3):
+        im_split.save(verbose=0)
+        fname_out = im_split.file_name + '_' + orientation + im_split.ext
+        run('isct_orientation3d -i ' + im_split.absolutepath + ' -orientation ' + orientation + ' -o ' + fname_out, 0)
+        fname_list.append(fname_out)
+    return concat_data(fname_list, 3)
+
+
+def generate_series(fname, nb_volumes, shape=(64, 64, 30)):
+    """
+    Generate a random 4D series in AIL orientation.
+    """
+    affine = np.array([[0., 0., -1., 30.], [-1., 0., 0., 32.], [0., -1., 0., 32.], [0., 0., 0., 1.]])
+    data = np.random.rand(*(shape + (nb_volumes,))).astype(np.float32)
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_qform(affine, 1)
+    nib.save(img, fname)
+
+
+def main(nb_volumes=100):
+    path_tmp = tempfile.mkdtemp()
+    path_curr = os.getcwd()
+    os.chdir(path_tmp)
+    try:
+        generate_series('fmri.nii', nb_volumes)
+        im = Image('fmri.nii')
+
+        start = time.time()
+        im_legacy = set_orientation_legacy(im, 'RPI')
+        time_legacy = time.time() - start
+
+        start = time.time()
+        im_memory = set_orientation(im, 'RPI')
+        im_memory.data = np.ascontiguousarray(im_memory.data)
+        time_memory = time.time() - start
+
+        print('{0}x{1}x{2} voxels, {3} volumes'.format(*im.data.shape))
+        print('  isct_orientation3d per volume: {0:.3f} s'.format(time_legacy))
+        print('  in memory:                     {0:.3f} s (x{1:.1f})'.format(time_memory, time_legacy / time_memory))
+        print('  identical data: ' + str(np.array_equal(im_legacy.data, im_memory.data)))
+    finally:
+        os.chdir(path_curr)
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
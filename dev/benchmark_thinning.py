@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark of the Zhang-Suen thinning used by sct_compute_hausdorff_distance: vectorized implementation (lookup
+# table over the 8-neighbour code, all slices at once) versus the previous implementation looping over pixels.
+# Both implementations are run on random blobs (away from the image border) and their outputs are compared.
+#
+# Usage: python benchmark_thinning.py [number of slices]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import sys
+import time
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+# Append path that contains scripts, to be able to load modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+from sct_compute_hausdorff_distance import zhang_suen_thinning
+
+
+def zhang_suen_loop(image):
+    """
+    Previous implementation of the Zhang-Suen thinning, looping over the non-zero pixels of a 2D image.
+    """
+    def get_neighbours(x, y, image):
+        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
+        return [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],
+                image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]
+
+    def transitions(neighbours):
+        n = neighbours + neighbours[0:1]
+        return sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))
+
+    image_thinned = image.copy()
+    changing1 = changing2 = 1
+    while changing1 or changing2:
+        for step in [1, 2]:
+            changing = []
+            pass_list = [1, len(image_thinned) - 1]
+            X, Y = (image_thinned > 0).nonzero()
+            for x, y in zip(X, Y):
+                if x not in pass_list and y not in pass_list:
+                    P2, P3, P4, P5, P6, P7, P8, P9 = n = get_neighbours(x, y, image_thinned)
+                    if step == 1:
+                        conditions = P2 * P4 * P6 == 0 and P4 * P6 * P8 == 0
+                    else:
+                        conditions = P2 * P4 * P8 == 0 and P2 * P6 * P8 == 0
+                    if 2 <= sum(n) <= 6 and conditions and transitions(n) == 1:
+                        changing.append((x, y))
+            for x, y in changing:
+                image_thinned[x][y] = 0
+            if step == 1:
+                changing1 = changing
+            else:
+                changing2 = changing
+    return image_thinned
+
+
+def generate_blobs(nb_slices, size=64):
+    """
+    Generate binary blobs, with an empty border of 4 pixels.
+    """
+    np.random.seed(0)
+    data = gaussian_filter(np.random.rand(nb_slices, size, size), sigma=(0, 3, 3))
+    data = (data > np.median(data)).astype(int)
+    data[:, :4, :], data[:, -4:, :], data[:, :, :4], data[:, :, -4:] = 0, 0, 0, 0
+    return data
+
+
+def main(nb_slices=20):
+    data = generate_blobs(nb_slices)
+
+    start = time.time()
+    thinned_loop = np.asarray([zhang_suen_loop(data_slice) for data_slice in data])
+    time_loop = time.time() - start
+
+    start = time.time()
+    thinned_vectorized = zhang_suen_thinning(data)
+    time_vectorized = time.time() - start
+
+    print('{0} slices of {1}x{2} pixels'.format(*data.shape))
+    print('  loop over pixels: {0:.3f} s'.format(time_loop))
+    print('  vectorized:       {0:.3f} s (x{1:.1f})'.format(time_vectorized, time_loop / time_vectorized))
+    print('  identical results: ' + str(np.array_equal(thinned_loop, thinned_vectorized)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Persistent on-disk cache for intermediate results (e.g., straightening warping fields).
+# Entries are addressed by a hash of their inputs (image data, header, parameters), so that a result computed once
+# can be reused by any later call with byte-identical inputs. The total size of the cache is bounded: least recently
+# used entries are removed first.
+#
+# The location and size of the cache can be set with the environment variables:
+#   SCT_CACHE_DIR: folder of the cache. Default: ~/.sct_cache
+#   SCT_CACHE_SIZE: maximum size of the cache, in MB. Default: 5000
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import sct_utils as sct
+
+
+class Cache(object):
+    """
+    Content-addressed cache stored in a folder. Each entry is a sub-folder named after its key, containing a set of
+    files and a json file with optional information.
+
+    Example:
+    cache = Cache()
+    key = cache.compute_key(image.data, image.hdr.get_sform(), 'nurbs', 2.0)
+    path_entry, info = cache.get(key)
+    if path_entry is None:
+        ... compute 'warp.nii.gz' ...
+        cache.put(key, {'warp.nii.gz': 'warp.nii.gz'}, info={'nb_points': 1000})
+    """
+    fname_info = 'info.json'
+
+    def __init__(self, path=None, size_max=None, verbose=1):
+        """
+        :param path: folder of the cache. Default: $SCT_CACHE_DIR, or ~/.sct_cache
+        :param size_max: maximum size of the cache, in MB. Default: $SCT_CACHE_SIZE, or 5000
+        """
+        if path is None:
+            path = os.getenv('SCT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.sct_cache'))
+        if size_max is None:
+            size_max = float(os.getenv('SCT_CACHE_SIZE', 5000))
+        self.path = os.path.abspath(path)
+        self.size_max = size_max * 1024 * 1024  # in bytes
+        self.verbose = verbose
+        sct.create_folder(self.path)
+
+    @staticmethod
+    def compute_key(*items):
+        """
+        Compute the key of a cache entry from its inputs.
+        :param items: numpy arrays, strings, numbers, None, or lists/tuples/dicts of them
+        :return: hexadecimal sha1 hash
+        """
+        sha = hashlib.sha1()
+
+        def update(item):
+            if isinstance(item, np.ndarray):
+                item = np.ascontiguousarray(item)
+                sha.update(('array' + str(item.dtype) + str(item.shape)).encode('utf-8'))
+                sha.update(item.data)
+            elif isinstance(item, dict):
+                sha.update(b'dict')
+                for k in sorted(item):
+                    update(k)
+                    update(item[k])
+            elif isinstance(item, (list, tuple)):
+                sha.update(('list' + str(len(item))).encode('utf-8'))
+                for element in item:
+                    update(element)
+            else:
+                sha.update((type(item).__name__ + repr(item)).encode('utf-8'))
+
+        for item in items:
+            update(item)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Return the folder of the entry and its information, or (None, None) if the entry is not in the cache.
+        The access time of the entry is updated (used for eviction).
+        """
+        path_entry = os.path.join(self.path, key)
+        if not os.path.isfile(os.path.join(path_entry, self.fname_info)):
+            return None, None
+        with open(os.path.join(path_entry, self.fname_info)) as f:
+            info = json.load(f)
+        os.utime(path_entry, None)
+        sct.printv('Cache: using entry ' + key, self.verbose)
+        return path_entry, info
+
+    def put(self, key, files, info=None):
+        """
+        Add an entry to the cache. Files are copied in a temporary folder, which is then renamed, so that a partially
+        written entry is never visible. Least recently used entries are removed if the cache is too large.
+        :param files: dict {name in the cache: path of the file to copy}
+        :param info: dict of json-serializable information stored with the entry
+        :return: folder of the entry
+        """
+        path_entry = os.path.join(self.path, key)
+        if os.path.isdir(path_entry):
+            return path_entry
+        path_tmp = os.path.join(self.path, 'tmp.' + key + '_' + str(os.getpid()))
+        sct.create_folder(path_tmp)
+        try:
+            for name, fname in files.items():
+                shutil.copyfile(fname, os.path.join(path_tmp, name))
+            with open(os.path.join(path_tmp, self.fname_info), 'w') as f:
+                json.dump(info if info is not None else {}, f)
+            os.rename(path_tmp, path_entry)
+        except OSError:
+            # another process might have created the same entry in the meantime
+            shutil.rmtree(path_tmp, ignore_errors=True)
+            if not os.path.isdir(path_entry):
+                raise
+        sct.printv('Cache: entry ' + key + ' added', self.verbose)
+        self.evict(keep=path_entry)
+        return path_entry
+
+    def copy_from(self, path_entry, files):
+        """
+        Copy files of a cache entry.
+        :param files: dict {name in the cache: destination path}
+        """
+        for name, fname in files.items():
+            shutil.copyfile(os.path.join(path_entry, name), fname)
+
+    def get_size(self, path_entry):
+        size = 0
+        for root, dirs, files in os.walk(path_entry):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return size
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the size of the cache is below its maximum size.
+        :param keep: folder of an entry that is never removed (e.g., the entry just added)
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            path_entry = os.path.join(self.path, name)
+            if os.path.isdir(path_entry) and not name.startswith('tmp.'):
+                entries.append([os.path.getmtime(path_entry), self.get_size(path_entry), path_entry])
+        size_total = sum(entry[1] for entry in entries)
+        for time_access, size, path_entry in sorted(entries):
+            if size_total <= self.size_max:
+                break
+            if path_entry == keep:
+                continue
+            shutil.rmtree(path_entry, ignore_errors=True)
+            size_total -= size
+            sct.printv('Cache: entry ' + os.path.basename(path_entry) + ' removed', self.verbose)
+        if keep is not None and size_total > self.size_max:
+            sct.printv('WARNING: Cache: entry ' + os.path.basename(keep) + ' is larger than the maximum size of the cache', self.verbose, 'warning')
@@ -13,7 +13,7 @@
 ########################################################################################################################
 from msct_image import Image
 from sct_image import set_orientation
-from sct_utils import extract_fname, printv, add_suffix, tmp_create
+from sct_utils import extract_fname, printv, add_suffix, tmp_create, slash_at_the_end
 from sct_crop_image import ImageCropper
 import sct_create_mask
 import sct_register_multimodal, sct_apply_transfo
@@ -23,6 +23,7 @@ import math
 import time
 import random
 import shutil
+from multiprocessing import Pool, cpu_count
 
 ########################################################################################################################
 #                                   CLASS SLICE
@@ -137,6 +138,9 @@ def pre_processing(fname_target, fname_sc_seg, fname_level=None, fname_manual_gm
         nx, ny, nz, nt, px, py, pz, pt = im_target_rpi.dim
         size_x, size_y = (square_size_size_mm + 1) / px, (square_size_size_mm + 1) / py
         size = int(math.ceil(max(size_x, size_y)))
+        # save reoriented images: the mask creation and the cropping read them from the disk
+        im_target_rpi.save()
+        im_sc_seg_rpi.save()
         # create mask
         fname_mask = 'mask_pre_crop.nii.gz'
         sct_create_mask.main(['-i', im_target_rpi.absolutepath, '-p', 'centerline,' + im_sc_seg_rpi.absolutepath, '-f', 'box', '-size', str(size), '-o', fname_mask])
@@ -386,6 +390,7 @@ def load_manual_gmseg(list_slices_target, list_fname_manual_gmseg, tmp_dir, im_s
         im_manual_gmseg = set_orientation(im_manual_gmseg, 'RPI')
 
         if fname_mask is not None:
+            im_manual_gmseg.save()
             fname_gmseg_crop = add_suffix(im_manual_gmseg.absolutepath, '_pre_crop')
             crop_im = ImageCropper(input_file=im_manual_gmseg.absolutepath, output_file=fname_gmseg_crop,
                                    mask=fname_mask)
@@ -433,79 +438,176 @@ def register_data(im_src, im_dest, param_reg, path_copy_warp=None, rm_tmp=True):
     -------
 
     '''
+    # create tmp dir: files are given with absolute paths, the current directory is not changed
+    tmp_dir = os.path.abspath(tmp_create()) + '/'
+    im_src_reg, fname_src2dest, fname_dest2src = register_images(im_src, im_dest, param_reg, tmp_dir)
+    # copy warping fields
+    if path_copy_warp is not None and os.path.isdir(os.path.abspath(path_copy_warp)):
+        path_copy_warp = os.path.abspath(path_copy_warp)
+        shutil.copy(tmp_dir + fname_src2dest, path_copy_warp + '/')
+        shutil.copy(tmp_dir + fname_dest2src, path_copy_warp + '/')
+    if rm_tmp:
+        # remove tmp dir
+        shutil.rmtree(tmp_dir)
+    # return res image
+    return im_src_reg, fname_src2dest, fname_dest2src
+
+
+def register_images(im_src, im_dest, param_reg, path_out):
+    """
+    Register a source image on a destination image, using their binarized versions as segmentations. All the files are
+    written in path_out (absolute path) and the current directory is not changed, so that several registrations can run
+    at the same time in different folders.
+    :param path_out: absolute path of an existing folder, with a slash at the end
+    :return: source image registered on the destination image (Image), file names (in path_out) of the forward and
+    inverse warping fields
+    """
     # im_src and im_dest are already preprocessed (in theory: im_dest = mean_image)
     # binarize images to get seg
     im_src_seg = binarize(im_src, thr_min=1, thr_max=1)
     im_dest_seg = binarize(im_dest)
-    # create tmp dir and go in it
-    tmp_dir = tmp_create()
-    os.chdir(tmp_dir)
     # save image and seg
-    fname_src = 'src.nii.gz'
-    im_src.setFileName(fname_src)
-    im_src.save()
-    fname_src_seg = 'src_seg.nii.gz'
-    im_src_seg.setFileName(fname_src_seg)
-    im_src_seg.save()
-    fname_dest = 'dest.nii.gz'
-    im_dest.setFileName(fname_dest)
-    im_dest.save()
-    fname_dest_seg = 'dest_seg.nii.gz'
-    im_dest_seg.setFileName(fname_dest_seg)
-    im_dest_seg.save()
+    fname_src = path_out + 'src.nii.gz'
+    fname_src_seg = path_out + 'src_seg.nii.gz'
+    fname_dest = path_out + 'dest.nii.gz'
+    fname_dest_seg = path_out + 'dest_seg.nii.gz'
+    for im, fname in zip([im_src, im_src_seg, im_dest, im_dest_seg], [fname_src, fname_src_seg, fname_dest, fname_dest_seg]):
+        im.setFileName(fname)
+        im.save()
     # do registration using param_reg
     sct_register_multimodal.main(args=['-i', fname_src,
                                        '-d', fname_dest,
                                        '-iseg', fname_src_seg,
                                        '-dseg', fname_dest_seg,
-                                       '-param', param_reg])
+                                       '-param', param_reg,
+                                       '-ofolder', path_out])
 
     # get registration result
-    fname_src_reg = add_suffix(fname_src, '_reg')
-    im_src_reg = Image(fname_src_reg)
-    # get out of tmp dir
-    os.chdir('..')
-    # copy warping fields
-    if path_copy_warp is not None and os.path.isdir(os.path.abspath(path_copy_warp)):
-        path_copy_warp = os.path.abspath(path_copy_warp)
-        file_src = extract_fname(fname_src)[1]
-        file_dest = extract_fname(fname_dest)[1]
-        fname_src2dest = 'warp_' + file_src + '2' + file_dest + '.nii.gz'
-        fname_dest2src = 'warp_' + file_dest + '2' + file_src + '.nii.gz'
-        shutil.copy(tmp_dir + '/' + fname_src2dest, path_copy_warp + '/')
-        shutil.copy(tmp_dir + '/' + fname_dest2src, path_copy_warp + '/')
-    if rm_tmp:
-        # remove tmp dir
-        shutil.rmtree(tmp_dir)
-    # return res image
+    im_src_reg = Image(add_suffix(fname_src, '_reg'))
+    file_src = extract_fname(fname_src)[1]
+    file_dest = extract_fname(fname_dest)[1]
+    fname_src2dest = 'warp_' + file_src + '2' + file_dest + '.nii.gz'
+    fname_dest2src = 'warp_' + file_dest + '2' + file_src + '.nii.gz'
+
     return im_src_reg, fname_src2dest, fname_dest2src
 
 
+def warp_segmentations(list_data_seg, fname_src, fname_dest, fname_warp, interp='nn'):
+    """
+    Warp several segmentations defined on the grid of the source image with the same warping field, in one resampling:
+    the segmentations are stacked along a fourth axis, and all sampled at the coordinates computed once from the
+    warping field.
+    :param list_data_seg: list of numpy arrays, on the grid of the source image
+    :param fname_warp: displacement field from the source to the destination image
+    :param interp: {nn, linear, spline}
+    :return: list of numpy arrays (float32), on the grid of the destination image
+    """
+    from scipy.ndimage import map_coordinates
+    if not list_data_seg:
+        return []
+    im_src = Image(fname_src)
+    im_dest = Image(fname_dest)
+    if not all(sct_apply_transfo.has_sform(im) for im in [im_src, im_dest, Image(fname_warp, lazy=True)]):
+        # geometry not given by the sform: segmentations are warped one by one by isct_antsApplyTransforms
+        return [apply_transfo(Image(param=data, hdr=im_src.hdr.copy()), im_dest, fname_warp, interp=interp).data for data in list_data_seg]
+    coord_phys = sct_apply_transfo.get_sampling_coordinates(im_dest, [fname_warp])
+    coord_vox = np.rollaxis(im_src.transfo_phys2pix_array(coord_phys, continuous=True), 3)
+
+    nb_seg = len(list_data_seg)
+    data_seg = np.stack([np.reshape(data, im_src.dim[0:3]) for data in list_data_seg], axis=3)
+    # same spatial coordinates for all the segmentations, exact index along the fourth axis
+    coord_seg = np.empty((4,) + coord_vox.shape[1:] + (nb_seg,))
+    coord_seg[0:3] = coord_vox[..., np.newaxis]
+    coord_seg[3] = np.arange(nb_seg)
+    order = sct_apply_transfo.interp_order[interp]
+    data_seg_reg = map_coordinates(data_seg, coord_seg, order=order, mode='mirror' if order > 1 else 'nearest', output=np.float32)
+    # as in ITK (see sct_apply_transfo.resample_volume), points more than half a voxel outside of the source are set to 0
+    for i in range(3):
+        data_seg_reg[(coord_vox[i] < -0.5) | (coord_vox[i] >= data_seg.shape[i] - 0.5)] = 0
+    return [data_seg_reg[..., i] for i in range(nb_seg)]
+
+
+def get_slice_image(data):
+    """
+    Image of a slice (or of a stack of slices), with the geometry that ITK gives to nifti files without orientation
+    (qform and sform codes 0): voxel size of 1, no origin shift and identity directions in LPS. The geometry is written
+    in the qform and in the sform, so that the registration tools and warp_segmentations use the same voxel to physical
+    transformation.
+    """
+    from nibabel import Nifti1Header
+    affine = np.diag([-1., -1., 1., 1.])  # LPS identity, in RAS coordinates
+    hdr = Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    return Image(param=data, hdr=hdr)
+
+
+def register_slice(args):
+    """
+    Register the image of a slice on a destination image, and warp all the segmentations of the slice (e.g., its WM and
+    GM masks) with the forward warping field. The slice is processed in its own folder, so that slices can be
+    registered in parallel. Defined at the module level to be used by a multiprocessing pool.
+    :param args: tuple (data_src, data_dest, list_data_seg, param_reg, path_out, rm_tmp), with path_out the absolute
+    path of the folder of the slice
+    :return: registered image (numpy array), list of registered segmentations (numpy arrays)
+    """
+    data_src, data_dest, list_data_seg, param_reg, path_out, rm_tmp = args
+    path_out = slash_at_the_end(path_out, slash=1)
+    if not os.path.isdir(path_out):
+        os.makedirs(path_out)
+    im_src_reg, fname_src2dest, fname_dest2src = register_images(get_slice_image(data_src), get_slice_image(data_dest), param_reg, path_out)
+    shape = im_src_reg.data.shape
+    # nearest neighbour interpolation to keep binary segmentations
+    list_seg_reg = warp_segmentations(list_data_seg, path_out + 'src.nii.gz', path_out + 'dest.nii.gz', path_out + fname_src2dest, interp='nn')
+    if rm_tmp:
+        shutil.rmtree(path_out)
+    return im_src_reg.data, [data_seg.reshape(shape) for data_seg in list_seg_reg]
+
+
+def init_registration_worker(itk_threads):
+    # temporary folders are named using the random generator, which is copied in each worker: reseed it
+    random.seed()
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(itk_threads)
+
+
+def register_slices(jobs, cpu_number=1):
+    """
+    Run registration jobs of slices (see register_slice), in a pool of processes if cpu_number > 1. The available cores
+    are shared between the processes for the ITK registration tools.
+    :param jobs: list of arguments of register_slice
+    :return: list of results of register_slice, in the order of the jobs
+    """
+    if cpu_number > 1 and len(jobs) > 1:
+        nb_processes = min(cpu_number, len(jobs))
+        pool = Pool(nb_processes, initializer=init_registration_worker, initargs=(max(1, cpu_count() // nb_processes),))
+        try:
+            return pool.map(register_slice, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [register_slice(job) for job in jobs]
+
+
 def apply_transfo(im_src, im_dest, warp, interp='spline', rm_tmp=True):
-    # create tmp dir and go in it
-    tmp_dir = tmp_create()
-    # copy warping field to tmp dir
-    shutil.copy(warp, tmp_dir)
-    warp = ''.join(extract_fname(warp)[1:])
-    # go to tmp dir
-    os.chdir(tmp_dir)
+    # create tmp dir: files are given with absolute paths, the current directory is not changed
+    tmp_dir = os.path.abspath(tmp_create()) + '/'
     # save image and seg
-    fname_src = 'src.nii.gz'
+    fname_src = tmp_dir + 'src.nii.gz'
     im_src.setFileName(fname_src)
     im_src.save()
-    fname_dest = 'dest.nii.gz'
+    fname_dest = tmp_dir + 'dest.nii.gz'
     im_dest.setFileName(fname_dest)
     im_dest.save()
     # apply warping field
     fname_src_reg = add_suffix(fname_src, '_reg')
     sct_apply_transfo.main(args=['-i', fname_src,
                                   '-d', fname_dest,
-                                  '-w', warp,
-                                  '-x', interp])
+                                  '-w', os.path.abspath(warp),
+                                  '-x', interp,
+                                  '-o', fname_src_reg])
 
     im_src_reg = Image(fname_src_reg)
-    # get out of tmp dir
-    os.chdir('..')
     if rm_tmp:
         # remove tmp dir
         shutil.rmtree(tmp_dir)
@@ -201,7 +201,12 @@ class Image(object):
 
     """
 
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1, lazy=False):
+        """
+        :param lazy: if True and param is a file name, only the header is read. Voxel data are read when the data
+               attribute is accessed for the first time (memory-mapped for uncompressed .nii files), or per slab with
+               get_data_slab().
+        """
         from sct_utils import extract_fname
         from nibabel import Nifti1Header
 
@@ -224,7 +229,7 @@ class Image(object):
 
         # load an image from file
         if type(param) is str:
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, lazy=lazy)
             self.compute_transform_matrix()
         # copy constructor
         elif isinstance(param, type(self)):
@@ -248,16 +253,53 @@ class Image(object):
         else:
             raise TypeError('Image constructor takes at least one argument.')
 
+    @property
+    def data(self):
+        if self._data is None and self.im_file is not None:
+            # lazy image: read the data from the file (memory-mapped if the file is not compressed)
+            self._data = np.asanyarray(self.im_file.dataobj)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def is_loaded(self):
+        """
+        Return False if the image is lazy and its data have not been read yet.
+        """
+        return self._data is not None or self.im_file is None
+
+    def get_data_slab(self, start, end, axis=2):
+        """
+        Return the data between indexes [start, end[ along an axis. If the data have not been read yet (lazy image),
+        only this slab is read from the file, and the data of the image stay unloaded.
+        """
+        slicer = (slice(None),) * axis + (slice(start, end),)
+        if self.is_loaded():
+            return self.data[slicer]
+        return np.asanyarray(self.im_file.dataobj[slicer])
+
     def __deepcopy__(self, memo):
-        from copy import deepcopy
+        from copy import copy, deepcopy
+        if not self.is_loaded():
+            # the copy shares the file of the lazy image: each image reads its own data when it is accessed
+            im_copy = copy(self)
+            im_copy.hdr = deepcopy(self.hdr, memo)
+            return im_copy
         return type(self)(deepcopy(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
 
     def copy(self, image=None):
         from copy import deepcopy
         from sct_utils import extract_fname
         if image is not None:
-            self.im_file = deepcopy(image.im_file)
-            self.data = deepcopy(image.data)
+            if image.is_loaded():
+                self.im_file = deepcopy(image.im_file)
+                self.data = deepcopy(image.data)
+            else:
+                # the data are not read: share the file of the lazy image, data are read when accessed
+                self.im_file = image.im_file
+                self.data = None
             self.dim = deepcopy(image.dim)
             self.hdr = deepcopy(image.hdr)
             self.orientation = deepcopy(image.orientation)
@@ -266,10 +308,11 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, lazy=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param lazy: if True, only the header is read. Data are read when accessed.
         :return:
         """
         from nibabel import load, spatialimages
@@ -281,7 +324,8 @@ class Image(object):
             self.im_file = load(path)
         except spatialimages.ImageFileError:
             printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.data = self.im_file.get_data()
+        if not lazy:
+            self.data = self.im_file.get_data()
         self.hdr = self.im_file.get_header()
         self.orientation = get_orientation(self)
         self.absolutepath = path
@@ -734,11 +778,84 @@ class Image(object):
         self.m_p2f_transfo = m_p2f[0:3, 0:3]
         self.coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
 
+    def get_sform_inverse(self):
+        """
+        Return the inverse of the sform of the header (physical to voxel transformation). It is cached and only
+        recomputed when the sform of the header changes.
+        :return: 4x4 numpy array
+        """
+        m_p2f = self.hdr.get_sform()
+        cache = getattr(self, '_sform_inverse_cache', None)
+        if cache is None or not np.array_equal(cache[0], m_p2f):
+            cache = self._sform_inverse_cache = (m_p2f, np.linalg.inv(m_p2f))
+        return cache[1]
+
+    @staticmethod
+    def apply_affine(matrix, coordi, out=None):
+        """
+        Apply a 4x4 affine transformation to an array of points.
+        :param matrix: 4x4 numpy array
+        :param coordi: numpy array of shape (..., 3), or tuple of three arrays broadcastable against each other (index
+               grids, e.g., from np.ogrid or np.indices)
+        :param out: optional float array of shape (..., 3) in which the result is written
+        :return: numpy array of shape (..., 3)
+        """
+        if isinstance(coordi, tuple):
+            shape = np.broadcast(*coordi).shape
+            if out is None:
+                out = np.empty(shape + (3,))
+            for i in range(3):
+                out[..., i] = matrix[i, 0] * coordi[0] + matrix[i, 1] * coordi[1] + matrix[i, 2] * coordi[2] + matrix[i, 3]
+            return out
+        coordi = np.asarray(coordi)
+        if out is None:
+            out = np.dot(coordi, matrix[0:3, 0:3].T)
+        elif out.dtype == np.float64 and out.flags.c_contiguous:
+            np.dot(coordi, matrix[0:3, 0:3].T, out=out)
+        else:
+            out[...] = np.dot(coordi, matrix[0:3, 0:3].T)
+        out += matrix[0:3, 3]
+        return out
+
+    def transfo_pix2phys_array(self, coordi, out=None):
+        """
+        Array version of transfo_pix2phys: return the physical coordinates of voxel coordinates.
+
+        Example:
+        img = Image('file.nii.gz')
+        coordi_phys = img.transfo_pix2phys_array(np.array([[1, 1, 1], [2, 2, 2]]))  # shape (2, 3)
+        coordi_phys = img.transfo_pix2phys_array(np.ogrid[0:nx, 0:ny, 0:nz])  # shape (nx, ny, nz, 3)
+
+        :param coordi: numpy array of shape (..., 3), or tuple of three broadcastable index grids
+        :param out: optional float array of shape (..., 3) in which the result is written
+        :return: numpy array of shape (..., 3)
+        """
+        return self.apply_affine(self.hdr.get_sform(), coordi, out=out)
+
+    def transfo_phys2pix_array(self, coordi, out=None, continuous=False):
+        """
+        Array version of transfo_phys2pix and transfo_phys2continuouspix: return the voxel coordinates of physical
+        coordinates.
+        :param coordi: numpy array of shape (..., 3), or tuple of three broadcastable arrays
+        :param out: optional array of shape (..., 3) in which the result is written. If continuous is False and out is
+               an integer array, rounded coordinates are cast into it.
+        :param continuous: if False, voxel coordinates are rounded to the nearest integers
+        :return: numpy array of shape (..., 3): float if continuous, integer otherwise
+        """
+        if continuous:
+            return self.apply_affine(self.get_sform_inverse(), coordi, out=out)
+        coordi_pix = np.round(self.apply_affine(self.get_sform_inverse(), coordi))
+        if out is None:
+            return coordi_pix.astype(int)
+        out[...] = coordi_pix
+        return out
+
     def transfo_pix2phys(self, coordi=None):
         """
         This function returns the physical coordinates of all points of 'coordi'. 'coordi' is a list of list of size
         (nb_points * 3) containing the pixel coordinate of points. The function will return a list with the physical
         coordinates of the points in the space of the image.
+        See transfo_pix2phys_array to work with numpy arrays.
 
         Example:
         img = Image('file.nii.gz')
@@ -748,66 +865,19 @@ class Image(object):
 
         :return:
         """
-
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
-        if coordi is not None:
-            coordi = np.asarray(coordi)
-            number_of_coordinates = coordi.shape[0]
-            num_c = 100000
-            result_temp = np.empty(shape=(0, 3))
-
-            for i in range(int(number_of_coordinates / num_c)):
-                coordi_temp = coordi[num_c * i:(i + 1) * num_c, :]
-                coordi_pix = np.transpose(coordi_temp)
-                dot_result = np.dot(m_p2f_transfo, coordi_pix)
-                coordi_phys = np.transpose(coord_origin + dot_result)
-                result_temp = np.concatenate((result_temp, coordi_phys), axis=0)
-
-            if int(number_of_coordinates / num_c) == 0:
-                coordi_temp = coordi
-            else:
-                coordi_temp = coordi[int(number_of_coordinates / num_c) * num_c:, :]
-            coordi_pix = np.transpose(coordi_temp)
-            coordi_phys = np.transpose(coord_origin + np.dot(m_p2f_transfo, coordi_pix))
-
-            coordi_phys = np.concatenate((result_temp, coordi_phys), axis=0)
-            coordi_phys_list = coordi_phys.tolist()
-            # sct.printv(coordi_phys.shape)
-
-            return coordi_phys_list
-        """
-        if coordi != None:
-            coordi_phys = transpose(self.coord_origin + dot(self.m_p2f_transfo, transpose(asarray(coordi))))
-            return coordi_phys.tolist()
-        else:
+        if coordi is None:
             return None
-        """
-        return np.transpose(self.coord_origin + np.dot(self.m_p2f_transfo, np.transpose(np.asarray(coordi))))
+        return self.transfo_pix2phys_array(np.asarray(coordi)).tolist()
 
     def transfo_phys2pix(self, coordi):
         """
         This function returns the pixels coordinates of all points of 'coordi'
         'coordi' is a list of list of size (nb_points * 3) containing the pixel coordinate of points. The function will return a list with the physical coordinates of the points in the space of the image.
-
+        See transfo_phys2pix_array to work with numpy arrays.
 
         :return:
         """
-
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        m_f2p_transfo = np.linalg.inv(m_p2f_transfo)
-
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
-        coordi_phys = np.transpose(np.asarray(coordi))
-        coordi_pix = np.transpose(np.dot(m_f2p_transfo, (coordi_phys - coord_origin)))
-        coordi_pix_tmp = coordi_pix.tolist()
-        coordi_pix_list = [[int(np.round(coordi_pix_tmp[j][i])) for i in range(len(coordi_pix_tmp[j]))] for j in range(len(coordi_pix_tmp))]
-
-        return coordi_pix_list
+        return self.transfo_phys2pix_array(np.asarray(coordi)).tolist()
 
     def transfo_phys2continuouspix(self, coordi=None, data_phys=None):
         """
@@ -817,25 +887,12 @@ class Image(object):
 
         If coordi is different from none:
         coordi is a list of list of size (nb_points * 3) containing the pixel coordinate of points. The function will return a list with the physical coordinates of the points in the space of the image.
-
+        See transfo_phys2pix_array to work with numpy arrays.
 
         :return:
         """
-
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        m_f2p_transfo = np.linalg.inv(m_p2f_transfo)
-
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
-        if coordi != None:
-            coordi_phys = np.transpose(np.asarray(coordi))
-            coordi_pix = np.transpose(np.dot(m_f2p_transfo, (coordi_phys - coord_origin)))
-            coordi_pix_tmp = coordi_pix.tolist()
-            coordi_pix_list = [[coordi_pix_tmp[j][i] for i in range(len(coordi_pix_tmp[j]))] for j in
-                               range(len(coordi_pix_tmp))]
-
-            return coordi_pix_list
+        if coordi is not None:
+            return self.transfo_phys2pix_array(np.asarray(coordi), continuous=True).tolist()
 
     def get_values(self, coordi=None, interpolation_mode=0, border='constant', cval=0.0):
         """
@@ -908,7 +965,7 @@ class Image(object):
         Returns:
             X, Y and Z axes of the image
         """
-        direction_matrix = self.im_file.affine
+        direction_matrix = self.hdr.get_best_affine()
         T_self, R_self, Sc_self, Sh_self = decompose_affine_transform(direction_matrix)
         return R_self[0:3, 0], R_self[0:3, 1], R_self[0:3, 2]
 
@@ -928,17 +985,15 @@ class Image(object):
         :return: a new image that has the same dimensions/grid of the reference image but the data of self image.
         """
         nx, ny, nz, nt, px, py, pz, pt = im_ref.dim
-        x, y, z = np.mgrid[0:nx, 0:ny, 0:nz]
-        indexes_ref = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-        physical_coordinates_ref = im_ref.transfo_pix2phys(indexes_ref)
+        physical_coordinates_ref = im_ref.transfo_pix2phys_array(tuple(np.ogrid[0:nx, 0:ny, 0:nz])).reshape(-1, 3)
 
         # TODO: add optional transformation from reference space to image space to physical coordinates of ref grid.
         # TODO: add choice to do non-full transorm: translation, (rigid), affine
         # 1. get transformation
         # 2. apply transformation on coordinates
 
-        coord_im = np.array(self.transfo_phys2continuouspix(physical_coordinates_ref))
-        interpolated_values = self.get_values(np.array([coord_im[:, 0], coord_im[:, 1], coord_im[:, 2]]), interpolation_mode=interpolation_mode, border=border)
+        coord_im = self.transfo_phys2pix_array(physical_coordinates_ref, continuous=True)
+        interpolated_values = self.get_values(coord_im.T, interpolation_mode=interpolation_mode, border=border)
 
         im_output = Image(im_ref)
         if interpolation_mode == 0:
@@ -1236,6 +1291,37 @@ def get_dimension(im_file, verbose=1):
     return nx, ny, nz, nt, px, py, pz, pt
 
 
+def create_nifti_memmap(fname, hdr, shape, dtype=np.float32):
+    """
+    Create an uncompressed nifti file (.nii) filled with zeros and return a writable memory-map of its data array.
+    The file is allocated once on disk, so the data can be filled by parts without holding the full array in memory.
+    :param fname: output file name. Must be an uncompressed nifti file (.nii)
+    :param hdr: nifti header (copied) used for the output file (orientation, voxel size, intent, ...)
+    :param shape: shape of the data array
+    :param dtype: type of the data array. Default=float32
+    :return: numpy.memmap of the data array (Fortran order, as stored in nifti files)
+    """
+    from nibabel import Nifti1Header
+    if not fname.endswith('.nii'):
+        raise ValueError('ERROR in msct_image.create_nifti_memmap: memory-mapped output must be an uncompressed nifti '
+                         'file (.nii), got ' + fname)
+    hdr = Nifti1Header.from_header(hdr)
+    hdr['magic'] = 'n+1'  # single file
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(None, None)
+    hdr.set_data_offset(0)  # let nibabel compute the offset, taking extensions into account
+    dtype_disk = hdr.get_data_dtype()
+    nbytes = int(np.prod(shape)) * dtype_disk.itemsize
+    with open(fname, 'wb') as fileobj:
+        hdr.write_to(fileobj)
+        offset = hdr.get_data_offset()
+        # allocate the data block (sparse file on most file systems)
+        fileobj.seek(offset + nbytes - 1)
+        fileobj.write(b'\x00')
+    return np.memmap(fname, dtype=dtype_disk, mode='r+', offset=offset, shape=tuple(shape), order='F')
+
+
 def change_data_orientation(data, old_orientation='RPI', orientation="RPI"):
     """
     This function changes the orientation of a data matrix from a give orientation to another.
@@ -20,11 +20,12 @@
 
 import os
 import sys
+import shutil
 import commands
 import numpy as np
 import sct_utils as sct
 from msct_image import Image
-from sct_image import split_data
+from sct_image import split_data, concat_data
 
 
 #=======================================================================================================================
@@ -36,7 +37,11 @@ def moco(param):
     fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
     file_data = param.file_data
     file_target = param.file_target
-    folder_mat = sct.slash_at_the_end(param.mat_moco, 1)  # output folder of mat file
+    if isinstance(param.mat_moco, list):
+        # one transformation per volume (without extension), which can be shared by several volumes
+        folder_mat = ''
+    else:
+        folder_mat = sct.slash_at_the_end(param.mat_moco, 1)  # output folder of mat file
     todo = param.todo
     suffix = param.suffix
     #file_schedule = param.file_schedule
@@ -60,7 +65,8 @@ def moco(param):
     sct.printv('  Output mat folder .....' + folder_mat, param.verbose)
 
     # create folder for mat files
-    sct.create_folder(folder_mat)
+    if folder_mat:
+        sct.create_folder(folder_mat)
 
     # Get size of data
     sct.printv('\nGet dimensions data...', verbose)
@@ -73,7 +79,8 @@ def moco(param):
     sct.run('cp ' + file_target + ext + ' target.nii')
     file_target = 'target'
 
-    # Split data along T dimension
+    # Split data along T dimension. The volumes are views of the 4D array, they are written to disk because they are
+    # read by the registration binaries.
     sct.printv('\nSplit data along T dimension...', verbose)
     data_split_list = split_data(data_im, dim=3)
     for im in data_split_list:
@@ -81,74 +88,122 @@ def moco(param):
     file_data_splitT = file_data + '_T'
 
     # Motion correction: initialization
-    index = np.arange(nt)
-    file_data_splitT_num = []
-    file_data_splitT_moco_num = []
+    file_data_splitT_num = [file_data_splitT + str(it).zfill(4) for it in range(nt)]
+    file_data_splitT_moco_num = [file_data + suffix + '_T' + str(it).zfill(4) for it in range(nt)]
+    if folder_mat:
+        file_mat = [folder_mat + 'mat.T' + str(it) for it in range(nt)]
+    else:
+        file_mat = list(param.mat_moco)
     failed_transfo = [0 for i in range(nt)]
-    file_mat = [[] for i in range(nt)]
+    cpu_number = int(getattr(param, 'cpu_number', 1))
+    nb_warmup = min(10, nt) if param.iterative_averaging and not param.todo == 'apply' else 0
 
     # Motion correction: Loop across T
-    for indice_index in range(nt):
-
-        # create indices and display stuff
-        it = index[indice_index]
-        file_data_splitT_num.append(file_data_splitT + str(it).zfill(4))
-        file_data_splitT_moco_num.append(file_data + suffix + '_T' + str(it).zfill(4))
-        sct.printv(('\nVolume ' + str((it)) + '/' + str(nt - 1) + ':'), verbose)
-        file_mat[it] = folder_mat + 'mat.T' + str(it)
-
-        # run 3D registration
-        failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
-
-        # average registered volume with target image
+    if nb_warmup:
+        # warm-up: each of the first volumes is averaged with the target used for the next volumes, so they are
+        # registered one after the other. The average is computed in memory.
         # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-        if param.iterative_averaging and indice_index < 10 and failed_transfo[it] == 0 and not param.todo == 'apply':
-            sct.run('sct_maths -i ' + file_target + ext + ' -mul ' + str(indice_index + 1) + ' -o ' + file_target + ext)
-            sct.run('sct_maths -i ' + file_target + ext + ' -add ' + file_data_splitT_moco_num[it] + ext + ' -o ' + file_target + ext)
-            sct.run('sct_maths -i ' + file_target + ext + ' -div ' + str(indice_index + 2) + ' -o ' + file_target + ext)
+        im_target = Image(file_target + ext)
+        for it in range(nb_warmup):
+            sct.printv(('\nVolume ' + str(it) + '/' + str(nt - 1) + ':'), verbose)
+            failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
+            if failed_transfo[it] == 0:
+                data_moco = Image(file_data_splitT_moco_num[it] + ext).data
+                im_target.data = (im_target.data * (it + 1) + data_moco.reshape(im_target.data.shape)) / float(it + 2)
+                im_target.save(verbose=0)
+    # the target does not change anymore: the other volumes are independent and are dispatched to a pool of workers.
+    # Failed transformations are returned in the order of the volumes.
+    itk_threads = get_itk_threads(cpu_number, nt - nb_warmup)
+    jobs = [(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it], itk_threads) for it in range(nb_warmup, nt)]
+    failed_transfo[nb_warmup:] = run_jobs(register_job, jobs, cpu_number)
 
     # Replace failed transformation with the closest good one
     sct.printv(('\nReplace failed transformations...'), verbose)
     fT = [i for i, j in enumerate(failed_transfo) if j == 1]
     gT = [i for i, j in enumerate(failed_transfo) if j == 0]
+    jobs = []
+    itk_threads = get_itk_threads(cpu_number, len(fT))
     for it in range(len(fT)):
         abs_dist = [abs(gT[i] - fT[it]) for i in range(len(gT))]
         if not abs_dist == []:
             index_good = abs_dist.index(min(abs_dist))
             sct.printv('  transfo #' + str(fT[it]) + ' --> use transfo #' + str(gT[index_good]), verbose)
-            # copy transformation
-            sct.run('cp ' + file_mat[gT[index_good]] + 'Warp.nii.gz' + ' ' + file_mat[fT[it]] + 'Warp.nii.gz')
+            # copy transformation, or use its path if transformations are given per volume (the file of the failed
+            # transformation may be shared by other volumes)
+            if folder_mat:
+                shutil.copyfile(file_mat[gT[index_good]] + 'Warp.nii.gz', file_mat[fT[it]] + 'Warp.nii.gz')
+            else:
+                file_mat[fT[it]] = file_mat[gT[index_good]]
             # apply transformation
-            sct.run('sct_apply_transfo -i ' + file_data_splitT_num[fT[it]] + '.nii -d ' + file_target + '.nii -w ' + file_mat[fT[it]] + 'Warp.nii.gz' + ' -o ' + file_data_splitT_moco_num[fT[it]] + '.nii' + ' -x ' + param.interp, verbose)
+            jobs.append((get_itk_threads_prefix(itk_threads) + 'sct_apply_transfo -i ' + file_data_splitT_num[fT[it]] + '.nii -d ' + file_target + '.nii -w ' + file_mat[fT[it]] + 'Warp.nii.gz' + ' -o ' + file_data_splitT_moco_num[fT[it]] + '.nii' + ' -x ' + param.interp, verbose))
         else:
             # exit program if no transformation exists.
             sct.printv('\nERROR in ' + os.path.basename(__file__) + ': No good transformation exist. Exit program.\n', verbose, 'error')
             sys.exit(2)
+    run_jobs(run_job, jobs, cpu_number)
 
     # Merge data along T
     file_data_moco = file_data + suffix
     if todo != 'estimate':
         sct.printv('\nMerge data back along T...', verbose)
-        from sct_image import concat_data
-        # im_list = []
-        fname_list = []
-        for indice_index in range(len(index)):
-            # im_list.append(Image(file_data_splitT_moco_num[indice_index] + ext))
-            fname_list.append(file_data_splitT_moco_num[indice_index] + ext)
-        im_out = concat_data(fname_list, 3)
+        im_out = concat_data([fname + ext for fname in file_data_splitT_moco_num], 3)
         im_out.setFileName(file_data_moco + ext)
         im_out.save()
 
     # delete file target.nii (to avoid conflict if this function is run another time)
     sct.printv('\nRemove temporary file...', verbose)
-    # os.remove('target.nii')
-    sct.run('rm target.nii')
+    os.remove('target.nii')
+
+
+def register_job(args):
+    return register(*args)
+
+
+def run_job(args):
+    return sct.run(*args)
+
+
+def get_itk_threads(cpu_number, nb_jobs):
+    """
+    Number of threads of the ITK binaries for jobs run in parallel, so that the total number of threads does not exceed
+    cpu_number. Jobs run one after the other keep the default number of threads of ITK (None).
+    """
+    if cpu_number <= 1 or nb_jobs <= 1:
+        return None
+    return max(1, cpu_number // min(cpu_number, nb_jobs))
+
+
+def get_itk_threads_prefix(itk_threads=None):
+    """
+    Prefix of a shell command setting the number of threads used by the ITK binaries. The environment of the process is
+    not modified, so that it can be used by jobs run in parallel.
+    """
+    if itk_threads is None:
+        return ''
+    return 'export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=' + str(itk_threads) + '; '
+
+
+def run_jobs(function, jobs, cpu_number=1):
+    """
+    Run independent jobs, in parallel if cpu_number > 1. Jobs mostly wait for external processes, so they are run in a
+    pool of threads.
+    :return: list of the outputs of the jobs, in the same order as the jobs
+    """
+    if cpu_number > 1 and len(jobs) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(cpu_number, len(jobs)))
+        try:
+            return pool.map(function, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [function(job) for job in jobs]
 
 
 #=======================================================================================================================
 # register:  registration of two volumes (or two images)
 #=======================================================================================================================
-def register(param, file_src, file_dest, file_mat, file_out):
+def register(param, file_src, file_dest, file_mat, file_out, itk_threads=None):
 
     # initialization
     failed_transfo = 0  # by default, failed matrix is 0 (i.e., no failure)
@@ -174,7 +229,7 @@ def register(param, file_src, file_dest, file_mat, file_out):
             cmd += ' -x ' + param.fname_mask
     if param.todo == 'apply':
         cmd = 'sct_apply_transfo -i ' + file_src + '.nii -d ' + file_dest + '.nii -w ' + file_mat + 'Warp.nii.gz' + ' -o ' + file_out + '.nii' + ' -x ' + param.interp
-    status, output = sct.run(cmd, param.verbose)
+    status, output = sct.run(get_itk_threads_prefix(itk_threads) + cmd, param.verbose)
 
     # check if output file exists
     if not os.path.isfile(file_out + '.nii'):
@@ -12,19 +12,20 @@
 # About the license: see the file LICENSE.TXT
 ########################################################################################################################
 import gzip
+import json
 import os
 import pickle
 import shutil
 import sys
 import time
+from multiprocessing import cpu_count
 
 import numpy as np
 import pandas as pd
 from sklearn import decomposition, manifold
 
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, normalize_slice,
-                              pre_processing, register_data)
-from msct_image import Image
+from msct_gmseg_utils import (Slice, average_gm_wm, normalize_slice, pre_processing,
+                              register_slices)
 from msct_parser import Parser
 from sct_utils import printv, slash_at_the_end
 import sct_utils as sct
@@ -106,6 +107,11 @@ def get_parser():
                       mandatory=False,
                       default_value=str(ParamModel().ind_rm))
     parser.usage.addSection('MISC')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used to register the slices of the model (slices are registered in parallel). 0 or 1: no parallel computation. By default, uses all the available cores.",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description='Remove temporary files.',
@@ -175,21 +181,42 @@ class Param:
     def __init__(self):
         self.verbose = 1
         self.rm_tmp = True
+        self.cpu_number = cpu_count()  # number of processes used to register the slices of the model
+
+
+# version of the array format of the model, written in the model information file
+MODEL_FORMAT_VERSION = 1
+# files of the model in the array format: one .npy file per array of the dictionary (see stack_slices)
+MODEL_INFO_FILE = 'model.json'
+DICTIONARY_ARRAYS = ['im', 'im_M', 'level', 'id', 'gm_seg', 'gm_seg_M', 'gm_slice', 'wm_seg', 'wm_seg_M', 'wm_slice']
 
 
-class Model:
+class Model(object):
     def __init__(self, param_model=None, param_data=None, param=None):
         self.param_model = param_model if param_model is not None else ParamModel()
         self.param_data = param_data if param_data is not None else ParamData()
         self.param = param if param is not None else Param()
 
         self.slices = []  # list of Slice() : Model dictionary
-        self.mean_image = None
+        self._mean_image = None
         self.intensities = None
 
         self.fitted_model = None  # PCA or Isomap model
         self.fitted_data = None
 
+        # dictionary as stacked arrays, and quantities derived from the dictionary (computed when first needed)
+        self._cache = {}
+
+    @property
+    def mean_image(self):
+        if self._mean_image is None and len(self.slices) > 0:
+            self._mean_image = np.mean(self.get_dictionary_arrays()['im'], axis=0)
+        return self._mean_image
+
+    @mean_image.setter
+    def mean_image(self, value):
+        self._mean_image = value
+
     # ------------------------------------------------------------------------------------------------------------------
     #                                       FUNCTIONS USED TO COMPUTE THE MODEL
     # ------------------------------------------------------------------------------------------------------------------
@@ -280,45 +307,18 @@ class Model:
 
     # ------------------------------------------------------------------------------------------------------------------
     def coregister_model_data(self):
-        # get mean image
-        im_mean = Image(param=self.mean_image)
-
-        # register all slices WM on mean WM
-        for dic_slice in self.slices:
-            # create a directory to get the warping fields
-            warp_dir = 'wf_slice' + str(dic_slice.id)
-            if not os.path.exists(warp_dir):
-                os.mkdir(warp_dir)
-
-            # get slice mean WM image
-            im_slice = Image(param=dic_slice.im)
-            # register slice image on mean dic image
-            im_slice_reg, fname_src2dest, fname_dest2src = register_data(im_src=im_slice, im_dest=im_mean, param_reg=self.param_data.register_param, path_copy_warp=warp_dir)
-            shape = im_slice_reg.data.shape
-
-            # use forward warping field to register all slice wm
-            list_wmseg_reg = []
-            for wm_seg in dic_slice.wm_seg:
-                im_wmseg = Image(param=wm_seg)
-                im_wmseg_reg = apply_transfo(im_src=im_wmseg, im_dest=im_mean, warp=warp_dir + '/' + fname_src2dest, interp='nn')
-
-                list_wmseg_reg.append(im_wmseg_reg.data.reshape(shape))
-
-            # use forward warping field to register gm seg
-            list_gmseg_reg = []
-            for gm_seg in dic_slice.gm_seg:
-                im_gmseg = Image(param=gm_seg)
-                im_gmseg_reg = apply_transfo(im_src=im_gmseg, im_dest=im_mean, warp=warp_dir + '/' + fname_src2dest, interp='nn')
-                list_gmseg_reg.append(im_gmseg_reg.data.reshape(shape))
-
+        # register all slices on the mean image, in parallel: each slice is registered in its own directory (to get
+        # the warping fields), and all its WM and GM segmentations are warped with the forward warping field at once
+        jobs = [(dic_slice.im, self.mean_image, list(dic_slice.wm_seg) + list(dic_slice.gm_seg), self.param_data.register_param, os.path.abspath('wf_slice' + str(dic_slice.id)), self.param.rm_tmp)
+                for dic_slice in self.slices]
+        results = register_slices(jobs, cpu_number=self.param.cpu_number)
+
+        for dic_slice, (data_slice_reg, list_seg_reg) in zip(self.slices, results):
+            nb_wm = len(dic_slice.wm_seg)
             # set slice attributes with data registered into the model space
-            dic_slice.set(im_m=im_slice_reg.data)
-            dic_slice.set(wm_seg_m=list_wmseg_reg)
-            dic_slice.set(gm_seg_m=list_gmseg_reg)
-
-            # remove warping fields directory
-            if self.param.rm_tmp:
-                shutil.rmtree(warp_dir)
+            dic_slice.set(im_m=data_slice_reg)
+            dic_slice.set(wm_seg_m=list_seg_reg[:nb_wm])
+            dic_slice.set(gm_seg_m=list_seg_reg[nb_wm:])
 
     # ------------------------------------------------------------------------------------------------------------------
     def normalize_model_data(self):
@@ -405,23 +405,32 @@ class Model:
 
     # ------------------------------------------------------------------------------------------------------------------
     def save_model(self):
+        '''
+        Save the model in the array format: one .npy file per array, that can be memory-mapped when the model is loaded.
+        '''
         os.chdir(self.param_model.new_model_dir)
         # to save:
-        # - self.slices = dictionary
-        slices = self.slices
-        pickle.dump(slices, gzip.open('slices.pklz', 'wb'), protocol=2)
+        # - self.slices = dictionary, as stacked arrays
+        for name, data in stack_slices(self.slices).items():
+            np.save(name + '.npy', data)
 
-        # - self.intensities = for normalization
+        # - self.intensities = for normalization: one row per level (level, GM, WM, MIN, MAX)
         intensities = self.intensities
-        pickle.dump(intensities, gzip.open('intensities.pklz', 'wb'), protocol=2)
+        np.save('intensities.npy', np.column_stack([intensities.index] + [intensities[col] for col in ['GM', 'WM', 'MIN', 'MAX']]))
 
-        # - reduced space (pca or isomap)
+        # - reduced space (pca or isomap): PCA is saved as plain arrays, isomap is pickled
         model = self.fitted_model
-        pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
+        if self.param_model.method == 'pca':
+            np.save('pca_components.npy', model.components_)
+            np.save('pca_mean.npy', model.mean_)
+        else:
+            pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
 
         # - fitted data (=eigen vectors or embedding vectors )
-        data = self.fitted_data
-        pickle.dump(data, gzip.open('fitted_data.pklz', 'wb'), protocol=2)
+        np.save('fitted_data.npy', self.fitted_data)
+
+        with open(MODEL_INFO_FILE, 'w') as f:
+            json.dump({'format_version': MODEL_FORMAT_VERSION, 'method': self.param_model.method, 'nb_slices': len(self.slices)}, f)
 
         os.chdir('..')
 
@@ -435,6 +444,55 @@ class Model:
         printv('\nLoading model...', self.param.verbose, 'normal')
         os.chdir(self.param_model.path_model_to_load)
 
+        if os.path.isfile(MODEL_INFO_FILE):
+            self.load_model_arrays()
+        else:
+            self.load_model_pickle()
+
+        printv('  model: ' + self.param_model.method)
+        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
+        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
+        os.chdir(path)
+
+    def load_model_arrays(self):
+        '''
+        Load a model saved in the array format (in the current directory). Arrays of the dictionary are memory-mapped:
+        they are read when they are used, and the memory is shared by the processes using the same model.
+        '''
+        with open(MODEL_INFO_FILE) as f:
+            info = json.load(f)
+        if info['format_version'] > MODEL_FORMAT_VERSION:
+            printv('ERROR: The GM segmentation model (format version ' + str(info['format_version']) + ') is not compatible with this version of the code.', self.param.verbose, 'error')
+        for fname in [name + '.npy' for name in DICTIONARY_ARRAYS] + ['intensities.npy', 'fitted_data.npy']:
+            if not os.path.isfile(fname):
+                printv('ERROR: Missing file in the GM segmentation model: ' + fname, self.param.verbose, 'error')
+
+        # - self.slices = dictionary
+        arrays = dict((name, np.load(name + '.npy', mmap_mode='r')) for name in DICTIONARY_ARRAYS)
+        self.slices = unstack_slices(arrays)
+        self._mean_image = None
+        self._cache = {'arrays': arrays}
+        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
+
+        # - self.intensities = for normalization
+        intensities = np.load('intensities.npy')
+        index = [int(level) for level in intensities[:, 0]]
+        self.intensities = pd.DataFrame(dict((col, pd.Series(intensities[:, i + 1], index=index)) for i, col in enumerate(['GM', 'WM', 'MIN', 'MAX'])))
+
+        # - reduced space (pca or isomap)
+        self.param_model.method = info['method']
+        if info['method'] == 'pca':
+            self.fitted_model = ProjectionPCA(np.load('pca_components.npy'), np.load('pca_mean.npy'))
+        else:
+            self.fitted_model = pickle.load(gzip.open('fitted_model.pklz', 'rb'))
+
+        # - fitted data (=eigen vectors or embedding vectors )
+        self.fitted_data = np.load('fitted_data.npy')
+
+    def load_model_pickle(self):
+        '''
+        Load a model saved as pickles (in the current directory), by previous versions of the code.
+        '''
         model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
         correct_model = True
         for fname in model_files.values():
@@ -453,8 +511,9 @@ class Model:
 
         # - self.slices = dictionary
         self.slices = pickle.load(gzip.open(model_files['slices'],  'rb'))
+        self._mean_image = None
+        self._cache = {}
         printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
-        self.mean_image = np.mean([dic_slice.im for dic_slice in self.slices], axis=0)
 
         # - self.intensities = for normalization
         self.intensities = pickle.load(gzip.open(model_files['intensity'], 'rb'))
@@ -465,37 +524,113 @@ class Model:
         # - fitted data (=eigen vectors or embedding vectors )
         self.fitted_data = pickle.load(gzip.open(model_files['data'], 'rb'))
 
-        printv('  model: ' + self.param_model.method)
-        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
-        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
-        os.chdir(path)
-
     # ------------------------------------------------------------------------------------------------------------------
     #                                                   UTILS FUNCTIONS
     # ------------------------------------------------------------------------------------------------------------------
+    def get_dictionary_arrays(self):
+        '''
+        Get the dictionary as stacked arrays (see stack_slices). The arrays are memory-mapped if the model was loaded
+        from the array format, otherwise they are stacked from the slices when first needed.
+        '''
+        if 'arrays' not in self._cache:
+            self._cache['arrays'] = stack_slices(self.slices)
+        return self._cache['arrays']
+
+    def get_gm_sum_by_slice(self):
+        '''
+        Get the sum and the number of the manual GM segmentations (in the model space) of each slice of the dictionary.
+        :return: array of shape (number of slices, number of pixels), array of shape (number of slices)
+        '''
+        if 'gm_sum_by_slice' not in self._cache:
+            arrays = self.get_dictionary_arrays()
+            nb_slices = len(arrays['level'])
+            gm_seg = np.asarray(arrays['gm_seg_M']).reshape(len(arrays['gm_slice']), -1)
+            nb_gm = np.bincount(arrays['gm_slice'], minlength=nb_slices)
+            # segmentations of each slice are consecutive rows: sum them by blocks
+            gm_sum = np.zeros((nb_slices, gm_seg.shape[1]))
+            start = np.searchsorted(arrays['gm_slice'], np.arange(nb_slices))
+            gm_sum[nb_gm > 0] = np.add.reduceat(gm_seg, start[nb_gm > 0], axis=0, dtype=float)
+            nb_gm = nb_gm.astype(float)
+            self._cache['gm_sum_by_slice'] = (gm_sum, nb_gm)
+        return self._cache['gm_sum_by_slice']
+
     def get_gm_wm_by_level(self):
+        if 'gm_wm_by_level' in self._cache:
+            return self._cache['gm_wm_by_level']
+        arrays = self.get_dictionary_arrays()
+        level_int = np.array([int(round(level)) for level in arrays['level']], dtype=int)
+        levels = np.unique(level_int)
+
         gm_seg_model = {}  # dic of mean gm seg by vertebral level
         wm_seg_model = {}  # dic of mean wm seg by vertebral level
-        # get id of the slices by level
-        slices_by_level = {}
-        for dic_slice in self.slices:
-            level_int = int(round(dic_slice.level))
-            if level_int not in slices_by_level.keys():
-                slices_by_level[level_int] = [dic_slice]
-            else:
-                slices_by_level[level_int].append(dic_slice)
-        # get average gm and wm by level
-        for level, list_slices in slices_by_level.items():
-            data_mean_gm, data_mean_wm = average_gm_wm(list_slices)
-            gm_seg_model[level] = data_mean_gm
-            wm_seg_model[level] = data_mean_wm
-        # for level=0 (no leve or level not in model) output average GM and WM seg across all model data
-        gm_seg_model[0] = np.mean(gm_seg_model.values(), axis=0)
-        wm_seg_model[0] = np.mean(wm_seg_model.values(), axis=0)
-
+        for seg_model, seg in [(gm_seg_model, 'gm'), (wm_seg_model, 'wm')]:
+            # average of the manual segmentations of the slices of each level, for all levels at once
+            data_seg = np.asarray(arrays[seg + '_seg_M'])
+            level_seg = level_int[arrays[seg + '_slice']]
+            in_level = (level_seg == levels[:, np.newaxis]).astype(float)
+            data_mean = np.dot(in_level, data_seg.reshape(len(data_seg), -1)) / np.sum(in_level, axis=1)[:, np.newaxis]
+            for level, data_mean_level in zip(levels, data_mean):
+                seg_model[level] = data_mean_level.reshape(data_seg.shape[1:])
+            # for level=0 (no leve or level not in model) output average GM and WM seg across all model data
+            seg_model[0] = np.mean(seg_model.values(), axis=0)
+
+        self._cache['gm_wm_by_level'] = (gm_seg_model, wm_seg_model)
         return gm_seg_model, wm_seg_model
 
 
+class ProjectionPCA(object):
+    '''
+    Projection into a PCA reduced space defined by plain arrays, as fitted by sklearn.decomposition.PCA (without
+    whitening).
+    '''
+    def __init__(self, components, mean):
+        '''
+        :param components: array of shape (number of components, number of features)
+        :param mean: array of shape (number of features)
+        '''
+        self.components_ = components
+        self.mean_ = mean
+        self.n_components_ = components.shape[0]
+
+    def transform(self, data):
+        return np.dot(np.asarray(data) - self.mean_, self.components_.T)
+
+
+def stack_slices(list_slices):
+    '''
+    Stack the data of a list of slices into arrays, one row per slice (im, im_M, level, id), or one row per manual
+    segmentation for the GM and WM segmentations (gm_seg, gm_seg_M, wm_seg, wm_seg_M), with the index of their slice
+    (gm_slice, wm_slice).
+    :return: dict of numpy arrays
+    '''
+    arrays = {'im': np.array([dic_slice.im for dic_slice in list_slices]),
+              'im_M': np.array([dic_slice.im_M for dic_slice in list_slices]),
+              'level': np.array([dic_slice.level for dic_slice in list_slices], dtype=float),
+              'id': np.array([dic_slice.id for dic_slice in list_slices], dtype=int)}
+    for seg in ['gm', 'wm']:
+        arrays[seg + '_seg'] = np.concatenate([getattr(dic_slice, seg + '_seg') for dic_slice in list_slices])
+        arrays[seg + '_seg_M'] = np.concatenate([getattr(dic_slice, seg + '_seg_M') for dic_slice in list_slices])
+        arrays[seg + '_slice'] = np.concatenate([np.repeat(i, len(getattr(dic_slice, seg + '_seg_M'))) for i, dic_slice in enumerate(list_slices)]).astype(int)
+    return arrays
+
+
+def unstack_slices(arrays):
+    '''
+    Create the list of slices from arrays stacked by stack_slices. The data of the slices are views of the arrays (no
+    copy, arrays can be memory-mapped).
+    '''
+    nb_slices = len(arrays['level'])
+    # segmentations of each slice are consecutive rows
+    gm_bounds = np.searchsorted(arrays['gm_slice'], np.arange(nb_slices + 1))
+    wm_bounds = np.searchsorted(arrays['wm_slice'], np.arange(nb_slices + 1))
+    list_slices = []
+    for i in range(nb_slices):
+        list_slices.append(Slice(slice_id=int(arrays['id'][i]), im=arrays['im'][i], im_m=arrays['im_M'][i], level=float(arrays['level'][i]),
+                                 gm_seg=arrays['gm_seg'][gm_bounds[i]:gm_bounds[i + 1]], gm_seg_m=arrays['gm_seg_M'][gm_bounds[i]:gm_bounds[i + 1]],
+                                 wm_seg=arrays['wm_seg'][wm_bounds[i]:wm_bounds[i + 1]], wm_seg_m=arrays['wm_seg_M'][wm_bounds[i]:wm_bounds[i + 1]]))
+    return list_slices
+
+
 def main(args=None):
 
     if args is None:
@@ -534,6 +669,8 @@ def main(args=None):
         param_data.register_param = arguments['-reg-param']
     if '-ind-rm' in arguments:
         param_model.ind_rm = arguments['-ind-rm']
+    if '-cpu-nb' in arguments:
+        param.cpu_number = int(arguments['-cpu-nb'])
     if '-r' in arguments:
         param.rm_tmp = bool(int(arguments['-r']))
     if '-v' in arguments:
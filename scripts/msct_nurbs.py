@@ -87,6 +87,7 @@ class NURBS():
         self.verbose = verbose
         self.all_slices = all_slices
         self.twodim = twodim
+        self.search_trace = []  # tested numbers of control points and their error, if nbControl is None
 
         if sens:                  # si on donne les points de controle#####
             if type(liste[0][0]).__name__ == 'list':
@@ -120,21 +121,19 @@ class NURBS():
                     sct.printv('ERROR : There are too few points to compute. The number of points of the curve must be strictly superior to degre +2 which is: ', self.nbControle, '. Either change degre to a lower value, either add points to the curve.')
                     exit(2)
 
+                # data points and their parametrization, shared by all the tested numbers of control points
+                Q = np.array([P_x, P_y] if twodim else [P_x, P_y, P_z], dtype=float).T
+                ubar = self.compute_parametrization(Q)
+
                 # compute weights based on curve density
                 w = [1.0] * len(P_x)
                 if weights:
-                    if not twodim:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = math.sqrt((P_x[i - 1] - P_x[i])**2 + (P_y[i - 1] - P_y[i])**2 + (P_z[i - 1] - P_z[i])**2)
-                            dist_after = math.sqrt((P_x[i] - P_x[i + 1])**2 + (P_y[i] - P_y[i + 1])**2 + (P_z[i] - P_z[i + 1])**2)
-                            w[i] = (dist_before + dist_after) / 2.0
-                    else:
-                        for i in range(1, len(P_x) - 1):
-                            dist_before = math.sqrt((P_x[i - 1] - P_x[i])**2 + (P_y[i - 1] - P_y[i])**2)
-                            dist_after = math.sqrt((P_x[i] - P_x[i + 1])**2 + (P_y[i] - P_y[i + 1])**2)
-                            w[i] = (dist_before + dist_after) / 2.0
+                    dist = np.sqrt(np.sum(np.diff(Q, axis=0) ** 2, axis=1))
+                    w[1:-1] = ((dist[:-1] + dist[1:]) / 2.0).tolist()
                     w[0], w[-1] = w[1], w[-2]
 
+                # the number of control points is increased until the error of approximation converges. The search
+                # trace lists the tested numbers of control points and their error (None if the fitting failed).
                 list_param_that_worked = []
                 last_error_curve = 0.0
                 second_last_error_curve = 0.0
@@ -150,42 +149,27 @@ class NURBS():
                         sct.printv('Test: # of control points = ' + str(self.nbControle))
                     try:
                         if not twodim:
-                            self.pointsControle = self.reconstructGlobalApproximation(P_x, P_y, P_z, self.degre, self.nbControle, w)
+                            self.pointsControle = self.reconstructGlobalApproximation(P_x, P_y, P_z, self.degre, self.nbControle, w, ubar=ubar)
                             self.courbe3D, self.courbe3D_deriv = self.construct3D(self.pointsControle, self.degre, self.precision / 3)  # generate curve with low resolution
                         else:
-                            self.pointsControle = self.reconstructGlobalApproximation2D(P_x, P_y, self.degre, self.nbControle, w)
+                            self.pointsControle = self.reconstructGlobalApproximation2D(P_x, P_y, self.degre, self.nbControle, w, ubar=ubar)
                             self.courbe2D, self.courbe2D_deriv = self.construct2D(self.pointsControle, self.degre, self.precision / 3)
 
                         # compute error between the input data and the nurbs
-                        error_curve = 0.0
-                        if not twodim:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe3D[0])):
-                                    dist = (self.courbe3D[0][k] - P_x[i])**2 + (self.courbe3D[1][k] - P_y[i])**2 + (self.courbe3D[2][k] - P_z[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
-                        else:
-                            for i in range(0, len(P_x)):
-                                min_dist = 10000.0
-                                for k in range(0, len(self.courbe2D[0])):
-                                    dist = (self.courbe2D[0][k] - P_x[i])**2 + (self.courbe2D[1][k] - P_y[i])**2
-                                    if dist < min_dist:
-                                        min_dist = dist
-                                error_curve += min_dist
-                        error_curve /= float(len(P_x))
+                        error_curve = self.compute_error(Q, self.courbe2D if twodim else self.courbe3D)
 
                         if verbose >= 1:
                             sct.printv('Error on approximation = ' + str(round(error_curve, 2)) + ' mm')
 
                         # Create a list of parameters that have worked in order to call back the last one that has worked
                         list_param_that_worked.append([self.nbControle, self.pointsControle, error_curve])
+                        self.search_trace.append([self.nbControle, error_curve])
 
                     except Exception as ex:
                         if verbose >= 1:
                             sct.log.error(ex)
                         error_curve = last_error_curve + 10000.0
+                        self.search_trace.append([self.nbControle, None])
 
                     # prepare for next iteration
                     self.nbControle += 1
@@ -238,62 +222,49 @@ class NURBS():
     def getCourbe2D_deriv(self):
         return self.courbe2D_deriv
 
-    # Multiplie deux polynomes
-    def multipolynome(self, polyA, polyB):
-        result = []
-        for r in polyB:
-            temp = polyA * r[0]
-            result.append([temp, r[-1]])
-        return result
-
-    def N(self, i, k, x):
-        global Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(1), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp[i][k - 1] == -1:
-                    Nik_temp[i][k - 1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([1 / den_g, -x[i] / den_g]), Nik_temp[i][k - 1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp[i + 1][k - 1] == -1:
-                    Nik_temp[i + 1][k - 1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-1 / den_d, x[i + k] / den_d]), Nik_temp[i + 1][k - 1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def Np(self, i, k, x):
-        global Nik_temp_deriv, Nik_temp
-        if k == 1:
-            tab = [[np.poly1d(0), i + 1]]
-        else:
-            tab = []
-            den_g = x[i + k - 1] - x[i]
-            den_d = x[i + k] - x[i + 1]
-            if den_g != 0:
-                if Nik_temp_deriv[i][-1] == -1:
-                    Nik_temp_deriv[i][-1] = self.N(i, k - 1, x)
-                tab_b = self.multipolynome(np.poly1d([k / den_g]), Nik_temp_deriv[i][-1])
-                tab.extend(tab_b)
-            if den_d != 0:
-                if Nik_temp_deriv[i + 1][-1] == -1:
-                    Nik_temp_deriv[i + 1][-1] = self.N(i + 1, k - 1, x)
-                tab_d = self.multipolynome(np.poly1d([-k / den_d]), Nik_temp_deriv[i + 1][-1])
-                tab.extend(tab_d)
-
-        return tab
-
-    def evaluateN(self, Ni, t, x):
-        result = 0
-        for Ni_temp in Ni:
-            if x[Ni_temp[-1] - 1] <= t <= x[Ni_temp[-1]]:
-                result += Ni_temp[0](t)
-        return result
+    @staticmethod
+    def evaluate_basis(k, x, t, derivative=False):
+        """
+        Evaluate all the B-spline basis functions of order k (degree k - 1) of the knot vector x at all the parameter
+        values t at once, with the Cox-de Boor recursion.
+        :param k: order of the basis functions
+        :param x: knot vector, of length n + k, where n is the number of basis functions
+        :param t: parameter values
+        :param derivative: if True, the derivatives of the basis functions are also returned. As in previous versions,
+               they are scaled by the order k (and not the degree k - 1).
+        :return: numpy array of shape (len(t), n), N[j, i] = N_i,k(t_j), and the array of derivatives if derivative
+        """
+        x = np.asarray(x, dtype=float)
+        t = np.asarray(t, dtype=float)[:, np.newaxis]
+        # order 1: indicator functions of the knot spans [x_i, x_i+1[. The last knot belongs to the last non-empty span.
+        N = ((x[:-1] <= t) & (t < x[1:])).astype(float)
+        span_last = np.nonzero(x[:-1] < x[1:])[0][-1]
+        N[t[:, 0] == x[span_last + 1], span_last] = 1.0
+        N_deriv = np.zeros((t.shape[0], len(x) - k))
+        for q in range(2, k + 1):
+            # 0/0 = 0 for repeated knots
+            den_g, den_d = x[q - 1:-1] - x[:-q], x[q:] - x[1:-q + 1]
+            inv_g, inv_d = np.zeros(den_g.shape), np.zeros(den_d.shape)
+            inv_g[den_g != 0], inv_d[den_d != 0] = 1.0 / den_g[den_g != 0], 1.0 / den_d[den_d != 0]
+            if q == k and derivative:
+                N_deriv = k * (inv_g * N[:, :-1] - inv_d * N[:, 1:])
+            N = (t - x[:-q]) * inv_g * N[:, :-1] + (x[q:] - t) * inv_d * N[:, 1:]
+        if derivative:
+            return N, N_deriv
+        return N
+
+    def evaluate_curve(self, P, k, x, param):
+        """
+        Evaluate the B-spline curve of control points P and knot vector x, and its derivative, at all the parameter
+        values at once.
+        :return: two numpy arrays of shape (len(param), dimension of the points): points and derivatives
+        """
+        N, N_deriv = self.evaluate_basis(k, x, param, derivative=True)
+        P = np.asarray(P, dtype=float)
+        sum_den = N.sum(axis=1)  # sum_den = 1 !
+        if np.any(sum_den <= 0.05):
+            raise Exception('WARNING: NURBS instability -> wrong reconstruction')
+        return N.dot(P) / sum_den[:, np.newaxis], N_deriv.dot(P)
 
     def calculX3D(self, P, k):
         n = len(P) - 1
@@ -334,78 +305,18 @@ class NURBS():
         return x
 
     def construct3D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in xrange(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in xrange(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
+        points, points_deriv = self.evaluate_curve(P, k, x, param)
 
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
+        order = np.argsort(points[:, 2])
+        P_x, P_y, P_z = points[order, 0], points[order, 1], points[order, 2]
+        P_x_d, P_y_d, P_z_d = points_deriv[order, 0], points_deriv[order, 1], points_deriv[order, 2]
 
+        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
         if self.all_slices:
             P_z = np.array([int(round(P_z[i])) for i in range(0, len(P_z))])
 
@@ -422,87 +333,23 @@ class NURBS():
                     P_z_d_temp = np.insert(P_z_d, np.where(P_z == i - 1)[-1][-1] + 1, (P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
                     P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
 
-            coord_mean = np.array([[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            P_z, [P_x, P_y, P_x_d, P_y_d, P_z_d] = self.average_by_slice(P_z, P_x, P_y, P_x_d, P_y_d, P_z_d)
 
         return [P_x, P_y, P_z], [P_x_d, P_y_d, P_z_d]
 
     def construct2D(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX2D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y = [], []  # coord fitees
-        P_x_d, P_y_d = [], []  # derivees
-        for i in xrange(len(param)):
-            sum_num_x, sum_num_y, sum_den = 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_den_der = 0, 0, 0
-
-            for l in xrange(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-        P_x = [P_x[i] for i in np.argsort(P_y)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_y)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_y)]
-        P_y = np.sort(P_y)
+        points, points_deriv = self.evaluate_curve(P, k, x, param)
 
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
+        order = np.argsort(points[:, 1])
+        P_x, P_y = points[order, 0], points[order, 1]
+        P_x_d, P_y_d = points_deriv[order, 0], points_deriv[order, 1]
 
+        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
         if self.all_slices:
             P_y = np.array([int(round(P_y[i])) for i in range(0, len(P_y))])
 
@@ -515,50 +362,100 @@ class NURBS():
                     P_y_d_temp = np.insert(P_y_d, np.where(P_y == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_y == i - 1)[-1][-1]] + P_y_d[np.where(P_y == i - 1)[-1][-1] + 1]) / 2)
                     P_x, P_y, P_x_d, P_y_d = P_x_temp, P_y_temp, P_x_d_temp, P_y_d_temp
 
-            coord_mean = np.array([[np.mean(P_x[P_y == i]), i] for i in range(min(P_y), max(P_y) + 1, 1)])
+            P_y, [P_x, P_x_d, P_y_d] = self.average_by_slice(P_y, P_x, P_x_d, P_y_d)
 
-            P_x = coord_mean[:, :][:, 0]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_y == i]), np.mean(P_y_d[P_y == i])] for i in range(min(P_y), max(P_y) + 1, 1)])
+        return [P_x, P_y], [P_x_d, P_y_d]
 
-            P_y = coord_mean[:, :][:, 1]
+    @staticmethod
+    def average_by_slice(z, *values):
+        """
+        Average values over the points of each slice.
+        :param z: numpy array of integer slice indexes of the points
+        :param values: numpy arrays of the values of the points
+        :return: slice indexes from min(z) to max(z) (float), and list of the averaged values
+        """
+        index = z - z.min()
+        nb_points = np.bincount(index)
+        return np.arange(z.min(), z.max() + 1, dtype=float), [np.bincount(index, weights=v) / nb_points for v in values]
 
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
+    @staticmethod
+    def compute_error(Q, curve):
+        """
+        Error of approximation: mean, over the data points, of the squared distance to the closest point of the curve
+        (bounded to 10000).
+        :param Q: numpy array of shape (m, dimension): data points
+        :param curve: list of the coordinates of the points of the curve, one array per dimension
+        """
+        curve = np.asarray(curve, dtype=float).T
+        min_dist = np.empty(len(Q))
+        # by chunks of data points, to bound the size of the distance matrix
+        for i in range(0, len(Q), 1000):
+            dist = np.sum((Q[i:i + 1000, np.newaxis, :] - curve[np.newaxis, :, :]) ** 2, axis=2)
+            min_dist[i:i + 1000] = np.minimum(dist.min(axis=1), 10000.0)
+        return np.sum(min_dist) / float(len(Q))
 
-        return [P_x, P_y], [P_x_d, P_y_d]
+    def isXinY(self, y, x):
+        """
+        Return True if each non-empty interval [y_i, y_i+1] of the knot vector y contains at least one parameter of x.
+        """
+        y, x = np.asarray(y, dtype=float), np.asarray(x, dtype=float)
+        inside = (y[:-1, np.newaxis] <= x) & (x <= y[1:, np.newaxis])
+        return bool(np.all(inside.any(axis=1) | (y[:-1] == y[1:])))
 
-    def Tk(self, k, Q, Nik, ubar, u):
-        return Q[k] - self.evaluateN(Nik[-1], ubar, u) * Q[-1] - self.evaluateN(Nik[0], ubar, u) * Q[0]
+    def approximate(self, Q, ubar, u, p, n, w):
+        """
+        Compute the control points of the least-square approximation of the data points Q, with fixed end points.
+        The normal equations are banded (bandwidth p - 1): they are solved with a banded Cholesky factorization.
+        :param Q: numpy array of shape (m, dimension): data points
+        :param ubar: parameters of the data points
+        :param u: knot vector
+        :param p: order of the NURBS
+        :param n: number of control points
+        :param w: weights of the data points
+        :return: numpy array of shape (n - 1, dimension): control points
+        """
+        from scipy.linalg import solveh_banded
+        m = len(Q)
+        # basis functions at the parameters of the data points (all but the last one)
+        N = self.evaluate_basis(p, u, ubar[0:m - 1])
+        denU = N.sum(axis=1)
+        R = N[:, 0:n - 1] / denU[:, np.newaxis]
+        w = np.asarray(w[0:m - 1], dtype=float)[:, np.newaxis]
+        Tk = Q[0:m - 1] - N[:, n - 1:n] * Q[-1] - N[:, 0:1] * Q[0]
+        T = R.T.dot(w * Tk)
+
+        A = R.T.dot(w * R)
+        A_banded = np.zeros((p, n - 1))
+        for i in range(min(p, n - 1)):
+            A_banded[i, 0:n - 1 - i] = np.diagonal(A, -i)
+        try:
+            P = solveh_banded(A_banded, T, lower=True)
+        except np.linalg.LinAlgError:
+            # not positive definite: general solver
+            P = np.linalg.solve(A, T)
+        return P
 
-    def isXinY(self, y, x):
-        result = True
-        for i in range(0, len(y) - 1):
-            if y[i] - y[i + 1] != 0.0:
-                result_temp = False
-                for j in range(0, len(x)):
-                    if y[i] - y[i + 1] != 0.0 and y[i] <= x[j] <= y[i + 1]:
-                        result_temp = True
-                        break
-                result = result and result_temp
-        return result
+    def compute_parametrization(self, Q):
+        """
+        Centripetal parametrization of the data points: cumulative length of the chords, normalized between 0 and 1.
+        It only depends on the data points, so it can be shared by fits with different numbers of control points.
+        :param Q: numpy array of shape (m, dimension): data points
+        :return: list of the m parameters
+        """
+        chords = np.sqrt(np.sum(np.diff(Q, axis=0) ** 2, axis=1))
+        di = np.cumsum(chords)[-1]
+        return [0] + np.cumsum(chords / di).tolist()
 
-    def reconstructGlobalApproximation(self, P_x, P_y, P_z, p, n, w):
+    def reconstructGlobalApproximation(self, P_x, P_y, P_z, p, n, w, ubar=None):
         # p = degre de la NURBS
         # n = nombre de points de controle desires
         # w is the weigth on each point P
-        global Nik_temp
+        # ubar: parametrization of the points (see compute_parametrization), computed if not provided
         m = len(P_x)
 
         # Calcul des chords
-        di = 0.0
-        for k in xrange(m - 1):
-            di += math.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2 + (P_z[k + 1] - P_z[k])**2)
-        ubar = [0]
-        for k in xrange(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(ubar[-1] + math.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2 + (P_z[k + 1] - P_z[k])**2) / di)  # centripetal method
+        if ubar is None:
+            ubar = self.compute_parametrization(np.array([P_x, P_y, P_z], dtype=float).T)
 
         # the knot vector should reflect the distribution of ubar
         d = (m + 1) / (n - p + 1)
@@ -592,61 +489,9 @@ class NURBS():
             u += gamma * (u_nonuniform - u_uniform)
             n_iter += 1
 
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]  # noqa
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in xrange(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in xrange(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in xrange(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in xrange(n - 1):
-            somme = 0
-            for k in xrange(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in xrange(n - 1):
-            somme = 0
-            for k in xrange(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        Tz = []
-        for i in xrange(n - 1):
-            somme = 0
-            for k in xrange(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_z, Nik, ubar[k], u) / denU[k]
-            Tz.append(somme)
-        Tz = np.matrix(Tz)
-
-        P_xb = (R.T * W * R).I * Tx.T
-        P_yb = (R.T * W * R).I * Ty.T
-        P_zb = (R.T * W * R).I * Tz.T
+        Q = np.array([P_x, P_y, P_z], dtype=float).T
+        P_b = self.approximate(Q, ubar, u, p, n, w)
+        P_xb, P_yb, P_zb = P_b[:, 0], P_b[:, 1], P_b[:, 2]
 
         # Modification of first and last control points
         P_xb[0], P_yb[0], P_zb[0] = P_x[0], P_y[0], P_z[0]
@@ -660,26 +505,20 @@ class NURBS():
         if std_x >= 0.1 and std_y >= 0.1 and std_z >= 0.1 and (std_Px > std_factor * std_x or std_Py > std_factor * std_y or std_Pz > std_factor * std_z):
             raise Exception('WARNING: NURBS instability -> wrong control points')
 
-        P = [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
+        P = P_b.tolist()
 
         return P
 
-    def reconstructGlobalApproximation2D(self, P_x, P_y, p, n, w):
+    def reconstructGlobalApproximation2D(self, P_x, P_y, p, n, w, ubar=None):
         # p = degre de la NURBS
         # n = nombre de points de controle desires
         # w is the weigth on each point P
-        global Nik_temp
+        # ubar: parametrization of the points (see compute_parametrization), computed if not provided
         m = len(P_x)
 
         # Calcul des chords
-        di = 0.0
-        for k in xrange(m - 1):
-            di += math.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2)
-        ubar = [0]
-        for k in xrange(m - 1):
-            # ubar.append((k+1)/float(m))  # uniform method
-            # ubar.append(ubar[-1]+abs((P_x[k+1]-P_x[k])**2 + (P_y[k+1]-P_y[k])**2 + (P_z[k+1]-P_z[k])**2)/di)  # chord length method
-            ubar.append(ubar[-1] + math.sqrt((P_x[k + 1] - P_x[k])**2 + (P_y[k + 1] - P_y[k])**2) / di)  # centripetal method
+        if ubar is None:
+            ubar = self.compute_parametrization(np.array([P_x, P_y], dtype=float).T)
 
         # the knot vector should reflect the distribution of ubar
         d = (m + 1) / (n - p + 1)
@@ -713,52 +552,9 @@ class NURBS():
             u += gamma * (u_nonuniform - u_uniform)
             n_iter += 1
 
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]  # noqa
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        R = []
-        for k in xrange(m - 1):
-            Rtemp = []
-            den = 0
-            for Ni in Nik:
-                den += self.evaluateN(Ni, ubar[k], u)
-            for i in xrange(n - 1):
-                Rtemp.append(self.evaluateN(Nik[i], ubar[k], u) / den)
-            R.append(Rtemp)
-        R = np.matrix(R)
-
-        # create W diagonal matrix
-        W = np.diag(w[0:-1])
-
-        # calcul des denominateurs par ubar
-        denU = []
-        for k in xrange(m - 1):
-            temp = 0
-            for Ni in Nik:
-                temp += self.evaluateN(Ni, ubar[k], u)
-            denU.append(temp)
-        Tx = []
-        for i in xrange(n - 1):
-            somme = 0
-            for k in xrange(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_x, Nik, ubar[k], u) / denU[k]
-            Tx.append(somme)
-        Tx = np.matrix(Tx)
-
-        Ty = []
-        for i in xrange(n - 1):
-            somme = 0
-            for k in xrange(m - 1):
-                somme += w[k] * self.evaluateN(Nik[i], ubar[k], u) * self.Tk(k, P_y, Nik, ubar[k], u) / denU[k]
-            Ty.append(somme)
-        Ty = np.matrix(Ty)
-
-        P_xb = (R.T * W * R).I * Tx.T
-        P_yb = (R.T * W * R).I * Ty.T
+        Q = np.array([P_x, P_y], dtype=float).T
+        P_b = self.approximate(Q, ubar, u, p, n, w)
+        P_xb, P_yb = P_b[:, 0], P_b[:, 1]
 
         # Modification of first and last control points
         P_xb[0], P_yb[0] = P_x[0], P_y[0]
@@ -772,12 +568,11 @@ class NURBS():
         if std_x >= 0.1 and std_y >= 0.1 and (std_Px > std_factor * std_x or std_Py > std_factor * std_y):
             raise Exception('WARNING: NURBS instability -> wrong control points')
 
-        P = [[P_xb[i, 0], P_yb[i, 0]] for i in range(len(P_xb))]
+        P = P_b.tolist()
 
         return P
 
     def reconstructGlobalInterpolation(self, P_x, P_y, P_z, p):  # now in 3D
-        global Nik_temp
         n = 13
         l = len(P_x)
         newPx = P_x[::int(round(l / (n - 1)))]
@@ -803,114 +598,33 @@ class NURBS():
             u.append(sumU / p)
         u.extend([1] * p)
 
-        # Construction des fonctions basiques
-        Nik_temp = [[-1 for j in xrange(p)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, p, u)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
         # Construction des matrices
-        M = []
-        for i in xrange(n):
-            ligneM = []
-            for j in xrange(n):
-                ligneM.append(self.evaluateN(Nik[j], ubar[i], u))
-            M.append(ligneM)
-        M = np.matrix(M)
+        M = self.evaluate_basis(p, u, ubar)
 
         # Matrice des points interpoles
-        Qx = np.matrix(newPx).T
-        Qy = np.matrix(newPy).T
-        Qz = np.matrix(newPz).T
+        Q = np.array([newPx, newPy, newPz], dtype=float).T
 
         # Calcul des points de controle
-        P_xb = M.I * Qx
-        P_yb = M.I * Qy
-        P_zb = M.I * Qz
-
-        return [[P_xb[i, 0], P_yb[i, 0], P_zb[i, 0]] for i in range(len(P_xb))]
-
-    def compute_curve_from_parametrization(self, P, k, x, Nik, Nikp, param):
-        n = len(P)  # Nombre de points de controle - 1
-        P_x, P_y, P_z = [], [], []  # coord fitees
-        P_x_d, P_y_d, P_z_d = [], [], []  # derivees
-        for i in xrange(len(param)):
-            sum_num_x, sum_num_y, sum_num_z, sum_den = 0, 0, 0, 0
-            sum_num_x_der, sum_num_y_der, sum_num_z_der, sum_den_der = 0, 0, 0, 0
-
-            for l in xrange(n - k + 1):  # utilisation que des points non nuls
-                if x[l + k - 1] <= param[i] < x[l + k]:
-                    debut = l
-            fin = debut + k - 1
-
-            for j, point in enumerate(P[debut:fin + 1]):
-                j = j + debut
-                N_temp = self.evaluateN(Nik[j], param[i], x)
-                N_temp_deriv = self.evaluateN(Nikp[j], param[i], x)
-                sum_num_x += N_temp * point[0]
-                sum_num_y += N_temp * point[1]
-                sum_num_z += N_temp * point[2]
-                sum_den += N_temp
-                sum_num_x_der += N_temp_deriv * point[0]
-                sum_num_y_der += N_temp_deriv * point[1]
-                sum_num_z_der += N_temp_deriv * point[2]
-                sum_den_der += N_temp_deriv
-
-            P_x.append(sum_num_x / sum_den)  # sum_den = 1 !
-            P_y.append(sum_num_y / sum_den)
-            P_z.append(sum_num_z / sum_den)
-            P_x_d.append(sum_num_x_der)
-            P_y_d.append(sum_num_y_der)
-            P_z_d.append(sum_num_z_der)
-
-            if sum_den <= 0.05:
-                raise Exception('WARNING: NURBS instability -> wrong reconstruction')
-
-        P_x = [P_x[i] for i in np.argsort(P_z)]
-        P_y = [P_y[i] for i in np.argsort(P_z)]
-        P_x_d = [P_x_d[i] for i in np.argsort(P_z)]
-        P_y_d = [P_y_d[i] for i in np.argsort(P_z)]
-        P_z_d = [P_z_d[i] for i in np.argsort(P_z)]
-        P_z = np.sort(P_z)
+        P_b = np.linalg.solve(M, Q)
 
-        # on veut que les coordonnees fittees aient le meme z que les coordonnes de depart. on se ramene donc a des entiers et on moyenne en x et y  .
-        P_x = np.array(P_x)
-        P_y = np.array(P_y)
-        P_x_d = np.array(P_x_d)
-        P_y_d = np.array(P_y_d)
-        P_z_d = np.array(P_z_d)
+        return P_b.tolist()
+
+    def compute_curve_from_parametrization(self, P, k, x, param):
+        points, points_deriv = self.evaluate_curve(P, k, x, param)
+        order = np.argsort(points[:, 2])
+        P_x, P_y, P_z = points[order, 0], points[order, 1], points[order, 2]
+        P_x_d, P_y_d, P_z_d = points_deriv[order, 0], points_deriv[order, 1], points_deriv[order, 2]
         return P_x, P_y, P_z, P_x_d, P_y_d, P_z_d
 
     def construct3D_uniform(self, P, k, prec):  # P point de controles
-        global Nik_temp, Nik_temp_deriv
-        n = len(P)  # Nombre de points de controle - 1
-
         # Calcul des xi
         x = self.calculX3D(P, k)
 
-        # Calcul des coefficients N(i,k)
-        Nik_temp = [[-1 for j in xrange(k)] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp[i][-1] = self.N(i, k, x)
-        Nik = []
-        for i in xrange(n):
-            Nik.append(Nik_temp[i][-1])
-
-        # Calcul des Nik,p'
-        Nik_temp_deriv = [[-1] for i in xrange(n)]
-        for i in xrange(n):
-            Nik_temp_deriv[i][-1] = self.Np(i, k, x)
-        Nikp = []
-        for i in xrange(n):
-            Nikp.append(Nik_temp_deriv[i][-1])
-
         # Calcul de la courbe
         # reparametrization of the curve
         import numpy as np
         param = np.linspace(x[0], x[-1], prec)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
         from msct_types import Centerline
         centerline = Centerline(P_x, P_y, P_z, P_x_d, P_y_d, P_z_d)
         distances_between_points = centerline.progressive_length
@@ -919,7 +633,7 @@ class NURBS():
         for i in range(1, prec):
             dist_curved[i] = dist_curved[i - 1] + distances_between_points[i - 1] / centerline.length
         param = x[0] + (x[-1] - x[0]) * np.interp(range_points, dist_curved, range_points)
-        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, Nik, Nikp, param)
+        P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = self.compute_curve_from_parametrization(P, k, x, param)
 
         if self.all_slices:
             P_z = np.array([int(round(P_z[i])) for i in range(0, len(P_z))])
@@ -942,20 +656,7 @@ class NURBS():
                         P_z_d[np.where(P_z == i - 1)[-1][-1]] + P_z_d[np.where(P_z == i - 1)[-1][-1] + 1]) / 2)
                     P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
 
-            coord_mean = np.array(
-                [[np.mean(P_x[P_z == i]), np.mean(P_y[P_z == i]), i] for i in range(min(P_z), max(P_z) + 1, 1)])
-
-            P_x = coord_mean[:, :][:, 0]
-            P_y = coord_mean[:, :][:, 1]
-
-            coord_mean_d = np.array([[np.mean(P_x_d[P_z == i]), np.mean(P_y_d[P_z == i]), np.mean(P_z_d[P_z == i])] for i in
-                                     range(min(P_z), max(P_z) + 1, 1)])
-
-            P_z = coord_mean[:, :][:, 2]
-
-            P_x_d = coord_mean_d[:, :][:, 0]
-            P_y_d = coord_mean_d[:, :][:, 1]
-            P_z_d = coord_mean_d[:, :][:, 2]
+            P_z, [P_x, P_y, P_x_d, P_y_d, P_z_d] = self.average_by_slice(P_z, P_x, P_y, P_x_d, P_y_d, P_z_d)
 
             # check if slice should be in the result, based on self.P_z
             indexes_to_remove = []
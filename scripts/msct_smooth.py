@@ -294,6 +294,8 @@ def b_spline_nurbs(x, y, z, fname_centerline=None, degree=3, point_number=3000,
         nbControl = round(nbControl)
 
     nurbs = NURBS(degree, point_number, data, False, nbControl, verbose, all_slices=all_slices, twodim=twodim)
+    if nurbs.search_trace:
+        sct.printv('Search of the number of control points (error on approximation): ' + ', '.join(str(nb) + ' (' + (str(round(error, 2)) if error is not None else 'failed') + ')' for nb, error in nurbs.search_trace), verbose)
 
     if not twodim:
         P = nurbs.getCourbe3D()
@@ -125,7 +125,7 @@ class CoordinateValue(Coordinate):
         return hash(self.value)
 
 
-class Centerline:
+class Centerline(object):
     """
     This class represents a centerline in an image. Its coordinates can be in voxel space as well as in physical space.
     A centerline is defined by its points and the derivatives of each point.
@@ -207,19 +207,19 @@ class Centerline:
             # Load centerline data from points and derivatives in parameters
             if points_x is None or points_y is None or points_z is None or deriv_x is None or deriv_y is None or deriv_z is None:
                 raise ValueError('Data must be provided to centerline to be initialized')
-            self.points = array(zip(points_x, points_y, points_z))
-            self.derivatives = array(zip(deriv_x, deriv_y, deriv_z))
+            self.points = np.column_stack((points_x, points_y, points_z))
+            self.derivatives = np.column_stack((deriv_x, deriv_y, deriv_z))
+        self.derivatives = self.derivatives.astype(float)
 
         self.number_of_points = len(self.points)
 
         # computation of centerline features, based on points and derivatives
         self.compute_length()
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        self.matrices, self.inverse_matrices = self.compute_coordinate_systems()
+        self.offset_plans = -einsum('ij,ij->i', self.derivatives, self.points)
+        # per-point coordinate systems and plane parameters are built from the arrays above when first needed
+        self._coordinate_system = None
+        self._plans_parameters = None
 
         # initialization of KDTree for enabling computation of nearest points in centerline
         self.tree_points = cKDTree(self.points)
@@ -227,20 +227,33 @@ class Centerline:
         if self.compute_init_distribution:
             self.compute_vertebral_distribution(disks_levels=self.disks_levels, label_reference=self.label_reference)
 
+    @property
+    def coordinate_system(self):
+        """
+        List of (origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix) for each point, as
+        returned by compute_coordinate_system().
+        """
+        if self._coordinate_system is None:
+            self._coordinate_system = list(zip(self.points, self.matrices[:, :, 0], self.matrices[:, :, 1],
+                                               self.matrices[:, :, 2], self.matrices, self.inverse_matrices))
+        return self._coordinate_system
+
+    @property
+    def plans_parameters(self):
+        """
+        List of plane parameters [a, b, c, d] for each point, as returned by get_plan_parameters().
+        """
+        if self._plans_parameters is None:
+            self._plans_parameters = np.column_stack((self.derivatives, self.offset_plans)).tolist()
+        return self._plans_parameters
+
     def compute_length(self):
-        for i in range(0, self.number_of_points - 1):
-            distance = sqrt((self.points[i][0] - self.points[i + 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i + 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i + 1][2]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = sqrt((self.points[i][0] - self.points[i - 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i - 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i - 1][2]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        distances = norm(np.diff(self.points, axis=0), axis=1)
+        self.length += float(np.sum(distances))
+        self.progressive_length.extend(distances.tolist())
+        self.incremental_length.extend((self.incremental_length[-1] + np.cumsum(distances)).tolist())
+        self.progressive_length_inverse.extend(distances[::-1].tolist())
+        self.incremental_length_inverse.extend((self.incremental_length_inverse[-1] + np.cumsum(distances[::-1])).tolist())
 
     def find_nearest_index(self, coord):
         """
@@ -352,6 +365,25 @@ class Centerline:
 
         return origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix
 
+    def compute_coordinate_systems(self):
+        """
+        This function computes the coordinate reference systems of all points of the centerline at once. Derivatives
+        are normalized in place, as in compute_coordinate_system().
+        :return: matrices (N, 3, 3), whose columns are the X, Y and Z axes of each plane, and their inverses
+        """
+        z_prime_axes = self.derivatives
+        z_prime_axes /= norm(z_prime_axes, axis=1)[:, np.newaxis]
+        y_axis = array([0, 1, 0])
+        y_prime_axes = y_axis - z_prime_axes[:, 1:2] * z_prime_axes
+        y_prime_axes /= norm(y_prime_axes, axis=1)[:, np.newaxis]
+        x_prime_axes = cross(y_prime_axes, z_prime_axes)
+        x_prime_axes /= norm(x_prime_axes, axis=1)[:, np.newaxis]
+
+        matrices = stack([x_prime_axes, y_prime_axes, z_prime_axes], axis=2)
+        inverse_matrices = inv(matrices)
+
+        return matrices, inverse_matrices
+
     def get_projected_coordinates_on_plane(self, coord, index, plane_params=None):
         """
         This function returns the coordinates of
@@ -621,7 +653,7 @@ class Centerline:
         x_grid, y_grid, z_grid = np.mgrid[-size:size:resolution, -size:size:resolution, 0:1]
         coordinates_grid = np.array(zip(x_grid.ravel(), y_grid.ravel(), z_grid.ravel()))
         coordinates_phys = self.get_inverse_plans_coordinates(coordinates_grid, np.array([index] * len(coordinates_grid)))
-        coordinates_im = np.array(image.transfo_phys2continuouspix(coordinates_phys))
+        coordinates_im = image.transfo_phys2pix_array(coordinates_phys, continuous=True)
         square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
         return square.reshape((len(x_grid), len(x_grid)))
 
@@ -654,7 +686,7 @@ class Centerline:
         P_x = np.array([point[0] for point in self.points])
         P_y = np.array([point[1] for point in self.points])
         P_z = np.array([point[2] for point in self.points])
-        P_z_vox = np.array([coord[2] for coord in image.transfo_phys2pix(self.points)])
+        P_z_vox = image.transfo_phys2pix_array(self.points)[:, 2]
         P_x_d = np.array([deriv[0] for deriv in self.derivatives])
         P_y_d = np.array([deriv[1] for deriv in self.derivatives])
         P_z_d = np.array([deriv[2] for deriv in self.derivatives])
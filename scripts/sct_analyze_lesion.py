@@ -404,7 +404,7 @@ class AnalyzeLeion:
 
     def angle_correction(self):
         # Empty arrays in which angle for each z slice will be stored
-        self.angles = np.zeros(Image(self.fname_mask).dim[2])
+        self.angles = np.zeros(Image(self.fname_mask, lazy=True).dim[2])
 
         if self.fname_sc is not None:
             im_seg = Image(self.fname_sc)
@@ -450,7 +450,7 @@ class AnalyzeLeion:
 
     def orient2rpi(self):
         # save input image orientation
-        self.orientation = get_orientation(Image(self.fname_mask))
+        self.orientation = get_orientation(Image(self.fname_mask, lazy=True))
 
         if not self.orientation == 'RPI':
             printv('\nOrient input image(s) to RPI orientation...', self.verbose, 'normal')
@@ -13,8 +13,8 @@ import shutil
 import sys
 import numpy as np
 import itertools
-from math import radians
-from skimage.feature import greycomatrix, greycoprops
+from math import radians, sin, cos
+from multiprocessing import Pool, cpu_count
 
 from msct_image import Image
 from msct_parser import Parser
@@ -68,6 +68,11 @@ def get_parser():
                       mandatory=False,
                       default_value=Param().path_results,
                       example='/my_texture/')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for computing the texture (slices are processed in parallel). 0 or 1: no parallel computation. By default, uses all the available cores.",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name="-igt",
                       type_value="image_nifti",
                       description="File name of ground-truth texture metrics.",
@@ -88,6 +93,109 @@ def get_parser():
     return parser
 
 
+GLCM_PROPERTIES = ['contrast', 'dissimilarity', 'homogeneity', 'energy', 'correlation', 'ASM']
+
+
+def get_windows(data, size):
+    """
+    View of all the (size x size) windows of a 2D array, without copy.
+    :return: array of shape (nx - size + 1, ny - size + 1, size, size). Element [x, y] is data[x:x+size, y:y+size]
+    """
+    nx, ny = data.shape
+    stride_x, stride_y = data.strides
+    return np.lib.stride_tricks.as_strided(data, shape=(nx - size + 1, ny - size + 1, size, size),
+                                           strides=(stride_x, stride_y, stride_x, stride_y))
+
+
+def compute_glcm_properties(windows, distance, angles, properties, symmetric=True):
+    """
+    Compute GLCM properties of a batch of windows, for several angles at once. Results are identical to the ones of
+    skimage.feature.greycomatrix (256 levels, normed) followed by skimage.feature.greycoprops, but the co-occurrence
+    matrices are never built: each window is represented by the list of its pairs of grey levels (i, j), and every
+    property is a mean over these pairs, except ASM which is computed from the number of occurrences of each pair.
+    :param windows: uint8 array (nb_windows, size, size)
+    :param distance: int, distance between the pixels of a pair
+    :param angles: list of angles, in degrees
+    :param properties: list of GLCM properties (see GLCM_PROPERTIES)
+    :param symmetric: bool, if True, pairs (i, j) and (j, i) are both counted (see greycomatrix)
+    :return: array (len(properties), len(angles), nb_windows)
+    """
+    for prop in properties:
+        if prop not in GLCM_PROPERTIES:
+            raise ValueError('%s is an invalid property' % prop)
+    nb_windows, size = windows.shape[:2]
+    windows = windows.astype(int)
+    result = np.zeros((len(properties), len(angles), nb_windows))
+    for ind_angle, angle in enumerate(angles):
+        # offset of the second pixel of each pair, same convention as greycomatrix
+        row, col = int(round(sin(radians(angle)) * distance)), int(round(cos(radians(angle)) * distance))
+        start_row, end_row = max(0, -row), min(size, size - row)
+        start_col, end_col = max(0, -col), min(size, size - col)
+        level_i = windows[:, start_row:end_row, start_col:end_col].reshape(nb_windows, -1)
+        level_j = windows[:, start_row + row:end_row + row, start_col + col:end_col + col].reshape(nb_windows, -1)
+        if symmetric:
+            level_i, level_j = np.hstack((level_i, level_j)), np.hstack((level_j, level_i))
+        nb_pairs = level_i.shape[1]
+        diff = level_i - level_j
+
+        for ind_prop, prop in enumerate(properties):
+            if prop == 'contrast':
+                value = np.mean(diff ** 2, axis=1)
+            elif prop == 'dissimilarity':
+                value = np.mean(np.abs(diff), axis=1)
+            elif prop == 'homogeneity':
+                value = np.mean(1. / (1. + diff ** 2), axis=1)
+            elif prop in ['ASM', 'energy']:
+                # sum of the squared number of occurrences of each pair: after sorting the pairs of each window, the
+                # k-th occurrence (k starting at 0) of a pair contributes 2k+1
+                codes = np.sort(level_i * 256 + level_j, axis=1)
+                position = np.arange(nb_pairs)
+                first = np.ones(codes.shape, dtype=bool)
+                first[:, 1:] = codes[:, 1:] != codes[:, :-1]
+                start_run = np.maximum.accumulate(np.where(first, position, 0), axis=1)
+                value = np.sum(2 * (position - start_run) + 1, axis=1) / float(nb_pairs ** 2)
+                if prop == 'energy':
+                    value = np.sqrt(value)
+            else:
+                diff_i = level_i - np.mean(level_i, axis=1)[:, None]
+                diff_j = level_j - np.mean(level_j, axis=1)[:, None]
+                std_i = np.sqrt(np.mean(diff_i ** 2, axis=1))
+                std_j = np.sqrt(np.mean(diff_j ** 2, axis=1))
+                cov = np.mean(diff_i * diff_j, axis=1)
+                # same handling of the standard deviations near zero as greycoprops
+                mask_0 = (std_i < 1e-15) | (std_j < 1e-15)
+                value = np.ones(nb_windows)
+                value[~mask_0] = cov[~mask_0] / (std_i[~mask_0] * std_j[~mask_0])
+            result[ind_prop, ind_angle] = value
+    return result
+
+
+def compute_texture_slice(args):
+    """
+    Compute the GLCM texture maps of a 2D slice. The texture is computed for each voxel whose whole window
+    (2*distance+1 x 2*distance+1) is within the slice and within the mask, other voxels are set to zero.
+    Defined at the module level to be used by a multiprocessing pool.
+    :param args: tuple (im_z, seg_z, distance, angles, properties, symmetric)
+    :return: array (len(properties), len(angles), nx, ny)
+    """
+    im_z, seg_z, distance, angles, properties, symmetric = args
+    size = 2 * distance + 1
+    texture = np.zeros((len(properties), len(angles)) + im_z.shape)
+    if min(im_z.shape) < size:
+        return texture
+
+    # centers of the windows that are fully within the mask
+    x, y = np.nonzero(np.all(get_windows(seg_z != 0, size), axis=(2, 3)))
+    if not len(x):
+        return texture
+
+    # quantize the slice once, as done by greycomatrix on uint8 windows
+    windows = get_windows(np.ascontiguousarray(im_z.astype(np.uint8)), size)[x, y]
+    texture[:, :, x + distance, y + distance] = compute_glcm_properties(windows, distance, angles, properties,
+                                                                        symmetric=symmetric)
+    return texture
+
+
 class ExtractGLCM:
     def __init__(self, param=None, param_glcm=None):
         self.param = param if param is not None else Param()
@@ -113,7 +221,7 @@ class ExtractGLCM:
         self.dct_im_seg = {'im': None, 'seg': None}
 
         # to re-orient the data at the end if needed
-        self.orientation_im = get_orientation(Image(self.param.fname_im))
+        self.orientation_im = get_orientation(Image(self.param.fname_im, lazy=True))
 
         self.fname_metric_lst = {}
 
@@ -227,36 +335,33 @@ class ExtractGLCM:
             dct_metric[m] = im_2save
             # dct_metric[m] = Image(self.fname_metric_lst[m])
 
-        timer = Timer(number_of_iteration=len(self.dct_im_seg['im']))
-        timer.start()
+        # compute all the properties and angles of a slice at once
+        properties = self.param_glcm.feature.split(',')
+        properties = [p.upper() if p.upper() == 'ASM' else p for p in properties]
+        angles = [int(a) for a in self.param_glcm.angle.split(',')]
+        jobs = [(im_z, seg_z, offset, angles, properties, self.param_glcm.symmetric)
+                for im_z, seg_z in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'])]
 
-        for im_z, seg_z, zz in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'], range(len(self.dct_im_seg['im']))):
-            for xx in range(im_z.shape[0]):
-                for yy in range(im_z.shape[1]):
-                    if not seg_z[xx, yy]:
-                        continue
-                    if xx < offset or yy < offset:
-                        continue
-                    if xx > (im_z.shape[0] - offset - 1) or yy > (im_z.shape[1] - offset - 1):
-                        continue  # to check if the whole glcm_window is in the axial_slice
-                    if False in np.unique(seg_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]):
-                        continue  # to check if the whole glcm_window is in the mask of the axial_slice
-
-                    glcm_window = im_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]
-                    glcm_window = glcm_window.astype(np.uint8)
-
-                    dct_glcm = {}
-                    for a in self.param_glcm.angle.split(','):  # compute the GLCM for self.param_glcm.distance and for each self.param_glcm.angle
-                        dct_glcm[a] = greycomatrix(glcm_window,
-                                                   [self.param_glcm.distance], [radians(int(a))],
-                                                   symmetric=self.param_glcm.symmetric,
-                                                   normed=self.param_glcm.normed)
-
-                    for m in self.metric_lst:  # compute the GLCM property (m.split('_')[0]) of the voxel xx,yy,zz
-                        dct_metric[m].data[xx, yy, zz] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
+        timer = Timer(number_of_iteration=len(jobs))
+        timer.start()
 
+        def fill_metric(zz, texture):
+            for ind_prop, ind_angle in itertools.product(range(len(properties)), range(len(angles))):
+                dct_metric[self.metric_lst[ind_prop * len(angles) + ind_angle]].data[:, :, zz] = texture[ind_prop, ind_angle]
             timer.add_iteration()
 
+        if self.param.cpu_number > 1 and len(jobs) > 1:
+            pool = Pool(min(self.param.cpu_number, len(jobs)))
+            try:
+                for zz, texture in enumerate(pool.imap(compute_texture_slice, jobs)):
+                    fill_metric(zz, texture)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for zz, job in enumerate(jobs):
+                fill_metric(zz, compute_texture_slice(job))
+
         timer.stop()
 
         for m in self.metric_lst:
@@ -282,6 +387,7 @@ class Param:
         self.verbose = '1'
         self.dim = 'ax'
         self.rm_tmp = True
+        self.cpu_number = cpu_count()  # number of processes used for computing the texture
 
 
 class ParamGLCM(object):
@@ -325,6 +431,8 @@ def main(args=None):
 
     if '-dim' in arguments:
         param.dim = arguments['-dim']
+    if '-cpu-nb' in arguments:
+        param.cpu_number = int(arguments['-cpu-nb'])
     if '-r' in arguments:
         param.rm_tmp = bool(int(arguments['-r']))
     if '-v' in arguments:
@@ -17,6 +17,7 @@
 import sys
 import os
 import time
+import numpy as np
 from msct_parser import Parser
 import sct_utils as sct
 from sct_crop_image import ImageCropper
@@ -89,7 +90,7 @@ def get_parser():
 
 
 class Transform:
-    def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
+    def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0, cpu_number=None):
         self.input_filename = input_filename
         if isinstance(warp, str):
             self.warp_input = list([warp])
@@ -102,6 +103,7 @@ class Transform:
         self.verbose = verbose
         self.remove_temp_files = remove_temp_files
         self.debug = debug
+        self.cpu_number = cpu_number  # number of threads used for 4D data. Default: number of CPUs
 
     def apply(self):
         # Initialization
@@ -158,7 +160,7 @@ class Transform:
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
         from msct_image import Image
-        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src).dim
+        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src, lazy=True).dim
         # nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
 
@@ -172,6 +174,13 @@ class Transform:
                 dim = '3'
             sct.run('isct_antsApplyTransforms -d '+dim+' -i ' + fname_src + ' -o ' + fname_out + ' -t ' + ' '.join(fname_warp_list_invert) + ' -r ' + fname_dest + interp, verbose)
 
+        # if 4d and only displacement fields (and geometries given by the sform): sampling coordinates are computed once
+        # for all volumes
+        elif all(is_displacement_field(fname_warp) for fname_warp in fname_warp_list_invert) \
+                and all(has_sform(Image(fname, lazy=True)) for fname in [fname_src, fname_dest] + fname_warp_list):
+            sct.printv('\nApply transformation to each 3D volume...', verbose)
+            apply_transfo_4d(fname_src, fname_out, fname_dest, fname_warp_list, self.interp, cpu_number=self.cpu_number, verbose=verbose)
+
         # if 4d, loop across the T dimension
         else:
             # create temporary folder
@@ -212,11 +221,9 @@ class Transform:
             # Merge files back
             sct.printv('\nMerge file back...', verbose)
             from sct_image import concat_data
-            import glob
             path_out, name_out, ext_out = sct.extract_fname(fname_out)
-            # im_list = [Image(file_name) for file_name in glob.glob('data_reg_T*.nii')]
             # concat_data use to take a list of image in input, now takes a list of file names to open the files one by one (see issue #715)
-            fname_list = glob.glob('data_reg_T*.nii')
+            fname_list = ['data_reg_T' + str(it).zfill(4) + '.nii' for it in range(nt)]
             im_out = concat_data(fname_list, 3, im_header['pixdim'])
             im_out.setFileName(name_out + ext_out)
             im_out.save(squeeze_data=False)
@@ -245,6 +252,209 @@ class Transform:
         sct.printv('fslview ' + fname_dest + ' ' + fname_out + ' &\n', verbose, 'info')
 
 
+# order of the spline used by scipy.ndimage for each interpolation method of isct_antsApplyTransforms
+interp_order = {'nn': 0, 'linear': 1, 'spline': 3}
+
+
+def is_displacement_field(fname_warp):
+    """
+    Return True if a transformation of the warp list is a (non-inverted) displacement field, i.e., if it can be applied
+    natively by get_sampling_coordinates.
+    """
+    path_warp, file_warp, ext_warp = sct.extract_fname(fname_warp)
+    return not fname_warp.startswith('-') and ext_warp not in ['.txt', '.mat']
+
+
+def has_sform(im):
+    """
+    Return True if the voxel to physical transformation of the image is given by its sform (sform_code > 0), which is the
+    only geometry used by the native resampling. Other images (qform only, or no orientation at all) are warped by
+    isct_antsApplyTransforms, which falls back on the qform or on the voxel size.
+    """
+    return im.hdr.get_sform(coded=True)[1] > 0
+
+
+def get_sampling_coordinates(im_dest, fname_warp_list):
+    """
+    Compute, for the center of each voxel of the destination image, the physical coordinates of the point of the source
+    image where it should be sampled. Displacement fields follow the ITK convention (as generated by ANTs): vectors are
+    expressed in LPS physical coordinates, and are interpolated linearly (zero displacement more than half a voxel
+    outside of the field). Fields of 2D images (two components, e.g. generated for 2D slices) displace points in the
+    axial plane only.
+    :param im_dest: destination image (Image, 3D)
+    :param fname_warp_list: displacement fields, in the order used by sct_apply_transfo (from source to destination)
+    :return: numpy array of shape (nx, ny, nz, 3), RAS physical coordinates
+    """
+    from scipy.ndimage import map_coordinates
+    from msct_image import Image
+    nx, ny, nz = im_dest.dim[0:3]
+    coord_phys = im_dest.transfo_pix2phys_array(tuple(np.ogrid[0:nx, 0:ny, 0:nz]))
+    # a point of the destination goes through the last warping field first
+    for i, fname_warp in enumerate(fname_warp_list[::-1]):
+        im_warp = Image(fname_warp, lazy=True)
+        displacement = im_warp.data.reshape(im_warp.data.shape[0:3] + (-1,))
+        nb_components = displacement.shape[3]
+        if i == 0 and displacement.shape[0:3] == (nx, ny, nz) and np.allclose(im_warp.hdr.get_sform(), im_dest.hdr.get_sform()):
+            # warping field defined on the grid of the destination image: no interpolation
+            displacement_dest = displacement
+        else:
+            coord_warp = np.rollaxis(im_warp.transfo_phys2pix_array(coord_phys, continuous=True), 3)
+            displacement_dest = np.empty(coord_phys.shape[0:3] + (nb_components,))
+            for j in range(nb_components):
+                displacement_dest[..., j] = map_coordinates(displacement[..., j], coord_warp, order=1, mode='nearest')
+            # as in ITK, no displacement beyond half a voxel outside of the field
+            for j in range(3):
+                displacement_dest[(coord_warp[j] < -0.5) | (coord_warp[j] >= displacement.shape[j] - 0.5)] = 0
+        # LPS displacements to RAS coordinates
+        coord_phys[..., 0] -= displacement_dest[..., 0]
+        coord_phys[..., 1] -= displacement_dest[..., 1]
+        if nb_components == 3:
+            coord_phys[..., 2] += displacement_dest[..., 2]
+    return coord_phys
+
+
+def resample_volume(data, coord_vox, interp='spline'):
+    """
+    Sample a 3D volume at continuous voxel coordinates, with the interpolation methods of isct_antsApplyTransforms.
+    As in ITK, points up to half a voxel outside of the first and last voxel centers are inside the volume (with the
+    boundary conditions of the ITK interpolators), and other points are set to 0.
+    :param coord_vox: numpy array of shape (3, nx, ny, nz), voxel coordinates in the volume
+    :return: numpy array of shape (nx, ny, nz), float32
+    """
+    from scipy.ndimage import map_coordinates
+    order = interp_order[interp]
+    data_out = map_coordinates(data, coord_vox, order=order, mode='mirror' if order > 1 else 'nearest', output=np.float32)
+    for i in range(3):
+        data_out[(coord_vox[i] < -0.5) | (coord_vox[i] >= data.shape[i] - 0.5)] = 0
+    return data_out
+
+
+def apply_transfo_to_files(fname_src_list, fname_out_list, fname_dest, fname_warp_list, interp_list, cpu_number=None, verbose=1):
+    """
+    Warp several 3D images into the same destination image with the same displacement fields. The warping fields are
+    read and the sampling coordinates are computed only once (and converted once per source grid), then all images are
+    resampled in a pool of threads. If the warp list contains affine or inverse transformations, or if an image is not
+    3D or has no sform (see has_sform), images are warped one by one with Transform.
+    :param fname_src_list: list of source images
+    :param fname_out_list: list of output images
+    :param fname_dest: destination image
+    :param fname_warp_list: list of warping fields, in the order used by sct_apply_transfo (from source to destination)
+    :param interp_list: list of interpolation methods {nn, linear, spline}, one per source image
+    :param cpu_number: number of threads. Default: number of CPUs
+    """
+    from msct_image import Image
+    if not fname_src_list:
+        return
+    if cpu_number is None:
+        from multiprocessing import cpu_count
+        cpu_number = cpu_count()
+    im_dest = Image(fname_dest, lazy=True)
+    im_src_list = [Image(fname_src, lazy=True) for fname_src in fname_src_list]
+
+    if not all(is_displacement_field(fname_warp) for fname_warp in fname_warp_list) or not sct.check_if_3d(fname_dest) \
+            or not has_sform(im_dest) or not all(has_sform(Image(fname_warp, lazy=True)) for fname_warp in fname_warp_list):
+        for fname_src, fname_out, interp in zip(fname_src_list, fname_out_list, interp_list):
+            Transform(fname_src, list(fname_warp_list), fname_dest, fname_out, verbose=verbose, interp=interp).apply()
+        return
+
+    sct.printv('\nCompute sampling coordinates...', verbose)
+    coord_phys = get_sampling_coordinates(im_dest, fname_warp_list)
+
+    def get_grid(im):
+        return tuple(im.dim[0:3]), tuple(im.hdr.get_sform().ravel())
+
+    # voxel coordinates, computed once per grid of source images (e.g., all the files of a template)
+    coord_vox = {}
+    def is_resampled(im):
+        # 4D images and images without sform are warped by Transform
+        return im.dim[3] == 1 and has_sform(im)
+
+    for im_src in im_src_list:
+        if is_resampled(im_src) and get_grid(im_src) not in coord_vox:
+            coord_vox[get_grid(im_src)] = np.rollaxis(im_src.transfo_phys2pix_array(coord_phys, continuous=True), 3)
+    del coord_phys
+
+    def warp_file(args):
+        im_src, fname_out, interp = args
+        if not is_resampled(im_src):
+            Transform(im_src.absolutepath, list(fname_warp_list), fname_dest, fname_out, verbose=0, interp=interp).apply()
+            return
+        im_out = im_dest.copy()
+        # data are read here and released once warped
+        data_src = im_src.get_data_slab(0, im_src.dim[2]).reshape(im_src.dim[0:3])
+        im_out.data = resample_volume(data_src, coord_vox[get_grid(im_src)], interp)
+        im_out.hdr.set_data_dtype(np.float32)
+        im_out.setFileName(fname_out)
+        im_out.save(verbose=0)
+
+    sct.printv('\nWarp ' + str(len(im_src_list)) + ' images...', verbose)
+    jobs = list(zip(im_src_list, fname_out_list, interp_list))
+    if cpu_number > 1 and len(jobs) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(cpu_number, len(jobs)))
+        try:
+            pool.map(warp_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            warp_file(job)
+
+
+def apply_transfo_4d(fname_src, fname_out, fname_dest, fname_warp_list, interp='spline', cpu_number=None, verbose=1):
+    """
+    Apply displacement fields to every volume of a 4D image. The sampling coordinates are computed once, then chunks of
+    volumes are read and resampled in a pool of threads, and written into a preallocated output.
+    :param fname_warp_list: list of warping fields (displacement fields only), in the order used by sct_apply_transfo
+    :param cpu_number: number of threads. Default: number of CPUs
+    """
+    from msct_image import Image
+    if cpu_number is None:
+        from multiprocessing import cpu_count
+        cpu_number = cpu_count()
+    im_src = Image(fname_src, lazy=True)
+    im_dest = Image(fname_dest, lazy=True)
+    nt, pt = im_src.dim[3], im_src.dim[7]
+
+    sct.printv('  Compute sampling coordinates...', verbose)
+    coord_vox = np.rollaxis(im_src.transfo_phys2pix_array(get_sampling_coordinates(im_dest, fname_warp_list), continuous=True), 3)
+    data_out = np.empty(tuple(im_dest.dim[0:3]) + (nt,), dtype=np.float32)
+
+    def warp_chunk(chunk):
+        # volumes of the chunk are read together, and released once warped
+        t_start, t_end = chunk
+        data_chunk = im_src.get_data_slab(t_start, t_end, axis=3).reshape(tuple(im_src.dim[0:3]) + (t_end - t_start,))
+        for it in range(t_start, t_end):
+            data_out[..., it] = resample_volume(data_chunk[..., it - t_start], coord_vox, interp)
+
+    # a few chunks per thread, to balance the load
+    chunk_size = max(1, int(np.ceil(nt / (2.0 * cpu_number))))
+    chunks = [(t, min(t + chunk_size, nt)) for t in range(0, nt, chunk_size)]
+    sct.printv('  Warp ' + str(nt) + ' volumes...', verbose)
+    if cpu_number > 1 and len(chunks) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(cpu_number, len(chunks)))
+        try:
+            pool.map(warp_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            warp_chunk(chunk)
+
+    # geometry of the destination image, time resolution of the source image
+    im_out = im_dest.copy()
+    im_out.data = data_out
+    im_out.hdr.set_data_dtype(np.float32)
+    im_out.hdr.set_data_shape(data_out.shape)
+    im_out.hdr.set_zooms(tuple(im_dest.dim[4:7]) + (pt,))
+    im_out.hdr.set_xyzt_units(im_dest.hdr.get_xyzt_units()[0], im_src.hdr.get_xyzt_units()[1])
+    im_out.setFileName(fname_out)
+    im_out.save(squeeze_data=False, verbose=0)
+
+
 # MAIN
 # ==========================================================================================
 def main(args=None):
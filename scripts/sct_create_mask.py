@@ -113,7 +113,7 @@ def create_mask(param):
     # sct.run('mkdir '+path_tmp, param.verbose)
 
     sct.printv('\nCheck orientation...', param.verbose)
-    orientation_input = get_orientation(Image(param.fname_data))
+    orientation_input = get_orientation(Image(param.fname_data, lazy=True))
     sct.printv('.. ' + orientation_input, param.verbose)
     reorient_coordinates = False
 
@@ -145,7 +145,7 @@ def create_mask(param):
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image('data_RPI.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image('data_RPI.nii', lazy=True).dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
     # in case user input 4d data
     if nt != 1:
@@ -176,7 +176,7 @@ class ImageCropper(object):
 
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
-        nx, ny, nz, nt, px, py, pz, pt = Image(fname_data).dim
+        nx, ny, nz, nt, px, py, pz, pt = Image(fname_data, lazy=True).dim
         sct.printv('.. ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
         # check if 4D data
         if not nt == 1:
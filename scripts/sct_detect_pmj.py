@@ -94,7 +94,7 @@ class DetectPMJ:
 
         self.tmp_dir = tmp_create(verbose=self.verbose)  # path to tmp directory
 
-        self.orientation_im = get_orientation(Image(self.fname_im))  # to re-orient the data at the end
+        self.orientation_im = get_orientation(Image(self.fname_im, lazy=True))  # to re-orient the data at the end
 
         self.slice2D_im = extract_fname(self.fname_im)[1] + '_midSag.nii'  # file used to do the detection, with only one slice
         self.dection_map_pmj = extract_fname(self.fname_im)[1] + '_map_pmj'  # file resulting from the detection
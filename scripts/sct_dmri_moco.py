@@ -31,17 +31,18 @@
 
 import sys
 import os
+import shutil
 import commands
 import time
-import math
 import numpy as np
 import sct_utils as sct
 import msct_moco as moco
 from sct_dmri_separate_b0_and_dwi import identify_b0
 import importlib
+from copy import deepcopy
 from sct_convert import convert
 from msct_image import Image
-from sct_image import copy_header, split_data, concat_data
+from sct_image import copy_header
 from msct_parser import Parser
 
 
@@ -76,6 +77,7 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.cpu_number = 1  # number of volumes registered in parallel, once the target does not change anymore
 
     # update constructor with user's parameters
     def update(self, param_user):
@@ -153,7 +155,8 @@ def get_parser():
                                                 "smooth [mm]: Smoothing kernel. Default=" + param_default.smooth + ".\n"
                                                   "metric {MI, MeanSquares, CC}: Metric used for registration. Default=" + param_default.metric + ".\n"
                                                   "gradStep [float]: Searching step used by registration algorithm. The higher the more deformation allowed. Default=" + param_default.gradStep + ".\n"
-                                                    "sample [0-1]: Sampling rate used for registration metric. Default=" + param_default.sampling + ".\n",
+                                                    "sample [0-1]: Sampling rate used for registration metric. Default=" + param_default.sampling + ".\n"
+                                                    "cpu_number [int]: Number of volumes registered in parallel (with iterative averaging, the first 10 volumes are registered one after the other). Default=" + str(param_default.cpu_number) + ".\n",
                       mandatory=False)
     parser.add_option(name='-thr',
                       type_value='float',
@@ -342,80 +345,44 @@ def dmri_moco(param):
 
     # Prepare NIFTI (mean/groups...)
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
+    # b=0 and DW images are selected and averaged in memory. Only the images read by the registration are written.
+    data = im_data.data
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
 
     # Merge b=0 images
     sct.printv('\nMerge b=0...', param.verbose)
-    im_b0_list = []
-    for it in range(nb_b0):
-        im_b0_list.append(im_data_split_list[index_b0[it]])
-    im_b0_out = concat_data(im_b0_list, 3)
-    im_b0_out.setFileName(file_b0 + ext_data)
-    im_b0_out.save()
+    data_b0 = data[..., index_b0]
+    save_data(data_b0, im_data, file_b0 + ext_data)
     sct.printv(('  File created: ' + file_b0), param.verbose)
 
     # Average b=0 images
     sct.printv('\nAverage b=0...', param.verbose)
     file_b0_mean = file_b0 + '_mean'
-    sct.run('sct_maths -i ' + file_b0 + ext_data + ' -o ' + file_b0_mean + ext_data + ' -mean t', param.verbose)
-
-    # Number of DWI groups
-    nb_groups = int(math.floor(nb_dwi / param.group_size))
-
-    # Generate groups indexes
-    group_indexes = []
-    for iGroup in range(nb_groups):
-        group_indexes.append(index_dwi[(iGroup * param.group_size):((iGroup + 1) * param.group_size)])
-
-    # add the remaining images to the last DWI group
-    nb_remaining = nb_dwi%param.group_size  # number of remaining images
-    if nb_remaining > 0:
-        nb_groups += 1
-        group_indexes.append(index_dwi[len(index_dwi) - nb_remaining:len(index_dwi)])
-
-    # DWI groups
-    file_dwi_mean = []
-    for iGroup in range(nb_groups):
-        sct.printv('\nDWI group: ' + str((iGroup + 1)) + '/' + str(nb_groups), param.verbose)
-
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
+    save_data(np.mean(data_b0, 3), im_data, file_b0_mean + ext_data)
 
-        # Merge DW Images
-        sct.printv('Merge DW images...', param.verbose)
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
+    # Generate groups indexes: consecutive DW images, the remaining images are in an additional (smaller) group
+    group_start = range(0, nb_dwi, param.group_size)
+    nb_groups = len(group_start)
+    group_indexes = [index_dwi[start:start + param.group_size] for start in group_start]
+    group_size = np.array([len(index_dwi_i) for index_dwi_i in group_indexes])
 
-        im_dwi_list = []
-        for it in range(nb_dwi_i):
-            im_dwi_list.append(im_data_split_list[index_dwi_i[it]])
-        im_dwi_out = concat_data(im_dwi_list, 3)
-        im_dwi_out.setFileName(file_dwi_merge_i + ext_data)
-        im_dwi_out.save()
+    # Average DW images of all groups at once
+    sct.printv('\nAverage DW images of ' + str(nb_groups) + ' groups...', param.verbose)
+    data_dwi_mean = np.add.reduceat(data[..., index_dwi], group_start, axis=3, dtype=np.float64) / group_size
 
-        # Average DW Images
-        sct.printv('Average DW images...', param.verbose)
-        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
-        sct.run('sct_maths -i ' + file_dwi_merge_i + ext_data + ' -o ' + file_dwi_mean[iGroup] + ext_data + ' -mean t', param.verbose)
+    # the first group mean is the target of the registration of DW images
+    file_dwi_mean = [file_dwi + '_mean_' + str(iGroup) for iGroup in range(nb_groups)]
+    save_data(data_dwi_mean[..., 0], im_data, file_dwi_mean[0] + ext_data)
 
     # Merge DWI groups means
     sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    im_dw_list = []
-    for iGroup in range(nb_groups):
-        im_dw_list.append(file_dwi_mean[iGroup] + ext_data)
-    im_dw_out = concat_data(im_dw_list, 3)
-    im_dw_out.setFileName(file_dwi_group + ext_data)
-    im_dw_out.save()
+    save_data(data_dwi_mean, im_data, file_dwi_group + ext_data)
 
     # Average DW Images
     # TODO: USEFULL ???
     sct.printv('\nAveraging all DW images...', param.verbose)
-    sct.run('sct_maths -i ' + file_dwi_group + ext_data + ' -o ' + file_dwi_group + '_mean' + ext_data + ' -mean t', param.verbose)
+    save_data(np.mean(data_dwi_mean, 3), im_data, file_dwi_group + '_mean' + ext_data)
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -444,10 +411,12 @@ def dmri_moco(param):
     if index_dwi[0] != 0:
         # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
         # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0] - 1]).zfill(4)
+        index_target = index_b0[index_dwi[0] - 1]
     else:
         # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+        index_target = index_b0[0]
+    param_moco.file_target = file_data + '_T' + str(index_target).zfill(4)
+    save_data(data[..., index_target], im_data, param_moco.file_target + ext_data)
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
@@ -464,20 +433,22 @@ def dmri_moco(param):
     param_moco.mat_moco = 'mat_dwigroups'
     moco.moco(param_moco)
 
-    # create final mat folder
-    sct.create_folder(mat_final)
-
-    # Copy b=0 registration matrices
-    sct.printv('\nCopy b=0 registration matrices...', param.verbose)
-
+    # Registration of each volume: the one of the b=0 image, or the one of the group of the DW image. The registrations
+    # are referred to by their path, they are only copied into the final mat folder if they are modified afterwards.
+    file_mat_final = [None] * nt
     for it in range(nb_b0):
-        sct.run('cp ' + 'mat_b0groups/' + 'mat.T' + str(it) + ext_mat + ' ' + mat_final + 'mat.T' + str(index_b0[it]) + ext_mat, param.verbose)
-
-    # Copy DWI registration matrices
-    sct.printv('\nCopy DWI registration matrices...', param.verbose)
+        file_mat_final[index_b0[it]] = 'mat_b0groups/' + 'mat.T' + str(it)
     for iGroup in range(nb_groups):
-        for dwi in range(len(group_indexes[iGroup])):
-            sct.run('cp ' + 'mat_dwigroups/' + 'mat.T' + str(iGroup) + ext_mat + ' ' + mat_final + 'mat.T' + str(group_indexes[iGroup][dwi]) + ext_mat, param.verbose)
+        for index in group_indexes[iGroup]:
+            file_mat_final[index] = 'mat_dwigroups/' + 'mat.T' + str(iGroup)
+
+    if param.spline_fitting or param.run_eddy:
+        # create final mat folder
+        sct.create_folder(mat_final)
+        sct.printv('\nCopy registration matrices...', param.verbose)
+        for it in range(nt):
+            shutil.copyfile(file_mat_final[it] + ext_mat, mat_final + 'mat.T' + str(it) + ext_mat)
+        file_mat_final = mat_final
 
     # Spline Regularization along T
     if param.spline_fitting:
@@ -496,7 +467,7 @@ def dmri_moco(param):
     param_moco.file_data = file_data
     param_moco.file_target = file_dwi + '_mean_' + str(0)  # reference for reslicing into proper coordinate system
     param_moco.path_out = ''
-    param_moco.mat_moco = mat_final
+    param_moco.mat_moco = file_mat_final
     param_moco.todo = 'apply'
     moco.moco(param_moco)
 
@@ -514,6 +485,15 @@ def dmri_moco(param):
     sct.run(cmd, param.verbose)
 
 
+def save_data(data, im_ref, fname):
+    """
+    Save data in a nifti file, with the header of a reference image.
+    """
+    im_out = Image(data, hdr=deepcopy(im_ref.hdr), orientation=im_ref.orientation, absolutepath=fname)
+    im_out.save()
+    return im_out
+
+
 #=======================================================================================================================
 # Start program
 #=======================================================================================================================
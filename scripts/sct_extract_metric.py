@@ -23,6 +23,7 @@ from glob import glob
 import time
 import nibabel as nib
 import numpy as np
+import scipy.linalg
 import sct_utils as sct
 from sct_image import get_orientation_3d, set_orientation
 from msct_image import Image
@@ -49,6 +50,7 @@ class Param:
         # self.fname_vertebral_labeling = 'MNI-Poly-AMU_level.nii.gz'
         self.adv_param = ['10',  # STD of the metric value across labels, in percentage of the mean (mean is estimated using cluster-based ML)
                           '10']  # STD of the assumed gaussian-distributed noise
+        self.solver = 'normal'  # least-squares solver for the 'ml' and 'map' methods
 
 
 def get_parser():
@@ -59,10 +61,10 @@ def get_parser():
     parser.usage.set_description("""This program extracts metrics (e.g., DTI or MTR) within labels. Labels could be a single file or a folder generated with 'sct_warp_template' and containing multiple label files and a label description file (info_label.txt). The labels should be in the same space coordinates as the input image.""")
     # Mandatory arguments
     parser.add_option(name='-i',
-                      type_value='image_nifti',
-                      description='File to extract metrics from.',
+                      type_value=[[','], 'image_nifti'],
+                      description='File to extract metrics from. Several metrics can be extracted in one pass (atlas loaded and estimation matrices computed only once) by giving several files separated with "," and/or 4D files (one metric per volume). Results are then written in one combined table.',
                       mandatory=True,
-                      example='FA.nii.gz')
+                      example='FA.nii.gz,MD.nii.gz')
     # Optional arguments
     parser.add_option(name='-f',
                       type_value='folder',
@@ -160,6 +162,15 @@ max: for each z-slice of the input data, extract the max value for each slice of
                       description='Nifti mask to weight each voxel during ML or MAP estimation.',
                       example='PAM50_wm.nii.gz',
                       mandatory=False)
+    parser.add_option(name='-solver',
+                      type_value='multiple_choice',
+                      description="""Least-squares solver used by the ML and MAP estimations.
+normal: pseudo-inverse of the normal equations
+lstsq: least-squares on the design matrix (slower, more robust to ill-conditioned atlases)
+cholesky: Cholesky factorization of the normal equations (fastest)""",
+                      example=['normal', 'lstsq', 'cholesky'],
+                      mandatory=False,
+                      default_value=param_default.solver)
 
     # read the .txt files referencing the labels
     file_label = param_default.path_label + param_default.file_info_label
@@ -193,7 +204,7 @@ To compute average MTR in a region defined by a single label file (could be bina
     return parser
 
 
-def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map, fname_mask_weight):
+def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map, fname_mask_weight, solver='normal'):
     """Main."""
 
     # Initialization
@@ -206,6 +217,9 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     fixed_label = []
     label_to_fix_fract_vol = None
     im_weight = None
+    # several metric files can be given, to extract all metrics at once
+    if not isinstance(fname_data, list):
+        fname_data = [fname_data]
 
     # check if path_label is a file instead of a folder
     if os.path.isfile(path_label):
@@ -249,7 +263,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
 
     # sct.printv(parameters)
     sct.printv('\nChecked parameters:')
-    sct.printv('  data ...................... ' + fname_data)
+    sct.printv('  data ...................... ' + ', '.join(fname_data))
     sct.printv('  path to label ............. ' + path_label)
     sct.printv('  label ..................... ' + labels_user)
     sct.printv('  method .................... ' + method)
@@ -279,14 +293,16 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # Load data
     # Check if the orientation of the data is RPI
     sct.printv('\nLoad metric image...', verbose)
-    input_im = Image(fname_data)
+    list_input_im = [Image(fname) for fname in fname_data]
+    input_im = list_input_im[0]
     orientation_data = input_im.orientation
 
     if orientation_data != 'RPI':
         # If orientation is not RPI, change to RPI and load data
         # metric
         sct.printv('\nChange metric image orientation into RPI and load it...', verbose)
-        input_im.change_orientation(orientation='RPI')
+        for im in list_input_im:
+            im.change_orientation(orientation='RPI')
         # labels
         sct.printv('\nChange labels orientation into RPI and load them...', verbose)
         labels = np.empty([nb_labels], dtype=object)
@@ -324,7 +340,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
             data_vertebral_labeling = Image(fname_vertebral_labeling).data
         if fname_mask_weight:
             im_weight = Image(fname_mask_weight)
-    data = input_im.data
+    data, metric_names = get_metric_data(list_input_im, fname_data)
     sct.printv('  OK!', verbose)
 
     # Change metric data type into floats for future manipulations (normalization)
@@ -335,7 +351,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     data[np.isposinf(data)] = np.nanmax(data)
 
     # Get dimensions of data and labels
-    nx, ny, nz = data.shape
+    nx, ny, nz = data.shape[-3:]
     nx_atlas, ny_atlas, nz_atlas = labels[0].shape
 
     # Check dimensions consistency between atlas and data
@@ -369,13 +385,14 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
 
     # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input
     # individual labels
-    indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight)
+    indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, solver=solver)
     # combined labels
-    combined_labels_value = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    combined_labels_std = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
+    combined_labels_value = np.empty(len(combined_labels_groups_all_IDs), dtype=object)
+    combined_labels_std = np.empty(len(combined_labels_groups_all_IDs), dtype=object)
     combined_labels_fract_vol = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
     for i_combined_labels in range(0, len(combined_labels_groups_all_IDs)):
-        combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, combined_labels_id_group=combined_labels_groups_all_IDs[i_combined_labels])
+        value, std, fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, combined_labels_id_group=combined_labels_groups_all_IDs[i_combined_labels], solver=solver)
+        combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = value[0], std[0], fract_vol[0]
 
     # display results
     sct.printv('\nResults:\nID, label name [total fractional volume of the label in number of voxels]:    metric value +/- metric STDEV within label', 1)
@@ -410,14 +427,37 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     #         sct.printv(str(combined_labels_ids[index]) + ', ' + str(combined_labels_names[index]) + ':    ' + str(combined_labels_value[index]) + ' +/- ' + str(combined_labels_std[index]), 1, 'info')
 
     # save results in the selected output file type
-    save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
+    save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, metric_names, method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
 
     # output a metric value map
     if fname_output_metric_map:
         data_metric_map = generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_labels_value, slices_list, label_to_fix, label_to_fix_fract_vol)
 
 
-def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', adv_param='', normalizing_label=[], normalization_method='', im_weight='', combined_labels_id_group='', verbose=0):
+def get_metric_data(list_input_im, fname_data):
+    """Stack the metric maps to extract, so that they are all estimated at once.
+    :list_input_im: list of Image (3D or 4D)
+    :fname_data: list of file names of the images
+    :return: data: (nx,ny,nz) array if a single 3D metric is given, (nb_metrics,nx,ny,nz) array otherwise
+             metric_names: list of nb_metrics names (file name, and volume index for 4D files)
+    """
+    list_data, metric_names = [], []
+    for im, fname in zip(list_input_im, fname_data):
+        if im.data.ndim == 4:
+            for t in range(im.data.shape[3]):
+                list_data.append(im.data[:, :, :, t])
+                metric_names.append(fname + ' [volume ' + str(t) + ']')
+        else:
+            list_data.append(im.data)
+            metric_names.append(fname)
+    if len(set(data.shape for data in list_data)) != 1:
+        sct.printv('\nERROR: Metric images DO NOT HAVE SAME DIMENSIONS.', 1, 'error')
+    if len(list_data) == 1:
+        return list_data[0], metric_names
+    return np.array(list_data), metric_names
+
+
+def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', adv_param='', normalizing_label=[], normalization_method='', im_weight='', combined_labels_id_group='', verbose=0, solver='normal'):
     """Extract metric in the labels specified by the file info_label.txt in the atlas folder."""
 
     # Initialization to default values
@@ -457,27 +497,29 @@ def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', a
                 # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
                 normalizing_label_slice[0] = normalizing_label[0][..., z]
                 metric_normalizing_label = estimate_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
-                # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z] / metric_normalizing_label[0][0]  # divide all the slice z by this value
+                # estimate the metric mean in the normalizing label for the slice z (one value per metric)
+                value_normalizing_label = np.array(metric_normalizing_label[0][0], dtype=float)
+                value_normalizing_label[value_normalizing_label == 0] = 1  # do not normalize if the value is null
+                # divide all the slice z by this value
+                data[..., z] = data[..., z] / value_normalizing_label.reshape(value_normalizing_label.shape + (1, 1))
 
         elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
             metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data, normalizing_label, method, param_default.verbose)  # mean and std are lists
 
     # extract metrics within labels
     sct.printv('\nEstimate metric within labels...', verbose)
-    metric_in_labels, metric_std_in_labels = estimate_metric_within_tract(data, labels, method, verbose, clustered_labels, matching_cluster_labels, adv_param, im_weight)  # mean and std are lists
+    metric_in_labels, metric_std_in_labels = estimate_metric_within_tract(data, labels, method, verbose, clustered_labels, matching_cluster_labels, adv_param, im_weight, solver=solver)  # mean and std are lists
 
     if normalizing_label and normalization_method == 'whole':  # case: user wants to normalize after estimations in the whole labels
         metric_in_labels, metric_std_in_labels = np.divide(metric_in_labels, metric_norm_label), np.divide(metric_std_in_labels, metric_std_norm_label)
 
     if combined_labels_id_group:
-        metric_in_labels = np.asarray([metric_in_labels[0]])
-        metric_std_in_labels = np.asarray([metric_std_in_labels[0]])
+        metric_in_labels = metric_in_labels[:1]
+        metric_std_in_labels = metric_std_in_labels[:1]
 
     # compute fractional volume for each label
-    fract_vol_per_label = np.zeros(metric_in_labels.size, dtype=float)
-    for i_label in range(0, metric_in_labels.size):
+    fract_vol_per_label = np.zeros(len(metric_in_labels), dtype=float)
+    for i_label in range(0, len(metric_in_labels)):
         fract_vol_per_label[i_label] = np.sum(labels[i_label])
 
     return metric_in_labels, metric_std_in_labels, fract_vol_per_label
@@ -604,7 +646,7 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
         sct.printv('WARNING: the top vertebral level you selected is not available \n--> Selected the nearest superior level available: ' + str(int(vert_levels_list[1])), type='warning')
 
     # Extract metric data size X, Y, Z
-    [mx, my, mz] = metric_data.shape
+    [mx, my, mz] = metric_data.shape[-3:]
     # Extract vertebral labeling data size X, Y, Z
     [vx, vy, vz] = data_vertebral_labeling.shape
 
@@ -683,10 +725,16 @@ def remove_slices(data_to_crop, slices_of_interest):
 
 
 def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert=None, warning_vert_levels=None, fixed_label=None):
-    """Save results in the output type selected by user."""
+    """Save results in the output type selected by user.
+    fname_data can be a list of metric names, in which case the values and stds of each label are arrays (one value
+    per metric) and the results of all metrics are saved in one combined table."""
 
     sct.printv('\nSaving results in: ' + fname_output + ' ...')
 
+    if not isinstance(fname_data, list):
+        fname_data = [fname_data]
+    metric_files = [os.path.abspath(fname) for fname in fname_data]
+
     # define vertebral levels and slices fields
     if actual_vert:
         vertebral_levels_field = str(int(actual_vert[0])) + ' to ' + str(int(actual_vert[1]))
@@ -717,7 +765,7 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         # Write date and time
         fid_metric.write('# Date - Time: ' + time.strftime('%Y/%m/%d - %H:%M:%S'))
         # Write metric data file path
-        fid_metric.write('\n' + '# Metric file: ' + os.path.abspath(fname_data))
+        fid_metric.write('\n' + '# Metric file: ' + ', '.join(metric_files))
         # If it's the case, write the label used to normalize the metric estimation:
         if fname_normalizing_label:
             fid_metric.write('\n' + '# Label used to normalize the metric estimation slice-by-slice: ' + fname_normalizing_label)
@@ -730,8 +778,12 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         # Write selected slices
         fid_metric.write('\n' + '# Slices (z): ' + slices_of_interest_field)
 
-        # label headers
-        fid_metric.write('%s' % ('\n' + '# ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
+        # label headers (one value and stdev column per metric)
+        if len(metric_files) == 1:
+            metric_headers = ', metric value, metric stdev within label'
+        else:
+            metric_headers = ''.join([', metric value (' + os.path.basename(fname) + '), metric stdev within label (' + os.path.basename(fname) + ')' for fname in metric_files])
+        fid_metric.write('%s' % ('\n' + '# ID, label name, total fractional volume of the label (in number of voxels)' + metric_headers + '\n\n'))
 
         # WRITE RESULTS
         labels_id_user.sort()
@@ -749,10 +801,16 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
             # display result for this label
             if section == '\n# White matter atlas\n':
                 index = indiv_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[index], indiv_labels_value[index], indiv_labels_std[index]))
+                fid_metric.write('%i, %s, %f' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[index]))
+                for value, std in zip(np.atleast_1d(indiv_labels_value[index]), np.atleast_1d(indiv_labels_std[index])):
+                    fid_metric.write(', %f, %f' % (value, std))
+                fid_metric.write('\n')
             elif section == '\n# Combined labels\n':
                 index = combined_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[index], combined_labels_value[index], combined_labels_std[index]))
+                fid_metric.write('%i, %s, %f' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[index]))
+                for value, std in zip(np.atleast_1d(combined_labels_value[index]), np.atleast_1d(combined_labels_std[index])):
+                    fid_metric.write(', %f, %f' % (value, std))
+                fid_metric.write('\n')
 
         if fixed_label:
             fid_metric.write('\n*' + fixed_label[0] + ', ' + fixed_label[1] + ': ' + fixed_label[2] + ' (value fixed by user)')
@@ -802,48 +860,50 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
 
             row_index = 1
 
-        # iterate on user's labels
-        for i_label_user in labels_id_user:
-            sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
-            sh.write(row_index, 1, os.path.abspath(fname_data))
-            sh.write(row_index, 2, method)
-            sh.write(row_index, 3, vertebral_levels_field)
-            sh.write(row_index, 4, slices_of_interest_field)
-            if fname_normalizing_label:
-                sh.write(row_index, 10, fname_normalizing_label)
-
-            # display result for this label
-            if i_label_user <= max(indiv_labels_ids):
-                index = indiv_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, indiv_labels_ids[index])
-                sh.write(row_index, 6, indiv_labels_names[index])
-                sh.write(row_index, 7, indiv_labels_fract_vol[index])
-                sh.write(row_index, 8, indiv_labels_value[index])
-                sh.write(row_index, 9, indiv_labels_std[index])
-            elif i_label_user > max(indiv_labels_ids):
-                index = combined_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, combined_labels_ids[index])
-                sh.write(row_index, 6, combined_labels_names[index])
-                sh.write(row_index, 7, combined_labels_fract_vol[index])
-                sh.write(row_index, 8, combined_labels_value[index])
-                sh.write(row_index, 9, combined_labels_std[index])
-
-            row_index += 1
-
-        if fixed_label:
-            sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
-            sh.write(row_index, 1, os.path.abspath(fname_data))
-            sh.write(row_index, 2, method)
-            sh.write(row_index, 3, vertebral_levels_field)
-            sh.write(row_index, 4, slices_of_interest_field)
-            if fname_normalizing_label:
-                sh.write(row_index, 10, fname_normalizing_label)
-
-            sh.write(row_index, 5, int(fixed_label[0]))
-            sh.write(row_index, 6, fixed_label[1])
-            sh.write(row_index, 7, 'nan')
-            sh.write(row_index, 8, '*' + fixed_label[2] + ' (value fixed by user)')
-            sh.write(row_index, 9, 'nan')
+        # iterate on metrics and user's labels (one row per metric and label)
+        for i_metric, metric_file in enumerate(metric_files):
+            for i_label_user in labels_id_user:
+                sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
+                sh.write(row_index, 1, metric_file)
+                sh.write(row_index, 2, method)
+                sh.write(row_index, 3, vertebral_levels_field)
+                sh.write(row_index, 4, slices_of_interest_field)
+                if fname_normalizing_label:
+                    sh.write(row_index, 10, fname_normalizing_label)
+
+                # display result for this label
+                if i_label_user <= max(indiv_labels_ids):
+                    index = indiv_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, indiv_labels_ids[index])
+                    sh.write(row_index, 6, indiv_labels_names[index])
+                    sh.write(row_index, 7, indiv_labels_fract_vol[index])
+                    sh.write(row_index, 8, np.atleast_1d(indiv_labels_value[index])[i_metric])
+                    sh.write(row_index, 9, np.atleast_1d(indiv_labels_std[index])[i_metric])
+                elif i_label_user > max(indiv_labels_ids):
+                    index = combined_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, combined_labels_ids[index])
+                    sh.write(row_index, 6, combined_labels_names[index])
+                    sh.write(row_index, 7, combined_labels_fract_vol[index])
+                    sh.write(row_index, 8, np.atleast_1d(combined_labels_value[index])[i_metric])
+                    sh.write(row_index, 9, np.atleast_1d(combined_labels_std[index])[i_metric])
+
+                row_index += 1
+
+            if fixed_label:
+                sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
+                sh.write(row_index, 1, metric_file)
+                sh.write(row_index, 2, method)
+                sh.write(row_index, 3, vertebral_levels_field)
+                sh.write(row_index, 4, slices_of_interest_field)
+                if fname_normalizing_label:
+                    sh.write(row_index, 10, fname_normalizing_label)
+
+                sh.write(row_index, 5, int(fixed_label[0]))
+                sh.write(row_index, 6, fixed_label[1])
+                sh.write(row_index, 7, 'nan')
+                sh.write(row_index, 8, '*' + fixed_label[2] + ' (value fixed by user)')
+                sh.write(row_index, 9, 'nan')
+                row_index += 1
 
         book.save(fname_output)
 
@@ -854,7 +914,11 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         metric_extraction_results = {}
 
         metric_extraction_results['Date - Time'] = time.strftime('%Y/%m/%d - %H:%M:%S')
-        metric_extraction_results['Metric file'] = os.path.abspath(fname_data)
+        if len(metric_files) == 1:
+            metric_extraction_results['Metric file'] = metric_files[0]
+        else:
+            # values and stdevs below are [nb_labels x nb_metrics] arrays
+            metric_extraction_results['Metric file'] = metric_files
         metric_extraction_results['Extraction method'] = method
         metric_extraction_results['Vertebral levels'] = vertebral_levels_field
         metric_extraction_results['Slices (z)'] = slices_of_interest_field
@@ -955,10 +1019,48 @@ def check_labels(indiv_labels_ids, selected_labels):
     return list_ids_of_labels_of_interest
 
 
-def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels=[], matching_cluster_labels=[], adv_param=[], im_weight=None):
+def solve_least_squares(x, y, weights=None, regularization=0, solver='normal'):
+    """Estimate beta minimizing ||w.(y - x.beta)||^2 + regularization.||beta||^2, where the weights w are applied to each
+    voxel (i.e., each row of x and y). The (nb_vox x nb_vox) diagonal weighting matrix is never built.
+    :x: [nb_vox x nb_labels] numpy array
+    :y: [nb_vox] numpy array, or [nb_vox x nb_metrics] to estimate several metrics with the same factorization
+    :weights: [nb_vox] numpy array. None: no weighting
+    :regularization: value added to the diagonal of the normal equations (used by the MAP estimation)
+    :solver: 'normal': pseudo-inverse of the normal equations, beta = (Xt.X + r.I)-1 . Xt.y
+             'lstsq': least-squares on x (and on sqrt(r).I for the regularization)
+             'cholesky': Cholesky factorization of the normal equations. Falls back to 'normal' if the system is singular
+    :return: beta [nb_labels] (or [nb_labels x nb_metrics])
+    """
+    if weights is not None:
+        x = x * weights[:, np.newaxis]
+        y = (y.T * weights).T
+    nb_labels = x.shape[1]
+
+    if solver == 'lstsq':
+        if regularization:
+            x = np.vstack((x, np.sqrt(regularization) * np.eye(nb_labels)))
+            y = np.concatenate((y, np.zeros((nb_labels,) + y.shape[1:])))
+        return np.linalg.lstsq(x, y, rcond=-1)[0]
+
+    xtx = np.dot(x.T, x) + regularization * np.eye(nb_labels)
+    xty = np.dot(x.T, y)
+    if solver == 'cholesky':
+        try:
+            return scipy.linalg.cho_solve(scipy.linalg.cho_factor(xtx), xty)
+        except np.linalg.LinAlgError:
+            # e.g., a label without any voxel: use the pseudo-inverse
+            pass
+    elif solver != 'normal':
+        raise ValueError('Unknown least-squares solver: ' + str(solver))
+    return np.dot(np.linalg.pinv(xtx), xty)
+
+
+def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels=[], matching_cluster_labels=[], adv_param=[], im_weight=None, solver='normal'):
     """Extract metric within labels.
-    :data: (nx,ny,nz) numpy array
+    :data: (nx,ny,nz) numpy array, or (nb_metrics,nx,ny,nz) to extract several metrics at once. In that case, the
+    returned mean and std of each label are arrays of nb_metrics values.
     :labels: nlabel tuple of (nx,ny,nz) array
+    :solver: least-squares solver for the 'ml' and 'map' methods (see solve_least_squares)
     """
 
     nb_labels = len(labels)  # number of labels
@@ -979,19 +1081,18 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     ind_positive_labels = labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
     # ind_positive_data = data > -9999999999  # data > 0
     ind_positive = ind_positive_labels  # & ind_positive_data
-    data1d = data[ind_positive]
-    nb_vox = len(data1d)
+    data1d = data[..., ind_positive]  # [nb_vox] or [nb_metrics x nb_vox]
+    nb_vox = data1d.shape[-1]
     labels2d = np.empty([nb_labels, nb_vox], dtype=float)
     for i in range(0, nb_labels):
         labels2d[i] = labels[i][ind_positive]
 
-    if method == 'map' or 'ml':
-        # if specified (flag -mask-weighted), define a matrix to weight voxels. If not, this matrix is set to identity.
+    if method == 'map' or method == 'ml':
+        # if specified (flag -mask-weighted), define weights applied to each voxel. If not, voxels are not weighted.
         if im_weight:
             data_weight_1d = im_weight.data[ind_positive]
         else:
-            data_weight_1d = np.ones(nb_vox)
-        W = np.diag(data_weight_1d)  # weight matrix
+            data_weight_1d = None
 
     # Display number of non-zero values
     sct.printv('  Number of non-null voxels: ' + str(nb_vox), verbose=verbose)
@@ -999,6 +1100,11 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     # initialization
     metric_mean = np.empty([nb_labels], dtype=object)
     metric_std = np.empty([nb_labels], dtype=object)
+    # value assigned when no estimation is possible: 0 for each metric
+    if data1d.ndim == 1:
+        metric_null = 0
+    else:
+        metric_null = np.zeros(data1d.shape[0])
 
     # Estimation with maximum a posteriori (map)
     if method == 'map':
@@ -1015,26 +1121,21 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         ind_positive_clustered_labels = clustered_labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
 
         # define the problem to apply the maximum likelihood to clustered labels
-        y_apriori = data[ind_positive_clustered_labels]  # [nb_vox x 1]
+        y_apriori = data[..., ind_positive_clustered_labels].T  # [nb_vox x 1] (or [nb_vox x nb_metrics])
 
         # create matrix X to use ML and estimate beta_0
         x_apriori = np.zeros([len(y_apriori), nb_clusters])
         for i_cluster in range(nb_clusters):
             x_apriori[:, i_cluster] = clustered_labels[i_cluster][ind_positive_clustered_labels]
 
-        # remove unused voxels from the weighting matrix W
+        # keep the weights of the voxels used
         if im_weight:
             data_weight_1d_apriori = im_weight.data[ind_positive_clustered_labels]
         else:
-            data_weight_1d_apriori = np.ones(np.sum(ind_positive_clustered_labels))
-        W_apriori = np.diag(data_weight_1d_apriori)  # weight matrix
-
-        # apply the weighting matrix
-        y_apriori = np.dot(W_apriori, y_apriori)
-        x_apriori = np.dot(W_apriori, x_apriori)
+            data_weight_1d_apriori = None
 
         # estimate values using ML for each cluster
-        beta = np.dot(np.linalg.pinv(np.dot(x_apriori.T, x_apriori)), np.dot(x_apriori.T, y_apriori))  # beta = (Xt . X)-1 . Xt . y
+        beta = solve_least_squares(x_apriori, y_apriori, weights=data_weight_1d_apriori, solver=solver)  # beta = (Xt . X)-1 . Xt . y
         # display results
         sct.printv('  Estimated beta0 per cluster: ' + str(beta), verbose=verbose)
 
@@ -1046,21 +1147,19 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
 
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
+        y = data1d.T  # [nb_vox x 1] (or [nb_vox x nb_metrics])
+        x = labels2d.T  # [nb_vox x nb_labels]
         # construct beta0
-        beta0 = np.zeros(nb_labels)
+        beta0 = np.zeros((nb_labels,) + beta.shape[1:])
         for i_cluster in range(nb_clusters):
             beta0[np.where(np.asarray(matching_cluster_labels) == i_cluster)[0]] = beta[i_cluster]
-        # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
-        Rlabel = np.diag(np.ones(nb_labels))
-        A = np.linalg.pinv(np.dot(x.T, x) + np.linalg.pinv(Rlabel) * var_noise / var_label)
-        B = x.T
-        C = y - np.dot(x, beta0)
-        beta = beta0 + np.dot(A, np.dot(B, C))
+        # covariance matrix Rlabel (variance between tracts). For simplicity, we set it to be the identity, so that:
+        # beta = beta0 + (Xt . X + I . var_noise / var_label)-1 . Xt . (y - X . beta0)
+        beta = beta0 + solve_least_squares(x, y - np.dot(x, beta0), weights=data_weight_1d,
+                                           regularization=float(var_noise) / var_label, solver=solver)
         for i_label in range(0, nb_labels):
             metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+            metric_std[i_label] = metric_null  # need to assign a value for writing output file
 
     # clear memory
     del data, labels
@@ -1068,15 +1167,15 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     # Estimation with maximum likelihood
     if method == 'ml':
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
-        beta = np.dot(np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y))  # beta = (Xt . X)-1 . Xt . y
+        y = data1d.T  # [nb_vox x 1] (or [nb_vox x nb_metrics])
+        x = labels2d.T  # [nb_vox x nb_labels]
+        beta = solve_least_squares(x, y, weights=data_weight_1d, solver=solver)  # beta = (Xt . X)-1 . Xt . y
         #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
         #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
         # sct.printv(beta, residuals, rank, singular_value)
         for i_label in range(0, nb_labels):
             metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+            metric_std[i_label] = metric_null  # need to assign a value for writing output file
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath' or method == 'max':
@@ -1084,14 +1183,14 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
             # check if all labels are equal to zero
             if sum(labels2d[i_label, :]) == 0:
                 sct.printv('WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.')
-                metric_mean[i_label] = 0
-                metric_std[i_label] = 0
+                metric_mean[i_label] = metric_null
+                metric_std[i_label] = metric_null
             else:
                 # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
+                metric_mean[i_label] = np.dot(data1d, labels2d[i_label, :]) / sum(labels2d[i_label, :])
                 # estimate the biased weighted standard deviation
                 metric_std[i_label] = np.sqrt(
-                    sum(labels2d[i_label, :] * (data1d - metric_mean[i_label]) ** 2) / sum(labels2d[i_label, :]))
+                    np.dot((data1d - np.expand_dims(metric_mean[i_label], -1)) ** 2, labels2d[i_label, :]) / sum(labels2d[i_label, :]))
 
     return metric_mean, metric_std
 
@@ -1230,16 +1329,19 @@ def generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_l
 
     sct.printv('\nGenerate metric value map based on each label fractional volumes: ' + fname_output_metric_map + '...')
 
-    # initialize metric value map with zeros
+    # initialize metric value map with zeros (4D if several metrics were extracted, one volume per metric)
     metric_map = input_im
-    metric_map.data = np.zeros(input_im.data.shape)
+    metric_map.data = np.zeros(input_im.data.shape[:3] + np.shape(indiv_labels_value[0]))
 
     # assign to each label the corresponding estimated metric value
     for i_label in range(len(labels)):
-        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + labels[i_label] * indiv_labels_value[i_label]
+        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + np.multiply.outer(labels[i_label], indiv_labels_value[i_label])
 
     if label_to_fix:
-        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + label_to_fix_fract_vol * float(label_to_fix[1])
+        map_fixed_label = label_to_fix_fract_vol * float(label_to_fix[1])
+        if metric_map.data.ndim == 4:
+            map_fixed_label = map_fixed_label[..., np.newaxis]
+        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + map_fixed_label
 
     # save metric value map
     metric_map.setFileName(fname_output_metric_map)
@@ -1300,6 +1402,7 @@ if __name__ == "__main__":
         fname_mask_weight = arguments['-mask-weighted']
     else:
         fname_mask_weight = ''
+    solver = arguments['-solver']
 
     # call main function
-    main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map, fname_mask_weight)
+    main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map, fname_mask_weight, solver)
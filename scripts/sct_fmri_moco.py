@@ -59,6 +59,7 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.cpu_number = 1  # number of volumes registered in parallel, once the target does not change anymore
         self.num_target = '0'
 
     # update constructor with user's parameters
@@ -107,6 +108,7 @@ def get_parser():
                                   "metric {MI, MeanSquares, CC}: Metric used for registration. Default=" + param_default.metric + ".\n"
                                   "gradStep [float]: Searching step used by registration algorithm. The higher the more deformation allowed. Default=" + param_default.gradStep + ".\n"
                                   "sample [0-1]: Sampling rate used for registration metric. Default=" + param_default.sampling + ".\n"
+                                  "cpu_number [int]: Number of volumes registered in parallel (with iterative averaging, the first 10 volumes are registered one after the other). Default=" + str(param_default.cpu_number) + ".\n"
                                   "numTarget [int]: Target volume or group (starting with 0). Default=" + param_default.num_target + ".\n",
                       mandatory=False)
     parser.add_option(name='-ofolder',
@@ -237,7 +239,7 @@ def fmri_moco(param):
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(file_data + '.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(file_data + '.nii', lazy=True).dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
 
     # Split into T dimension
@@ -10,7 +10,6 @@
 # About the license: see the file LICENSE.TXT
 #########################################################################################
 
-import os
 import sys
 
 from msct_image import Image, get_dimension
@@ -168,7 +167,7 @@ def main(args=None):
         im_out = None
 
     elif "-getorient" in arguments:
-        im_in = Image(fname_in[0])
+        im_in = Image(fname_in[0], lazy=True)
         orient = orientation(im_in, get=True, verbose=verbose)
         im_out = None
 
@@ -346,26 +345,30 @@ def copy_header(im_src, im_dest):
 def split_data(im_in, dim):
     """
     Split data
+    The output images are views of the input image: their data are views of the input data (no copy), and they share
+    a copy of the input header. Modifying the data of an output image in place modifies the input image.
     :param im_in: input image.
     :param dim: dimension: 0, 1, 2, 3.
     :return: list of split images
     """
-    from numpy import array_split
+    from copy import deepcopy
     dim_list = ['x', 'y', 'z', 't']
-    # Parse file name
-    # Open first file.
     data = im_in.data
     if dim + 1 > len(shape(data)):  # in case input volume is 3d and dim=t
         data = data[..., newaxis]
-    # Split data into list
-    data_split = array_split(data, data.shape[dim], dim)
-    # Write each file
+    # header shared by all the output images (they all have the same shape)
+    hdr_split = deepcopy(im_in.hdr)
+    dim_split = None
+    if im_in.dim is not None:
+        dim_split = list(im_in.dim)
+        dim_split[dim] = 1
+    # Split data into list of views
     im_out_list = []
-    for i, dat in enumerate(data_split):
-        im_out = im_in.copy()
-        im_out.data = dat
-        im_out.setFileName(im_out.file_name + '_' + dim_list[dim].upper() + str(i).zfill(4) + im_out.ext)
-        im_out_list.append(im_out)
+    for i in range(data.shape[dim]):
+        data_split = data[(slice(None),) * dim + (slice(i, i + 1),)]
+        fname_out = im_in.file_name + '_' + dim_list[dim].upper() + str(i).zfill(4) + im_in.ext
+        im_out_list.append(Image(data_split, hdr=hdr_split, orientation=im_in.orientation, absolutepath=fname_out,
+                                 dim=dim_split))
 
     return im_out_list
 
@@ -373,54 +376,65 @@ def split_data(im_in, dim):
 def concat_data(fname_in_list, dim, pixdim=None):
     """
     Concatenate data
-    :param im_in_list: list of images.
+    The output array is allocated once, and each input is copied into it, so that only one input file is open at a
+    time.
+    :param fname_in_list: list of file names, images or numpy arrays.
     :param dim: dimension: 0, 1, 2, 3.
     :param pixdim: pixel resolution to join to image header
     :return im_out: concatenated image
     """
     # WARNING: calling concat_data in python instead of in command line causes a non understood issue (results are different with both options)
-    from numpy import concatenate, expand_dims
-
-    dat_list = []
-    data_concat_list = []
-
-    # check if shape of first image is smaller than asked dim to concatenate along
-    # data0 = Image(fname_in_list[0]).data
-    # if len(data0.shape) <= dim:
-    #     expand_dim = True
-    # else:
-    #     expand_dim = False
-
-    for i, fname in enumerate(fname_in_list):
-        # if there is more than 100 images to concatenate, then it does it iteratively to avoid memory issue.
-        if i != 0 and i % 100 == 0:
-            data_concat_list.append(concatenate(dat_list, axis=dim))
-            im = Image(fname)
-            dat = im.data
-            # if image shape is smaller than asked dim, then expand dim
-            if len(dat.shape) <= dim:
-                dat = expand_dims(dat, dim)
-            dat_list = [dat]
-            del im
-            del dat
+    from copy import deepcopy
+    from numpy import asanyarray, empty, ndarray, result_type
+    from nibabel import load
+
+    def expand_shape(shape_in):
+        # if image shape is smaller than asked dim, then expand dim
+        return tuple(shape_in) + (1,) * (dim + 1 - len(shape_in))
+
+    # get shapes and types of the inputs without loading the data of files
+    shape_list, dtype_list = [], []
+    for item in fname_in_list:
+        if isinstance(item, Image):
+            item = item.data
+        if isinstance(item, ndarray):
+            shape_list.append(expand_shape(item.shape))
+            dtype_list.append(item.dtype)
         else:
-            im = Image(fname)
+            im_nib = load(item)
+            shape_list.append(expand_shape(im_nib.shape))
+            # read one voxel, to get the type of the data after intensity scaling
+            dtype_list.append(asanyarray(im_nib.dataobj[(slice(0, 1),) * len(im_nib.shape)]).dtype)
+    shape_out = list(shape_list[0])
+    shape_out[dim] = sum(shape_item[dim] for shape_item in shape_list)
+    data_concat = empty(shape_out, dtype=result_type(*dtype_list))
+
+    # copy each input in the output array
+    im_ref = None
+    index = 0
+    for item, shape_item in zip(fname_in_list, shape_list):
+        if isinstance(item, Image):
+            im, dat = item, item.data
+        elif isinstance(item, ndarray):
+            im, dat = None, item
+        else:
+            im = Image(item)
             dat = im.data
-            # if image shape is smaller than asked dim, then expand dim
-            if len(dat.shape) <= dim:
-                dat = expand_dims(dat, dim)
-            dat_list.append(dat)
-            del im
-            del dat
-    if data_concat_list:
-        data_concat_list.append(concatenate(dat_list, axis=dim))
-        data_concat = concatenate(data_concat_list, axis=dim)
+        if im_ref is None and im is not None:
+            im_ref = im
+        data_concat[(slice(None),) * dim + (slice(index, index + shape_item[dim]),)] = dat.reshape(shape_item)
+        index += shape_item[dim]
+        del dat
+
+    # header of the output: the one of the first image
+    if im_ref is not None:
+        im_out = Image(data_concat, hdr=deepcopy(im_ref.hdr), orientation=im_ref.orientation,
+                       absolutepath=im_ref.file_name + '_concat' + im_ref.ext, dim=deepcopy(im_ref.dim))
     else:
-        data_concat = concatenate(dat_list, axis=dim)
-    # write file
-    im_out = Image(fname_in_list[0]).copy()
-    im_out.data = data_concat
-    im_out.setFileName(im_out.file_name + '_concat' + im_out.ext)
+        im_out = Image(data_concat)
+    if im_out.dim is not None and dim < 4:
+        im_out.dim = list(im_out.dim)
+        im_out.dim[dim] = shape_out[dim]
 
     if pixdim is not None:
         im_out.hdr['pixdim'] = pixdim
@@ -563,95 +577,46 @@ def orientation(im, ori=None, set=False, get=False, set_data=False, verbose=1, f
 
     printv(str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
 
-    # if data are 2d or 3d, get orientation from header using fslhd
-
-    if (nz == 1 or nt == 1) and len(im.data.shape) < 5:
-        if get:
-            try:
-                printv('Get orientation...', verbose)
-                im_out = None
-                ori = get_orientation(im)
-            except Exception, e:
-                printv('ERROR: an error occurred: ' + str(e), verbose, 'error')
-            return ori
-        elif set:
-            # set orientation
-            printv('Change orientation...', verbose)
-            im_out = set_orientation(im, ori)
-        elif set_data:
-            im_out = set_orientation(im, ori, True)
-        else:
-            im_out = None
-
-    else:
-        from os import chdir
-        # 4D data: split along T dimension
-        # or 5D data: split along 5th dimension
-        # Create a temporary directory and go in it
-        tmp_folder = tmp_create(verbose)
-        chdir(tmp_folder)
-        if len(im.data.shape) == 5 and im.data.shape[-1] not in [0, 1]:
-            # 5D data
-            printv('Split along 5th dimension...', verbose)
-            im_split_list = multicomponent_split(im)
-            dim = 5
-        else:
-            # 4D data
-            printv('Split along T dimension...', verbose)
-            im_split_list = split_data(im, 3)
-            dim = 4
-        for im_s in im_split_list:
-            im_s.save(verbose=verbose)
-
-        if get:
-            # get orientation
+    # the orientation is read from the header and changed in memory, whatever the number of dimensions of the data
+    if get:
+        try:
             printv('Get orientation...', verbose)
             im_out = None
-            ori = get_orientation(im_split_list[0])
-            chdir('..')
-            run('rm -rf ' + tmp_folder, error_exit='warning')
-            return ori
-        elif set:
-            # set orientation
-            printv('Change orientation...', verbose)
-            im_changed_ori_list = []
-            for im_s in im_split_list:
-                im_set = set_orientation(im_s, ori)
-                im_changed_ori_list.append(im_set)
-            printv('Merge file back...', verbose)
-            if dim == 4:
-                im_out = concat_data(im_changed_ori_list, 3)
-            elif dim == 5:
-                fname_changed_ori_list = [im_ch_ori.absolutepath for im_ch_ori in im_changed_ori_list]
-                im_out = multicomponent_merge(fname_changed_ori_list)
-        elif set_data:
+            ori = get_orientation(im)
+        except Exception, e:
+            printv('ERROR: an error occurred: ' + str(e), verbose, 'error')
+        return ori
+    elif set:
+        # set orientation
+        printv('Change orientation...', verbose)
+        im_out = set_orientation(im, ori)
+    elif set_data:
+        if (nz != 1 and nt != 1) or len(im.data.shape) == 5:
             printv('Set orientation of the data only is not compatible with 4D data...', verbose, 'error')
-        else:
-            im_out = None
-
-        # Go back to previous directory:
-        chdir('..')
-        run('rm -rf ' + tmp_folder, error_exit='warning')
+        im_out = set_orientation(im, ori, True)
+    else:
+        im_out = None
 
     if fname_out:
         im_out.setFileName(fname_out)
-        if fname_out != im.file_name + '_' + ori + im.ext:
-            run('rm -f ' + im.file_name + '_' + ori + im.ext)
     else:
         im_out.setFileName(im.file_name + '_' + ori + im.ext)
     return im_out
 
 
+# voxel axis direction (index of the physical axis in RAS+, sign) for each orientation character
+orientation_dic = {
+    (0, 1): 'L',
+    (0, -1): 'R',
+    (1, 1): 'P',
+    (1, -1): 'A',
+    (2, 1): 'I',
+    (2, -1): 'S',
+}
+
+
 def get_orientation(im):
     from nibabel import orientations
-    orientation_dic = {
-        (0, 1): 'L',
-        (0, -1): 'R',
-        (1, 1): 'P',
-        (1, -1): 'A',
-        (2, 1): 'I',
-        (2, -1): 'S',
-    }
 
     orientation_matrix = orientations.io_orientation(im.hdr.get_best_affine())
     ori = orientation_dic[tuple(orientation_matrix[0])] + orientation_dic[tuple(orientation_matrix[1])] + orientation_dic[tuple(orientation_matrix[2])]
@@ -680,6 +645,56 @@ def get_orientation_3d(im, filename=False):
     return orientation
 
 
+def change_image_orientation(im, orientation):
+    """
+    Change the orientation of an image in memory. The first three axes of the data are permuted and flipped, and the
+    qform and sform of the header are updated accordingly, so that the physical coordinates of the voxels do not
+    change. Other dimensions (e.g., time, components) are kept as they are, so 3D, 4D and 5D images are reoriented in
+    one call.
+    The data of the output image is a view of the data of the input image (no copy).
+    :param im: Image
+    :param orientation: string of three characters, e.g., 'RPI'
+    :return: reoriented Image
+    """
+    from copy import deepcopy
+    from numpy import array
+    from nibabel import orientations
+
+    character_dic = dict((character, ornt) for ornt, character in orientation_dic.items())
+    if len(orientation) != 3 or any(c not in character_dic for c in orientation) or \
+            len(set(character_dic[c][0] for c in orientation)) != 3:
+        printv('ERROR: ' + str(orientation) + ' is not a valid orientation.', 1, 'error')
+
+    data = im.data
+    if data.ndim < 3:
+        data = data.reshape(data.shape + (1,) * (3 - data.ndim))
+    affine = im.hdr.get_best_affine()
+    ornt_transform = orientations.ornt_transform(orientations.io_orientation(affine),
+                                                 array([character_dic[c] for c in orientation]))
+    # affine transformation from the voxel coordinates of the output to the ones of the input
+    affine_transform = orientations.inv_ornt_aff(ornt_transform, data.shape[:3])
+
+    im_out = Image(orientations.apply_orientation(data, ornt_transform), hdr=deepcopy(im.hdr),
+                   orientation=orientation, absolutepath=im.absolutepath)
+    hdr = im_out.hdr
+    hdr.set_data_shape(im_out.data.shape)
+    zooms_in, zooms = im.hdr.get_zooms(), list(hdr.get_zooms())
+    for axis_in, (axis_out, flip) in enumerate(ornt_transform):
+        zooms[int(axis_out)] = zooms_in[axis_in] if axis_in < len(zooms_in) else 1.0
+    hdr.set_zooms(zooms)
+    qform, qform_code = im.hdr.get_qform(coded=True)
+    sform, sform_code = im.hdr.get_sform(coded=True)
+    if qform is None and sform is None:
+        hdr.set_qform(affine.dot(affine_transform), 1)
+    if qform is not None:
+        hdr.set_qform(qform.dot(affine_transform), int(qform_code))
+    if sform is not None:
+        hdr.set_sform(sform.dot(affine_transform), int(sform_code))
+    im_out.dim = get_dimension(im_out)
+    im_out.compute_transform_matrix()
+    return im_out
+
+
 def set_orientation(im, orientation, data_inversion=False, filename=False, fname_out=''):
     """
     Set orientation on image
@@ -687,9 +702,10 @@ def set_orientation(im, orientation, data_inversion=False, filename=False, fname
     :param orientation:
     :param data_inversion:
     :param filename:
+    :param fname_out: if set and im is an Image object, the output image is also saved in this file
     :return:
     """
-
+    save = filename or fname_out != ''
     if fname_out:
         pass
     elif filename:
@@ -699,16 +715,12 @@ def set_orientation(im, orientation, data_inversion=False, filename=False, fname
         fname_out = im.file_name + '_' + orientation + im.ext
 
     if not data_inversion:
-        from sct_utils import run
+        im_out = change_image_orientation(Image(im) if filename else im, orientation)
+        im_out.setFileName(fname_out)
+        if save:
+            im_out.save(verbose=0)
         if filename:
-            run('isct_orientation3d -i ' + im + ' -orientation ' + orientation + ' -o ' + fname_out, 0)
             im_out = fname_out
-        else:
-            fname_in = im.absolutepath
-            if not os.path.exists(fname_in):
-                im.save()
-            run('isct_orientation3d -i ' + im.absolutepath + ' -orientation ' + orientation + ' -o ' + fname_out, 0)
-            im_out = Image(fname_out)
     else:
         im_out = im.copy()
         im_out.change_orientation(orientation, True)
@@ -205,7 +205,7 @@ class ProcessLabels(object):
         :return:
         """
         output_image = Image(self.image_input, self.verbose)
-        nx, ny, nz, nt, px, py, pz, pt = Image(self.image_input.absolutepath).dim
+        nx, ny, nz, nt, px, py, pz, pt = Image(self.image_input.absolutepath, lazy=True).dim
 
         coordinates_input = self.image_input.getNonZeroCoordinates()
         d = self.cross_radius  # cross radius in pixel
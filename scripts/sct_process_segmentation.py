@@ -26,7 +26,7 @@ import sct_utils as sct
 from msct_nurbs import NURBS
 from sct_image import set_orientation
 from sct_straighten_spinalcord import smooth_centerline
-from msct_image import Image
+from msct_image import Image, get_dimension
 from msct_parser import Parser
 import msct_shape
 import pandas as pd
@@ -608,52 +608,63 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
     return file_data + '_centerline.nii.gz'
 
 
-# compute_csa
+# get_image_rpi
 # ==========================================================================================
-def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, use_phys_coord=True):
-
-    from math import degrees
-    import pandas as pd
-    import pickle
-
-    # Extract path, file and extension
-    fname_segmentation = os.path.abspath(fname_segmentation)
-    # path_data, file_data, ext_data = sct.extract_fname(fname_segmentation)
-
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', verbose)
-    path_tmp = sct.slash_at_the_end('tmp.' + time.strftime("%y%m%d%H%M%S") + '_' + str(randint(1, 1000000)), 1)
-    sct.run('mkdir ' + path_tmp, verbose)
-
-    # Copying input data to tmp folder
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    sct.run('sct_convert -i ' + fname_segmentation + ' -o ' + path_tmp + 'segmentation.nii.gz', verbose)
-    # go to tmp folder
-    os.chdir(path_tmp)
-    # Change orientation of the input segmentation into RPI
-    sct.printv('\nChange orientation to RPI...', verbose)
-    sct.run('sct_image -i segmentation.nii.gz -setorient RPI -o segmentation_RPI.nii.gz', verbose)
-
-    # Open segmentation volume
-    sct.printv('\nOpen segmentation volume...', verbose)
-    im_seg = Image('segmentation_RPI.nii.gz')
+def get_image_rpi(seg, voxel_size=(1.0, 1.0, 1.0)):
+    """
+    Get a segmentation as an Image in RPI orientation. The reorientation is done in memory.
+    :param seg: Image, file name or 3D numpy array. Arrays are assumed to be in RPI orientation.
+    :param voxel_size: voxel size in mm (x, y, z), only used if seg is a numpy array
+    :return: Image in RPI orientation
+    """
+    if isinstance(seg, str):
+        seg = Image(seg)
+    elif isinstance(seg, np.ndarray):
+        from nibabel import Nifti1Header
+        hdr = Nifti1Header()
+        hdr.set_data_shape(seg.shape)
+        hdr.set_zooms(tuple(voxel_size[:3]) + (1.0,) * (seg.ndim - 3))
+        affine = np.diag([-voxel_size[0], voxel_size[1], voxel_size[2], 1.0])
+        hdr.set_qform(affine, 1)
+        hdr.set_sform(affine, 1)
+        seg = Image(seg, hdr=hdr, orientation='RPI')
+        seg.dim = get_dimension(seg)
+        seg.compute_transform_matrix()
+    if seg.orientation != 'RPI':
+        seg = set_orientation(seg, 'RPI')
+    return seg
+
+
+# compute_csa_per_slice
+# ==========================================================================================
+def compute_csa_per_slice(seg, angle_correction=True, use_phys_coord=True, algo_fitting='hanning', type_window='hanning', window_length=80, voxel_size=(1.0, 1.0, 1.0), verbose=0):
+    """
+    Compute the cross-sectional area of the spinal cord on each axial slice of a segmentation, in memory. The number of
+    voxels (weighted by the partial volume) of all slices is scaled by the in-plane voxel size and by the cosine of the
+    angle between the centerline and the I-S axis.
+    :param seg: segmentation: Image, file name or 3D numpy array (in RPI orientation)
+    :param voxel_size: voxel size in mm (x, y, z), only used if seg is a numpy array
+    :return: z_slices: indices of the slices in RPI orientation, from the lowest to the highest non-empty slice
+             csa: CSA of each slice (mm^2)
+             angles: angle between the centerline and the I-S axis for each slice (degrees)
+             z_centerline_voxel: z coordinates of the centerline in voxel space (None if angle_correction is False)
+    """
+    im_seg = get_image_rpi(seg, voxel_size)
     data_seg = im_seg.data
-    # hdr_seg = im_seg.hdr
-
-    # Get size of data
-    sct.printv('\nGet data dimensions...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
-    sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
-    # # Extract min and max index in Z direction
-    X, Y, Z = (data_seg > 0).nonzero()
-    min_z_index, max_z_index = min(Z), max(Z)
+    # Extract min and max index in Z direction
+    z_nonzero = np.nonzero(np.any(data_seg > 0, axis=(0, 1)))[0]
+    min_z_index, max_z_index = z_nonzero[0], z_nonzero[-1]
+    z_slices = np.arange(min_z_index, max_z_index + 1)
 
+    angles = np.zeros(len(z_slices))
+    z_centerline_voxel = None
     # if angle correction is required, get segmentation centerline
     if angle_correction:
         if use_phys_coord:
             # fit centerline, smooth it and return the first derivative (in physical space)
-            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
+            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
             centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
 
             # average centerline coordinates over slices of the image
@@ -663,48 +674,81 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
             axis_X, axis_Y, axis_Z = im_seg.get_directions()
 
             # compute z_centerline in image coordinates for usage in vertebrae mapping
-            z_centerline_voxel = [coord[2] for coord in im_seg.transfo_phys2pix([[x_centerline_fit_rescorr[i], y_centerline_fit_rescorr[i], z_centerline_rescorr[i]] for i in range(len(z_centerline_rescorr))])]
+            z_centerline_voxel = im_seg.transfo_phys2pix_array(np.column_stack((x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr)))[:, 2]
 
         else:
             # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
-            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
+            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
 
-            # correct centerline fitted coordinates according to the data resolution
-            x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr, x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr = x_centerline_fit * px, y_centerline_fit * py, z_centerline * pz, x_centerline_deriv * px, y_centerline_deriv * py, z_centerline_deriv * pz
+            # correct centerline derivatives according to the data resolution
+            x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr = np.asarray(x_centerline_deriv) * px, np.asarray(y_centerline_deriv) * py, np.asarray(z_centerline_deriv) * pz
 
             axis_Z = [0.0, 0.0, 1.0]
 
             # compute z_centerline in image coordinates for usage in vertebrae mapping
             z_centerline_voxel = z_centerline
 
-    # Compute CSA
-    sct.printv('\nCompute CSA...', verbose)
+        # tangent vectors to the centerline (i.e. its derivative), one per slice
+        tangent_vect = np.column_stack((x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr))
+        if len(tangent_vect) < len(z_slices):
+            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash:
+            # the last tangent vector is used for the slices that are not covered by the centerline
+            sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
+        tangent_vect = tangent_vect[np.minimum(np.arange(len(z_slices)), len(tangent_vect) - 1)]
+        tangent_vect = tangent_vect / np.linalg.norm(tangent_vect, axis=1)[:, np.newaxis]
 
-    # Empty arrays in which CSA for each z slice will be stored
-    csa = np.zeros(max_z_index - min_z_index + 1)
-    angles = np.zeros(max_z_index - min_z_index + 1)
+        # compute the angle between the normal vector of the plane and the vector z
+        angles = np.arccos(tangent_vect.dot(axis_Z))
 
-    for iz in xrange(min_z_index, max_z_index + 1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
-            try:
-                # normalize the tangent vector to the centerline (i.e. its derivative)
-                tangent_vect = normalize(np.array([x_centerline_deriv_rescorr[iz - min_z_index], y_centerline_deriv_rescorr[iz - min_z_index], z_centerline_deriv_rescorr[iz - min_z_index]]))
+    # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1, and
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    number_voxels = data_seg[:, :, min_z_index:max_z_index + 1].sum(axis=(0, 1))
+    csa = number_voxels * px * py * np.cos(angles)
 
-            except IndexError:
-                sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
+    return z_slices, csa, np.degrees(angles), z_centerline_voxel
 
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.vdot(tangent_vect, axis_Z))
-        else:
-            angle = 0.0
 
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
+def get_slice_values_volume(im_seg, z_slices, values):
+    """
+    Create a volume in which the voxels of the segmentation are set to the value of their slice (e.g., CSA).
+    :param im_seg: segmentation Image
+    :param z_slices: indices of the consecutive slices associated to values
+    :param values: one value per slice
+    :return: Image of type float32
+    """
+    data = im_seg.data.astype(np.float32)
+    data_slab = data[:, :, z_slices[0]:z_slices[-1] + 1]
+    data_slab[...] = np.where(data_slab > 0, np.asarray(values, dtype=np.float32), data_slab)
+    im_out = Image(data, hdr=im_seg.hdr.copy(), orientation=im_seg.orientation, absolutepath=im_seg.absolutepath, dim=im_seg.dim)
+    im_out.changeType('float32')
+    return im_out
+
 
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz - min_z_index] = number_voxels * px * py * np.cos(angle)
-        angles[iz - min_z_index] = degrees(angle)
+# compute_csa
+# ==========================================================================================
+def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, use_phys_coord=True):
+
+    import pickle
+
+    # Extract path, file and extension
+    fname_segmentation = os.path.abspath(fname_segmentation)
+
+    # Open segmentation volume and change its orientation into RPI (in memory)
+    sct.printv('\nOpen segmentation volume...', verbose)
+    im_seg_original = Image(fname_segmentation)
+    orientation = im_seg_original.orientation
+    sct.printv('\nChange orientation to RPI...', verbose)
+    im_seg = get_image_rpi(im_seg_original)
+    data_seg = im_seg.data
+
+    # Get size of data
+    sct.printv('\nGet data dimensions...', verbose)
+    nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
+    sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
+
+    # Compute CSA
+    sct.printv('\nCompute CSA...', verbose)
+    z_slices, csa, angles, z_centerline_voxel = compute_csa_per_slice(im_seg, angle_correction=angle_correction, use_phys_coord=use_phys_coord, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, verbose=verbose)
 
     sct.printv('\nSmooth CSA across slices...', verbose)
     if smoothing_param:
@@ -715,7 +759,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
         if verbose == 2:
             import matplotlib.pyplot as plt
             plt.figure()
-            z_centerline_scaled = [x * pz for x in z_centerline]
+            z_centerline_scaled = z_slices * pz
             pltx, = plt.plot(z_centerline_scaled, csa, 'bo')
             pltx_fit, = plt.plot(z_centerline_scaled, csa_smooth, 'r', linewidth=2)
             plt.title("Cross-sectional area (CSA)")
@@ -728,87 +772,29 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     else:
         sct.printv('.. No smoothing!', verbose)
 
-    # output volume of csa values
+    # output volumes of csa and angle values, in the orientation of the input segmentation
     sct.printv('\nCreate volume of CSA values...', verbose)
-    data_csa = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_csa[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_csa[i[0], i[1], iz] = csa[iz - min_z_index]
-    # replace data
-    im_seg.data = data_csa
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
-    # set file name -- use .gz because faster to write
-    im_seg.setFileName('csa_volume_RPI.nii.gz')
-    im_seg.changeType('float32')
-    # save volume
-    im_seg.save()
-
-    # output volume of csa values
+    set_orientation(get_slice_values_volume(im_seg, z_slices, csa), orientation, fname_out=output_folder + 'csa_image.nii.gz')
     sct.printv('\nCreate volume of angle values...', verbose)
-    data_angle = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_angle[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_angle[i[0], i[1], iz] = angles[iz - min_z_index]
-    # replace data
-    im_seg.data = data_angle
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
-    # set file name -- use .gz because faster to write
-    im_seg.setFileName('angle_volume_RPI.nii.gz')
-    im_seg.changeType('float32')
-    # save volume
-    im_seg.save()
-
-    # get orientation of the input data
-    im_seg_original = Image('segmentation.nii.gz')
-    orientation = im_seg_original.orientation
-    sct.run('sct_image -i csa_volume_RPI.nii.gz -setorient ' + orientation + ' -o csa_volume_in_initial_orientation.nii.gz')
-    sct.run('sct_image -i angle_volume_RPI.nii.gz -setorient ' + orientation + ' -o angle_volume_in_initial_orientation.nii.gz')
-
-    # come back to parent folder
-    os.chdir('..')
-
-    # Generate output files
-    sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file(path_tmp + 'csa_volume_in_initial_orientation.nii.gz', output_folder + 'csa_image.nii.gz')  # extension already included in name_output
-    sct.generate_output_file(path_tmp + 'angle_volume_in_initial_orientation.nii.gz', output_folder + 'angle_image.nii.gz')  # extension already included in name_output
+    set_orientation(get_slice_values_volume(im_seg, z_slices, angles), orientation, fname_out=output_folder + 'angle_image.nii.gz')
     sct.printv('\n')
 
     # Create output text file
     sct.printv('Display CSA per slice:', verbose)
     file_results = open(output_folder + 'csa_per_slice.txt', 'w')
     file_results.write('# Slice (z),CSA (mm^2),Angle with respect to the I-S direction (degrees)\n')
-    for i in range(min_z_index, max_z_index + 1):
-        file_results.write(str(int(i)) + ',' + str(csa[i - min_z_index]) + ',' + str(angles[i - min_z_index]) + '\n')
+    for i in range(len(z_slices)):
+        file_results.write(str(int(z_slices[i])) + ',' + str(csa[i]) + ',' + str(angles[i]) + '\n')
         # Display results
-        sct.printv('z = %d, CSA = %f mm^2, Angle = %f deg' % (i, csa[i - min_z_index], angles[i - min_z_index]), type='info')
+        sct.printv('z = %d, CSA = %f mm^2, Angle = %f deg' % (z_slices[i], csa[i], angles[i]), type='info')
     file_results.close()
     sct.printv('Save results in: ' + output_folder + 'csa_per_slice.txt\n', verbose)
 
     # Create output pickle file
     # data frame format
-    results_df = pd.DataFrame({'Slice (z)': range(min_z_index, max_z_index + 1),
+    results_df = pd.DataFrame({'Slice (z)': z_slices,
                                'CSA (mm^2)': csa,
                                'Angle with respect to the I-S direction (degrees)': angles})
-    # # dictionary format
-    # results_df = {'Slice (z)': range(min_z_index, max_z_index+1),
-    #                            'CSA (mm^2)': csa,
-    #                            'Angle with respect to the I-S direction (degrees)': angles}
     output_file = open(output_folder + 'csa_per_slice.pickle', 'wb')
     pickle.dump(results_df, output_file)
     output_file.close()
@@ -822,7 +808,6 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
             sct.printv('\nERROR: You asked for specific vertebral levels (option -vert) but you did not provide any vertebral labeling file (see option -vertfile). The path to the vertebral labeling file is usually \"./label/template/PAM50_levels.nii.gz\". See usage.\n', 1, 'error')
 
         elif vert_levels and fname_vertebral_labeling:
-            # from sct_extract_metric import get_slices_matching_with_vertebral_levels
             sct.printv('Selected vertebral levels... ' + vert_levels)
 
             # check if vertebral labeling file exists
@@ -833,7 +818,6 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
             im_vertebral_labeling.change_orientation(orientation='RPI')
 
             # get the slices corresponding to the vertebral levels
-            # slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels(data_seg, vert_levels, im_vertebral_labeling.data, 1)
             slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels_based_centerline(vert_levels, im_vertebral_labeling.data, z_centerline_voxel)
 
         elif not vert_levels:
@@ -850,25 +834,14 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
         else:
             # parse the selected slices
             slices_lim = slices.strip().split(':')
-            slices_list = range(int(slices_lim[0]), int(slices_lim[-1]) + 1)
             sct.printv('Average CSA across slices ' + str(slices_lim[0]) + ' to ' + str(slices_lim[-1]) + '...', type='info')
 
-            CSA_for_selected_slices = []
-            angles_for_selected_slices = []
-            # Read the file csa_per_slice.txt and get the CSA for the selected slices
-            with open(output_folder + 'csa_per_slice.txt') as openfile:
-                for line in openfile:
-                    if line[0] != '#':
-                        line_split = line.strip().split(',')
-                        if int(line_split[0]) in slices_list:
-                            CSA_for_selected_slices.append(float(line_split[1]))
-                            angles_for_selected_slices.append(float(line_split[2]))
-
-            # average the CSA and angle
-            mean_CSA = np.mean(np.asarray(CSA_for_selected_slices))
-            std_CSA = np.std(np.asarray(CSA_for_selected_slices))
-            mean_angle = np.mean(np.asarray(angles_for_selected_slices))
-            std_angle = np.std(np.asarray(angles_for_selected_slices))
+            # average the CSA and angle across the selected slices
+            selected_slices = (z_slices >= int(slices_lim[0])) & (z_slices <= int(slices_lim[-1]))
+            mean_CSA = np.mean(csa[selected_slices])
+            std_CSA = np.std(csa[selected_slices])
+            mean_angle = np.mean(angles[selected_slices])
+            std_angle = np.std(angles[selected_slices])
 
         sct.printv('Mean CSA: ' + str(mean_CSA) + ' +/- ' + str(std_CSA) + ' mm^2', type='info')
         sct.printv('Mean angle: ' + str(mean_angle) + ' +/- ' + str(std_angle) + ' degrees', type='info')
@@ -882,7 +855,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
             volume = 0.0
         else:
             sct.printv('Compute the volume in between slices ' + str(slices_lim[0]) + ' to ' + str(slices_lim[-1]) + '...', type='info')
-            nb_vox = np.sum(data_seg[:, :, slices_list])
+            nb_vox = np.sum(data_seg[:, :, int(slices_lim[0]):int(slices_lim[-1]) + 1])
             volume = nb_vox * px * py * pz
         sct.printv('Volume in between the selected slices: ' + str(volume) + ' mm^3', type='info')
 
@@ -892,11 +865,6 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     elif (not (slices or vert_levels)) and (overwrite == 1):
         sct.printv('WARNING: Flag \"-overwrite\" is only available if you select (a) slice(s) or (a) vertebral level(s) (flag -z or -vert) ==> CSA estimation per slice will be output in .txt and .pickle files only.', type='warning')
 
-    # Remove temporary files
-    if remove_temp_files:
-        sct.printv('\nRemove temporary files...')
-        sct.run('rm -rf ' + path_tmp, error_exit='warning')
-
     # Sum up the output file names
     sct.printv('\nOutput a nifti file of CSA values along the segmentation: ' + output_folder + 'csa_image.nii.gz', verbose, 'info')
     sct.printv('Output result text file of CSA per slice: ' + output_folder + 'csa_per_slice.txt', verbose, 'info')
@@ -1126,15 +1094,17 @@ def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels,
     # Find slices included in the vertebral levels wanted by the user
     # if the median vertebral level of this slice is in the vertebral levels asked by the user, record the slice number
     sct.printv('\tFind slices corresponding to vertebral levels based on the centerline...')
-    matching_slices_centerline_vert_labeling = []
-
-    z_centerline = [x for x in z_centerline if 0 < int(x) < vertebral_labeling_data.shape[2]]
-    vert_range = range(vert_levels_list[0], vert_levels_list[1] + 1)
-
-    for idx, z_slice in enumerate(vertebral_labeling_data.T[z_centerline, :, :]):
-        slice_idxs = np.nonzero(z_slice)
-        if np.asarray(slice_idxs).shape != (2, 0) and int(np.median(z_slice[slice_idxs])) in vert_range:
-            matching_slices_centerline_vert_labeling.append(idx)
+    z_centerline = np.array([int(x) for x in z_centerline if 0 < int(x) < vertebral_labeling_data.shape[2]], dtype=int)
+
+    # median of the non-zero labels of all slices at once: zeros are sorted after the labels, so that the median is
+    # taken among the nb_labels first values of each slice
+    labels = vertebral_labeling_data[:, :, z_centerline].reshape(-1, len(z_centerline))
+    labels = np.sort(np.where(labels != 0, labels, np.inf), axis=0)
+    nb_labels = np.sum(np.isfinite(labels), axis=0)
+    idx_slices = np.arange(len(z_centerline))
+    median_labels = (labels[np.maximum(nb_labels - 1, 0) // 2, idx_slices] + labels[nb_labels // 2, idx_slices]) / 2.0
+    median_labels = np.trunc(np.where(nb_labels > 0, median_labels, 0)).astype(int)
+    matching_slices_centerline_vert_labeling = np.nonzero((nb_labels > 0) & (median_labels >= int(vert_levels_list[0])) & (median_labels <= int(vert_levels_list[1])))[0]
 
     # now, find the min and max slices that are included in the vertebral levels
     if len(matching_slices_centerline_vert_labeling) == 0:
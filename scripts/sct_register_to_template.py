@@ -625,8 +625,8 @@ def resample_labels(fname_labels, fname_dest, fname_output):
     label using the old and new voxel size.
     """
     # get dimensions of input and destination files
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_labels).dim
-    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_labels, lazy=True).dim
+    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = Image(fname_dest, lazy=True).dim
     sampling_factor = [float(nx) / nxd, float(ny) / nyd, float(nz) / nzd]
     # read labels
     from sct_label_utils import ProcessLabels
@@ -14,11 +14,13 @@
 '''
 INFORMATION:
 The model used in this function is compound of:
-  - a dictionary: a list of slices of WM/GM contrasted images with their manual segmentations [slices.pklz]
-  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [fitted_model.pklz]
-  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.pklz]
-  - the averaged median intensity in the white and gray matter in the model [intensities.pklz]
+  - a dictionary: slices of WM/GM contrasted images with their manual segmentations, stacked in arrays [im.npy, im_M.npy, gm_seg.npy, gm_seg_M.npy, wm_seg.npy, wm_seg_M.npy, level.npy, id.npy, gm_slice.npy, wm_slice.npy]
+  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [pca_components.npy and pca_mean.npy, or fitted_model.pklz]
+  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.npy]
+  - the averaged median intensity in the white and gray matter in the model [intensities.npy]
+  - the version of the format of the model files [model.json]
   - an information file indicating which parameters were used to construct this model, and te date of computation [info.txt]
+The arrays are memory-mapped when the model is loaded. Models saved as pickles by previous versions [slices.pklz, fitted_model.pklz, fitted_data.pklz, intensities.pklz] can still be loaded.
 
 A constructed model is provided in the toolbox here: $PATH_SCT/data/gm_model.
 It's made from T2* images of 80 subjects and computed with the parameters that gives the best gray matter segmentation results.
@@ -45,14 +47,14 @@ import shutil
 import sys
 import time
 import copy
-from math import exp
 
 import numpy as np
+from scipy.spatial.distance import cdist
 
 import sct_maths
 import sct_process_segmentation
 import sct_register_multimodal
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, binarize,
+from msct_gmseg_utils import (apply_transfo, binarize,
                               normalize_slice, pre_processing, register_data)
 from msct_image import Image
 from msct_multiatlas_seg import Model, Param, ParamData, ParamModel
@@ -259,10 +261,10 @@ class SegmentGM:
         self.project_target()
 
         printv('\nCompute similarities between target slices and model slices using model reduced space...', self.param.verbose, 'normal')
-        list_dic_indexes_by_slice = self.compute_similarities()
+        selected_dic_slices = self.compute_similarities()
 
         printv('\nLabel fusion of model slices most similar to target slices...', self.param.verbose, 'normal')
-        self.label_fusion(list_dic_indexes_by_slice)
+        self.label_fusion(selected_dic_slices)
 
         printv('\nWarp back segmentation into image space...', self.param.verbose, 'normal')
         self.warp_back_seg(path_warp)
@@ -371,56 +373,49 @@ class SegmentGM:
             target_slice.set(im_m=norm_im_M)
 
     def project_target(self):
-        projected_target_slices = []
-        for target_slice in self.target_im:
-            # get slice data in the good shape
-            slice_data = target_slice.im_M.flatten()
-            slice_data = slice_data.reshape(1, -1)  # data with single sample
-            # project slice data into the model
-            slice_data_projected = self.model.fitted_model.transform(slice_data)
-            projected_target_slices.append(slice_data_projected.reshape(-1, ))
-        # store projected target slices
-        self.projected_target = projected_target_slices
+        # project the data of all target slices into the model at once (one sample per slice)
+        target_data = np.array([target_slice.im_M.flatten() for target_slice in self.target_im])
+        self.projected_target = self.model.fitted_model.transform(target_data)
 
     def compute_similarities(self):
-        list_dic_indexes_by_slice = []
-        for i, target_coord in enumerate(self.projected_target):
-            list_dic_similarities = []
-            for j, dic_coord in enumerate(self.model.fitted_data):
-                # compute square norm using coordinates in the model space
-                square_norm = np.linalg.norm((target_coord - dic_coord), 2)
-                # compute similarity with or without levels
-                if self.param_seg.fname_level is not None:
-                    # EQUATION WITH LEVELS
-                    similarity = exp(-self.param_seg.weight_level * abs(self.target_im[i].level - self.model.slices[j].level)) * exp(-self.param_seg.weight_coord * square_norm)
-                else:
-                    # EQUATION WITHOUT LEVELS
-                    similarity = exp(-self.param_seg.weight_coord * square_norm)
-                # add similarity to list
-                list_dic_similarities.append(similarity)
-            list_norm_similarities = [float(s) / sum(list_dic_similarities) for s in list_dic_similarities]
-            # select indexes of most similar slices
-            list_dic_indexes = []
-            for j, norm_sim in enumerate(list_norm_similarities):
-                if norm_sim >= self.param_seg.thr_similarity:
-                    list_dic_indexes.append(j)
-            # save list of indexes into list by slice
-            list_dic_indexes_by_slice.append(list_dic_indexes)
-
-        return list_dic_indexes_by_slice
-
-    def label_fusion(self, list_dic_indexes_by_slice):
-        for target_slice in self.target_im:
-            # get list of slices corresponding to the indexes
-            list_dic_slices = [self.model.slices[j] for j in list_dic_indexes_by_slice[target_slice.id]]
-            # average slices GM and WM
-            # WM is not used anymore here, but the average_gm_wm() function is used in other parts of the code that need both the GM and WM averages
-            data_mean_gm, data_mean_wm = average_gm_wm(list_dic_slices)
-            # set negative values to 0
-            data_mean_gm[data_mean_gm < 0] = 0
+        """
+        Compute the similarities between all target slices and all model slices, using their coordinates in the model
+        reduced space (and their vertebral levels), and select the most similar model slices for each target slice.
+        :return: boolean array of shape (number of target slices, number of model slices): selected model slices
+        """
+        # distance between target slices (rows) and model slices (columns) in the model space
+        dist = cdist(np.asarray(self.projected_target), np.asarray(self.model.fitted_data))
+        # compute similarity with or without levels
+        if self.param_seg.fname_level is not None:
+            # EQUATION WITH LEVELS
+            target_levels = np.array([target_slice.level for target_slice in self.target_im], dtype=float)
+            model_levels = self.model.get_dictionary_arrays()['level']
+            similarities = np.exp(-self.param_seg.weight_level * np.abs(target_levels[:, np.newaxis] - model_levels) - self.param_seg.weight_coord * dist)
+        else:
+            # EQUATION WITHOUT LEVELS
+            similarities = np.exp(-self.param_seg.weight_coord * dist)
+        # normalize similarities of each target slice, and select most similar model slices
+        norm_similarities = similarities / np.sum(similarities, axis=1)[:, np.newaxis]
+
+        return norm_similarities >= self.param_seg.thr_similarity
+
+    def label_fusion(self, selected_dic_slices):
+        """
+        Average the GM segmentations (in the model space) of the model slices selected for each target slice. The
+        averages of all target slices are computed with one matrix product.
+        :param selected_dic_slices: boolean array of shape (number of target slices, number of model slices)
+        """
+        # sum and number of the GM segmentations of each model slice
+        gm_sum, nb_gm = self.model.get_gm_sum_by_slice()
+
+        selected_dic_slices = np.asarray(selected_dic_slices, dtype=float)
+        data_mean_gm = np.dot(selected_dic_slices, gm_sum) / np.dot(selected_dic_slices, nb_gm)[:, np.newaxis]
+        # set negative values to 0
+        data_mean_gm[data_mean_gm < 0] = 0
 
+        for target_slice in self.target_im:
             # store segmentation into target_im
-            target_slice.set(gm_seg_m=data_mean_gm)
+            target_slice.set(gm_seg_m=data_mean_gm[target_slice.id].reshape(self.model.slices[0].gm_seg_M.shape[1:]))
 
     def warp_back_seg(self, path_warp):
         # get 3D images from list of slices
@@ -629,6 +624,8 @@ class SegmentGM:
         if self.im_res_gmseg.orientation is not 'RPI':
             im_res_gmseg = set_orientation(self.im_res_gmseg, 'RPI')
             im_res_wmseg = set_orientation(self.im_res_wmseg, 'RPI')
+            im_res_gmseg.save()
+            im_res_wmseg.save()
             fname_gmseg = im_res_gmseg.absolutepath
             fname_wmseg = im_res_wmseg.absolutepath
 
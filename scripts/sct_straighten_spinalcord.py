@@ -54,9 +54,8 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     # open centerline
     data = file_image.data
 
-    # loop across z and associate x,y coordinate with the point having maximum intensity
     # N.B. len(z_centerline) = nz_nonz can be smaller than nz in case the centerline is smaller than the input volume
-    z_centerline = [iz for iz in range(0, nz, 1) if data[:, :, iz].any()]
+    z_centerline = np.nonzero(np.any(data, axis=(0, 1)))[0].tolist()
     nz_nonz = len(z_centerline)
     x_centerline = [0 for _ in range(0, nz_nonz, 1)]
     y_centerline = [0 for _ in range(0, nz_nonz, 1)]
@@ -66,8 +65,6 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     x_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
     y_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
     z_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
-    num_features = [0 for _ in range(0, nz_nonz, 1)]
-    distances = []
 
     if nz_nonz <= 5 and algo_fitting == 'nurbs':
         sct.printv('WARNING: switching to hanning smoothing due to low number of slices.', verbose=verbose, type='warning')
@@ -75,30 +72,39 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
 
     # get center of mass of the centerline/segmentation and remove outliers
     sct.printv('.. Get center of mass of the centerline/segmentation...', verbose)
-    for iz in range(0, nz_nonz, 1):
-        slice = np.array(data[:, :, z_centerline[iz]])
-        labeled_array, num_f = ndimage.measurements.label(slice)
-        num_features[iz] = num_f
-        x_centerline[iz], y_centerline[iz] = ndimage.measurements.center_of_mass(slice)
-        if iz != 0:
-            distances.append(sqrt((x_centerline[iz] - x_centerline[iz - 1]) ** 2 + (y_centerline[iz] - y_centerline[iz - 1]) ** 2))
-
-    if remove_outliers:
+    if nz_nonz:
+        # all slices at once, within the bounding box of the non-zero voxels
+        x_nonz = np.nonzero(np.any(data, axis=(1, 2)))[0]
+        y_nonz = np.nonzero(np.any(data, axis=(0, 2)))[0]
+        data_box = np.asarray(data[x_nonz[0]:x_nonz[-1] + 1, y_nonz[0]:y_nonz[-1] + 1, z_centerline])
+        index_slices = np.arange(1, nz_nonz + 1)
+        labels_slices = np.empty(data_box.shape, dtype=int)
+        labels_slices[...] = index_slices
+        center_of_mass = np.array(ndimage.measurements.center_of_mass(data_box, labels_slices, index_slices))
+        x_centerline = (center_of_mass[:, 0] + x_nonz[0]).tolist()
+        y_centerline = (center_of_mass[:, 1] + y_nonz[0]).tolist()
+
+    if remove_outliers and nz_nonz:
+        # number of connected objects in each slice: labelling with an in-plane connectivity only
+        structure = np.zeros((3, 3, 3), dtype=int)
+        structure[:, :, 1] = ndimage.generate_binary_structure(2, 1)
+        labeled_array, num_labels = ndimage.measurements.label(data_box, structure)
+        slice_label = np.zeros(num_labels + 1, dtype=int)
+        slice_label[labeled_array[labeled_array > 0]] = np.nonzero(labeled_array)[2]
+        num_features = np.bincount(slice_label[1:], minlength=nz_nonz)
+
+        # distance between centers of mass of consecutive slices
+        distances = np.sqrt(np.diff(x_centerline) ** 2 + np.diff(y_centerline) ** 2)
         mean_distances = np.mean(distances)
         std_distances = np.std(distances)
-        indices_to_remove = []
 
-        # ascending verification
-        for iz in range(0, nz_nonz / 2, 1):
-            distance = sqrt((x_centerline[iz] - x_centerline[iz + 1]) ** 2 + (y_centerline[iz] - y_centerline[iz + 1]) ** 2)
-            if num_features[iz] > 1 or abs(distance - mean_distances) > 3 * std_distances:
-                indices_to_remove.append(iz)
-
-        # descending verification
-        for iz in range(nz_nonz - 1, nz_nonz / 2, -1):
-            distance = sqrt((x_centerline[iz] - x_centerline[iz - 1]) ** 2 + (y_centerline[iz] - y_centerline[iz - 1]) ** 2)
-            if num_features[iz] > 1 or abs(distance - mean_distances) > 3 * std_distances:
-                indices_to_remove.append(iz)
+        # ascending verification (distance to the next slice) on the first half of the slices, descending verification
+        # (distance to the previous slice) on the second half
+        index_ascending = np.arange(0, nz_nonz // 2)
+        index_descending = np.arange(nz_nonz // 2 + 1, nz_nonz)
+        is_outlier_ascending = (num_features[index_ascending] > 1) | (abs(distances[index_ascending] - mean_distances) > 3 * std_distances)
+        is_outlier_descending = (num_features[index_descending] > 1) | (abs(distances[index_descending - 1] - mean_distances) > 3 * std_distances)
+        indices_to_remove = np.concatenate([index_ascending[is_outlier_ascending], index_descending[is_outlier_descending]])
 
         x_centerline = np.delete(x_centerline, indices_to_remove)
         y_centerline = np.delete(y_centerline, indices_to_remove)
@@ -107,7 +113,7 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     if phys_coordinates:
         sct.printv('.. Computing physical coordinates of centerline/segmentation...', verbose)
         coord_centerline = np.array(zip(x_centerline, y_centerline, z_centerline))
-        phys_coord_centerline = np.asarray(file_image.transfo_pix2phys(coord_centerline))
+        phys_coord_centerline = file_image.transfo_pix2phys_array(coord_centerline)
         x_centerline = phys_coord_centerline[:, 0]
         y_centerline = phys_coord_centerline[:, 1]
         z_centerline = phys_coord_centerline[:, 2]
@@ -175,6 +181,66 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
             x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
 
 
+def get_chunks(nx, ny, nz, nb_voxels_chunk=500000):
+    """
+    Split the z axis of a (nx, ny, nz) volume into chunks of consecutive slices, each chunk containing at most
+    nb_voxels_chunk voxels (at least one slice per chunk).
+    :return: list of [z_start, z_end[ boundaries
+    """
+    nz_chunk = max(1, int(nb_voxels_chunk // (nx * ny)))
+    return [(z_start, min(z_start + nz_chunk, nz)) for z_start in range(0, nz, nz_chunk)]
+
+
+def compute_displacements_chunk(data_warp, image_ref, centerline_ref, centerline_dest, lookup, z_start, z_end,
+                                threshold_distance=10, mode='curved2straight'):
+    """
+    Compute the displacement field of slices [z_start, z_end[ of the reference space and write it in place into
+    data_warp. All voxels of the chunk are processed at once (nearest centerline plane, projection, in-plane coordinates
+    and correspondence in the destination space).
+    :param data_warp: preallocated warping field of shape (nx, ny, nz, 1, 3), in the space of image_ref
+    :param image_ref: Image defining the grid of the warping field
+    :param centerline_ref: Centerline in the space of image_ref
+    :param centerline_dest: Centerline in the destination space
+    :param lookup: numpy array, lookup table from centerline_ref indexes to centerline_dest indexes
+    :param mode: 'curved2straight': image_ref is the straight space; 'straight2curved': image_ref is the curved space
+    """
+    nx, ny = data_warp.shape[0], data_warp.shape[1]
+    physical_coordinates = image_ref.transfo_pix2phys_array(tuple(np.ogrid[0:nx, 0:ny, z_start:z_end])).reshape(-1, 3)
+
+    nearest_indexes = centerline_ref.find_nearest_indexes(physical_coordinates)
+    distances = centerline_ref.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    lookup_chunk = lookup[nearest_indexes]
+    indexes_out_distance = np.logical_or(np.abs(distances) > threshold_distance, lookup_chunk == 0)
+    projected_points = centerline_ref.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline_ref.get_in_plans_coordinates(projected_points, nearest_indexes)
+    del projected_points
+
+    if mode == 'curved2straight':
+        coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup_chunk)
+    elif mode == 'straight2curved':
+        coord_dest = centerline_dest.points[lookup_chunk]
+        coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_dest[:, 2] += distances
+    else:
+        raise ValueError("mode must be either 'curved2straight' or 'straight2curved'.")
+
+    displacements = coord_dest - physical_coordinates
+    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = 100000.0
+
+    data_warp[:, :, z_start:z_end, 0, :] = -displacements.reshape((nx, ny, z_end - z_start, 3))
+
+
+def compute_displacements_job(job):
+    """
+    Wrapper around compute_displacements_chunk() to be used with a pool of workers.
+    :param job: tuple (args, kwargs)
+    """
+    args, kwargs = job
+    compute_displacements_chunk(*args, **kwargs)
+
+
 class SpinalCordStraightener(object):
 
     def __init__(self, input_filename, centerline_filename, debug=0, deg_poly=10, gapxy=30, gapz=15,
@@ -213,11 +279,62 @@ class SpinalCordStraightener(object):
         self.resample_factor = 0.0
         self.accuracy_results = 0
 
+        from multiprocessing import cpu_count
+        self.cpu_number = cpu_count()  # number of threads used for computing the warping fields
+        self.nb_voxels_chunk = 500000  # maximum number of voxels processed at once (per thread)
+        self.warp_memmap = False  # write warping fields directly into memory-mapped nifti files
+        # persistent cache of centerline fits and warping fields (see msct_cache), enabled if SCT_CACHE_DIR is set
+        self.use_cache = os.getenv('SCT_CACHE_DIR') is not None
+        self.path_cache = None
+
         self.elapsed_time = 0.0
         self.elapsed_time_accuracy = 0.0
 
         self.template_orientation = 0
 
+    def get_cache_parameters(self):
+        """
+        Return the parameters of the straightening that change the centerline fit or the warping fields.
+        """
+        return {'algo_fitting': self.algo_fitting, 'type_window': self.type_window,
+                'window_length': self.window_length, 'threshold_distance': self.threshold_distance,
+                'resample_factor': self.resample_factor, 'template_orientation': self.template_orientation,
+                'curved2straight': self.curved2straight, 'straight2curved': self.straight2curved,
+                'use_straight_reference': self.use_straight_reference}
+
+    def fit_centerline(self, fname_centerline, number_of_points, cache=None):
+        """
+        Fit the centerline (see smooth_centerline) and build the Centerline object, in physical coordinates.
+        If a cache is provided, the fitted points and derivatives are reused when the input centerline and the fitting
+        parameters are identical to a previous call.
+        :param fname_centerline: centerline in RPI orientation
+        :param cache: msct_cache.Cache object, or None
+        :return: Centerline
+        """
+        from msct_types import Centerline
+        from msct_image import Image
+        if cache is not None:
+            image_centerline = Image(fname_centerline)
+            key = cache.compute_key('centerline', image_centerline.data, image_centerline.hdr.get_sform(),
+                                    number_of_points, self.algo_fitting, self.type_window, self.window_length)
+            path_entry, info = cache.get(key)
+            if path_entry is not None:
+                return Centerline(fname=os.path.join(path_entry, 'centerline.npz'))
+
+        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = \
+            smooth_centerline(fname_centerline, algo_fitting=self.algo_fitting, type_window=self.type_window,
+                              window_length=self.window_length, verbose=self.verbose,
+                              nurbs_pts_number=number_of_points, all_slices=False, phys_coordinates=True,
+                              remove_outliers=True)
+        centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv,
+                                y_centerline_deriv, z_centerline_deriv)
+
+        if cache is not None:
+            fname_npz = 'tmp.' + sct.extract_fname(fname_centerline)[1] + '_fit.npz'
+            centerline.save_centerline(fname_output=fname_npz)
+            cache.put(key, {'centerline.npz': fname_npz})
+        return centerline
+
     def straighten(self):
         # Initialization
         fname_anat = self.input_filename
@@ -230,8 +347,6 @@ class SpinalCordStraightener(object):
         verbose = self.verbose
         interpolation_warp = self.interpolation_warp
         algo_fitting = self.algo_fitting
-        window_length = self.window_length
-        type_window = self.type_window
         qc = self.qc
 
         # start timer
@@ -268,6 +383,12 @@ class SpinalCordStraightener(object):
         if self.disks_ref_filename != '':
             sct.run('sct_convert -i ' + self.disks_ref_filename + ' -o ' + path_tmp + 'labels_ref.nii.gz')
 
+        # warping fields are written uncompressed if they are memory-mapped
+        if self.warp_memmap:
+            fname_warp_curve2straight, fname_warp_straight2curve = 'tmp.curve2straight.nii', 'tmp.straight2curve.nii'
+        else:
+            fname_warp_curve2straight, fname_warp_straight2curve = 'tmp.curve2straight.nii.gz', 'tmp.straight2curve.nii.gz'
+
         # go to tmp folder
         os.chdir(path_tmp)
 
@@ -331,121 +452,176 @@ class SpinalCordStraightener(object):
                 if number_of_points == 0:
                     number_of_points = 50
 
-            # 2. extract bspline fitting of the centreline, and its derivatives
-            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('centerline_rpi.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, verbose=verbose, nurbs_pts_number=number_of_points, all_slices=False, phys_coordinates=True, remove_outliers=True)
-            from msct_types import Centerline
-            centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
-
-            number_of_points = centerline.number_of_points
-
-            # ==========================================================================================
-            sct.printv("\nCreate the straight space and the safe zone...", verbose)
-            # 3. compute length of centerline
-            # compute the length of the spinal cord based on fitted centerline and size of centerline in z direction
-            from math import sqrt, atan2, sin
-
-            # Computation of the safe zone.
-            # The safe zone is defined as the length of the spinal cord for which an axial segmentation will be complete
-            # The safe length (to remove) is computed using the safe radius (given as parameter) and the angle of the
-            # last centerline point with the inferior-superior direction. Formula: Ls = Rs * sin(angle)
-            # Calculate Ls for both edges and remove appropriate number of centerline points
-            radius_safe = 0.0  # mm
-
-            # inferior edge
-            u = np.array([x_centerline_deriv[0], y_centerline_deriv[0], z_centerline_deriv[0]])
-            v = np.array([0, 0, -1])
-            angle_inferior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
-            length_safe_inferior = radius_safe * sin(angle_inferior)
-
-            # superior edge
-            u = np.array([x_centerline_deriv[-1], y_centerline_deriv[-1], z_centerline_deriv[-1]])
-            v = np.array([0, 0, 1])
-            angle_superior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
-            length_safe_superior = radius_safe * sin(angle_superior)
-
-            # remove points
-            from bisect import bisect
-            inferior_bound = bisect(centerline.progressive_length, length_safe_inferior) - 1
-            superior_bound = centerline.number_of_points - bisect(centerline.progressive_length_inverse, length_safe_superior)
-
-            length_centerline = centerline.length
-            size_z_centerline = z_centerline[-1] - z_centerline[0]
-
-            # compute the size factor between initial centerline and straight bended centerline
-            factor_curved_straight = length_centerline / size_z_centerline
-            middle_slice = (z_centerline[0] + z_centerline[-1]) / 2.0
-
-            bound_curved = [z_centerline[inferior_bound], z_centerline[superior_bound]]
-            bound_straight = [(z_centerline[inferior_bound] - middle_slice) * factor_curved_straight + middle_slice,
-                              (z_centerline[superior_bound] - middle_slice) * factor_curved_straight + middle_slice]
-
-            if verbose == 2:
-                sct.printv("Length of spinal cord = ", str(length_centerline))
-                sct.printv("Size of spinal cord in z direction = ", str(size_z_centerline))
-                sct.printv("Ratio length/size = ", str(factor_curved_straight))
-                sct.printv("Safe zone boundaries: ")
-                sct.printv("Curved space = ", bound_curved)
-                sct.printv("Straight space = ", bound_straight)
-
-            # 4. compute and generate straight space
-            # points along curved centerline are already regularly spaced.
-            # calculate position of points along straight centerline
-
-            # Create straight NIFTI volumes
-            # ==========================================================================================
-            if self.use_straight_reference:
-                image_centerline_pad = Image('centerline_rpi.nii.gz')
-                nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
-
-                sct.run('sct_image -i centerline_ref.nii.gz -setorient RPI -o centerline_ref_rpi.nii.gz')
-                fname_ref = 'centerline_ref_rpi.nii.gz'
-                image_centerline_straight = Image('centerline_ref_rpi.nii.gz')
-                nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
-                x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('centerline_ref_rpi.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, verbose=verbose, nurbs_pts_number=number_of_points, all_slices=False, phys_coordinates=True, remove_outliers=True)
-                centerline_straight = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
-
-                hdr_warp = image_centerline_pad.hdr.copy()
-                hdr_warp_s = image_centerline_straight.hdr.copy()
-                hdr_warp_s.set_data_dtype('float32')
+            # look for the warping fields in the cache. The key covers the input centerline, the reference and the
+            # straightening parameters.
+            cache, key_warp, path_entry = None, None, None
+            if self.use_cache:
+                from msct_cache import Cache
+                cache = Cache(path=self.path_cache, verbose=verbose)
+                images_key = [image_centerline]
+                for fname_key in ['centerline_ref.nii.gz', 'labels_input.nii.gz', 'labels_ref.nii.gz']:
+                    if os.path.isfile(fname_key):
+                        images_key.append(Image(fname_key))
+                key_warp = cache.compute_key('straightening', [[im.data, im.hdr.get_sform()] for im in images_key],
+                                             number_of_points, self.get_cache_parameters())
+                path_entry, info_warp = cache.get(key_warp)
+                if path_entry is not None:
+                    sct.printv('\nWarping fields found in cache: ' + path_entry, verbose)
+                    fname_ref = str(info_warp['fname_ref'])
+                    fname_warp_curve2straight = str(info_warp['fname_warp_curve2straight'])
+                    fname_warp_straight2curve = str(info_warp['fname_warp_straight2curve'])
+                    number_of_points = info_warp['number_of_points']
+                    files = {fname_ref: fname_ref}
+                    if self.curved2straight:
+                        files[fname_warp_curve2straight] = fname_warp_curve2straight
+                    if self.straight2curved:
+                        files[fname_warp_straight2curve] = fname_warp_straight2curve
+                    cache.copy_from(path_entry, files)
+
+            if path_entry is None:
+                # 2. extract bspline fitting of the centreline, and its derivatives
+                from msct_types import Centerline
+                centerline = self.fit_centerline('centerline_rpi.nii.gz', number_of_points, cache=cache)
+                z_centerline = centerline.points[:, 2]
+                x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = centerline.derivatives.transpose()
+
+                number_of_points = centerline.number_of_points
+
+                # ==========================================================================================
+                sct.printv("\nCreate the straight space and the safe zone...", verbose)
+                # 3. compute length of centerline
+                # compute the length of the spinal cord based on fitted centerline and size of centerline in z direction
+                from math import atan2, sin
+
+                # Computation of the safe zone.
+                # The safe zone is defined as the length of the spinal cord for which an axial segmentation will be complete
+                # The safe length (to remove) is computed using the safe radius (given as parameter) and the angle of the
+                # last centerline point with the inferior-superior direction. Formula: Ls = Rs * sin(angle)
+                # Calculate Ls for both edges and remove appropriate number of centerline points
+                radius_safe = 0.0  # mm
+
+                # inferior edge
+                u = np.array([x_centerline_deriv[0], y_centerline_deriv[0], z_centerline_deriv[0]])
+                v = np.array([0, 0, -1])
+                angle_inferior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
+                length_safe_inferior = radius_safe * sin(angle_inferior)
+
+                # superior edge
+                u = np.array([x_centerline_deriv[-1], y_centerline_deriv[-1], z_centerline_deriv[-1]])
+                v = np.array([0, 0, 1])
+                angle_superior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
+                length_safe_superior = radius_safe * sin(angle_superior)
+
+                # remove points
+                from bisect import bisect
+                inferior_bound = bisect(centerline.progressive_length, length_safe_inferior) - 1
+                superior_bound = centerline.number_of_points - bisect(centerline.progressive_length_inverse, length_safe_superior)
+
+                length_centerline = centerline.length
+                size_z_centerline = z_centerline[-1] - z_centerline[0]
+
+                # compute the size factor between initial centerline and straight bended centerline
+                factor_curved_straight = length_centerline / size_z_centerline
+                middle_slice = (z_centerline[0] + z_centerline[-1]) / 2.0
+
+                bound_curved = [z_centerline[inferior_bound], z_centerline[superior_bound]]
+                bound_straight = [(z_centerline[inferior_bound] - middle_slice) * factor_curved_straight + middle_slice,
+                                  (z_centerline[superior_bound] - middle_slice) * factor_curved_straight + middle_slice]
+
+                if verbose == 2:
+                    sct.printv("Length of spinal cord = ", str(length_centerline))
+                    sct.printv("Size of spinal cord in z direction = ", str(size_z_centerline))
+                    sct.printv("Ratio length/size = ", str(factor_curved_straight))
+                    sct.printv("Safe zone boundaries: ")
+                    sct.printv("Curved space = ", bound_curved)
+                    sct.printv("Straight space = ", bound_straight)
+
+                # 4. compute and generate straight space
+                # points along curved centerline are already regularly spaced.
+                # calculate position of points along straight centerline
+
+                # Create straight NIFTI volumes
+                # ==========================================================================================
+                if self.use_straight_reference:
+                    image_centerline_pad = Image('centerline_rpi.nii.gz')
+                    nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
 
-                if self.disks_input_filename != "" and self.disks_ref_filename != "":
-                    disks_input_image = Image('labels_input.nii.gz')
-                    coord = disks_input_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                    coord_physical = []
-                    for c in coord:
-                        c_p = disks_input_image.transfo_pix2phys([[c.x, c.y, c.z]])[0]
-                        c_p.append(c.value)
-                        coord_physical.append(c_p)
-                    centerline.compute_vertebral_distribution(coord_physical)
-                    centerline.save_centerline(image=disks_input_image, fname_output='disks_input_image.nii.gz')
-
-                    disks_ref_image = Image('labels_ref.nii.gz')
-                    coord = disks_ref_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                    coord_physical = []
-                    for c in coord:
-                        c_p = disks_ref_image.transfo_pix2phys([[c.x, c.y, c.z]])[0]
-                        c_p.append(c.value)
-                        coord_physical.append(c_p)
-                    centerline_straight.compute_vertebral_distribution(coord_physical)
-                    centerline_straight.save_centerline(image=disks_ref_image, fname_output='disks_ref_image.nii.gz')
+                    sct.run('sct_image -i centerline_ref.nii.gz -setorient RPI -o centerline_ref_rpi.nii.gz')
+                    fname_ref = 'centerline_ref_rpi.nii.gz'
+                    image_centerline_straight = Image('centerline_ref_rpi.nii.gz')
+                    nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
+                    centerline_straight = self.fit_centerline('centerline_ref_rpi.nii.gz', number_of_points, cache=cache)
+
+                    hdr_warp = image_centerline_pad.hdr.copy()
+                    hdr_warp_s = image_centerline_straight.hdr.copy()
+                    hdr_warp_s.set_data_dtype('float32')
+
+                    if self.disks_input_filename != "" and self.disks_ref_filename != "":
+                        disks_input_image = Image('labels_input.nii.gz')
+                        coord = disks_input_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
+                        coord_physical = []
+                        for c in coord:
+                            c_p = disks_input_image.transfo_pix2phys([[c.x, c.y, c.z]])[0]
+                            c_p.append(c.value)
+                            coord_physical.append(c_p)
+                        centerline.compute_vertebral_distribution(coord_physical)
+                        centerline.save_centerline(image=disks_input_image, fname_output='disks_input_image.nii.gz')
+
+                        disks_ref_image = Image('labels_ref.nii.gz')
+                        coord = disks_ref_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
+                        coord_physical = []
+                        for c in coord:
+                            c_p = disks_ref_image.transfo_pix2phys([[c.x, c.y, c.z]])[0]
+                            c_p.append(c.value)
+                            coord_physical.append(c_p)
+                        centerline_straight.compute_vertebral_distribution(coord_physical)
+                        centerline_straight.save_centerline(image=disks_ref_image, fname_output='disks_ref_image.nii.gz')
 
-            else:
-                sct.printv('\nPad input volume to account for spinal cord length...', verbose)
-                from numpy import ceil
-                start_point = (z_centerline[0] - middle_slice) * factor_curved_straight + middle_slice
-                end_point = (z_centerline[-1] - middle_slice) * factor_curved_straight + middle_slice
-
-                xy_space = 35  # in mm
-                offset_z = 0
-
-                # if the destination image is resampled, we still create the straight reference space with the native resolution
-                if self.resample_factor != 0.0:
-                    padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz_native))
-                    sct.run('sct_image -i centerline_rpi_native.nii.gz -o tmp.centerline_pad_native.nii.gz -pad 0,0,' + str(padding_z))
-                    image_centerline_pad = Image('centerline_rpi_native.nii.gz')
+                else:
+                    sct.printv('\nPad input volume to account for spinal cord length...', verbose)
+                    from numpy import ceil
+                    start_point = (z_centerline[0] - middle_slice) * factor_curved_straight + middle_slice
+                    end_point = (z_centerline[-1] - middle_slice) * factor_curved_straight + middle_slice
+
+                    xy_space = 35  # in mm
+                    offset_z = 0
+
+                    # if the destination image is resampled, we still create the straight reference space with the native resolution
+                    if self.resample_factor != 0.0:
+                        padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz_native))
+                        sct.run('sct_image -i centerline_rpi_native.nii.gz -o tmp.centerline_pad_native.nii.gz -pad 0,0,' + str(padding_z))
+                        image_centerline_pad = Image('centerline_rpi_native.nii.gz')
+                        nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
+                        start_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
+                        end_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+                        straight_size_x = int(xy_space / px)
+                        straight_size_y = int(xy_space / py)
+                        warp_space_x = [int(np.round(nx / 2)) - straight_size_x, int(np.round(nx / 2)) + straight_size_x]
+                        warp_space_y = [int(np.round(ny / 2)) - straight_size_y, int(np.round(ny / 2)) + straight_size_y]
+                        if warp_space_x[0] < 0:
+                            warp_space_x[1] += warp_space_x[0] - 2
+                            warp_space_x[0] = 0
+                        if warp_space_y[0] < 0:
+                            warp_space_y[1] += warp_space_y[0] - 2
+                            warp_space_y[0] = 0
+                        if self.resample_factor != 0.0:
+                            sct.run('sct_crop_image -i tmp.centerline_pad_native.nii.gz -o tmp.centerline_pad_crop_native.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord_native[2] - start_point_coord_native[2]))
+
+                        fname_ref = 'tmp.centerline_pad_crop_native.nii.gz'
+                        xy_space = 40
+                        offset_z = 4
+                    else:
+                        fname_ref = 'tmp.centerline_pad_crop.nii.gz'
+
+                    nx, ny, nz, nt, px, py, pz, pt = image_centerline.dim
+                    padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz)) + offset_z
+                    sct.run('sct_image -i centerline_rpi.nii.gz -o tmp.centerline_pad.nii.gz -pad 0,0,' + str(padding_z))
+                    image_centerline_pad = Image('centerline_rpi.nii.gz')
                     nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
-                    start_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
-                    end_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+                    hdr_warp = image_centerline_pad.hdr.copy()
+                    start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
+                    end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+
                     straight_size_x = int(xy_space / px)
                     straight_size_y = int(xy_space / py)
                     warp_space_x = [int(np.round(nx / 2)) - straight_size_x, int(np.round(nx / 2)) + straight_size_x]
@@ -456,251 +632,229 @@ class SpinalCordStraightener(object):
                     if warp_space_y[0] < 0:
                         warp_space_y[1] += warp_space_y[0] - 2
                         warp_space_y[0] = 0
-                    if self.resample_factor != 0.0:
-                        sct.run('sct_crop_image -i tmp.centerline_pad_native.nii.gz -o tmp.centerline_pad_crop_native.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord_native[2] - start_point_coord_native[2]))
-
-                    fname_ref = 'tmp.centerline_pad_crop_native.nii.gz'
-                    xy_space = 40
-                    offset_z = 4
-                else:
-                    fname_ref = 'tmp.centerline_pad_crop.nii.gz'
 
-                nx, ny, nz, nt, px, py, pz, pt = image_centerline.dim
-                padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz)) + offset_z
-                sct.run('sct_image -i centerline_rpi.nii.gz -o tmp.centerline_pad.nii.gz -pad 0,0,' + str(padding_z))
-                image_centerline_pad = Image('centerline_rpi.nii.gz')
-                nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
-                hdr_warp = image_centerline_pad.hdr.copy()
-                start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
-                end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
-
-                straight_size_x = int(xy_space / px)
-                straight_size_y = int(xy_space / py)
-                warp_space_x = [int(np.round(nx / 2)) - straight_size_x, int(np.round(nx / 2)) + straight_size_x]
-                warp_space_y = [int(np.round(ny / 2)) - straight_size_y, int(np.round(ny / 2)) + straight_size_y]
-                if warp_space_x[0] < 0:
-                    warp_space_x[1] += warp_space_x[0] - 2
-                    warp_space_x[0] = 0
-                if warp_space_y[0] < 0:
-                    warp_space_y[1] += warp_space_y[0] - 2
-                    warp_space_y[0] = 0
-
-                sct.run('sct_crop_image -i tmp.centerline_pad.nii.gz -o tmp.centerline_pad_crop.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord[2] - start_point_coord[2] + offset_z))
-
-                image_centerline_straight = Image('tmp.centerline_pad_crop.nii.gz')
-                nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
-                hdr_warp_s = image_centerline_straight.hdr.copy()
-                hdr_warp_s.set_data_dtype('float32')
-                #origin = [(nx_s * px_s)/2.0, -(ny_s * py_s)/2.0, -(nz_s * pz_s)/2.0]
-                #hdr_warp_s.structarr['qoffset_x'] = origin[0]
-                #hdr_warp_s.structarr['qoffset_y'] = origin[1]
-                #hdr_warp_s.structarr['qoffset_z'] = origin[2]
-                #hdr_warp_s.structarr['srow_x'][-1] = origin[0]
-                #hdr_warp_s.structarr['srow_y'][-1] = origin[1]
-                #hdr_warp_s.structarr['srow_z'][-1] = origin[2]
-
-                if self.template_orientation == 1:
-                    hdr_warp_s.structarr['quatern_b'] = 0.0
-                    hdr_warp_s.structarr['quatern_c'] = 1.0
-                    hdr_warp_s.structarr['quatern_d'] = 0.0
-                    hdr_warp_s.structarr['srow_x'][0] = -px_s
-                    hdr_warp_s.structarr['srow_x'][1] = 0.0
-                    hdr_warp_s.structarr['srow_x'][2] = 0.0
-                    hdr_warp_s.structarr['srow_y'][0] = 0.0
-                    hdr_warp_s.structarr['srow_y'][1] = py_s
-                    hdr_warp_s.structarr['srow_y'][2] = 0.0
-                    hdr_warp_s.structarr['srow_z'][0] = 0.0
-                    hdr_warp_s.structarr['srow_z'][1] = 0.0
-                    hdr_warp_s.structarr['srow_z'][2] = pz_s
-
-                image_centerline_straight.hdr = hdr_warp_s
-                image_centerline_straight.compute_transform_matrix()
-                image_centerline_straight.save()
-
-                start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
-                end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
-
-                number_of_voxel = nx * ny * nz
-                sct.printv("Number of voxel = " + str(number_of_voxel))
-
-                time_centerlines = time.time()
-
-                from numpy import linspace
-                ix_straight = [int(np.round(nx_s / 2))] * number_of_points
-                iy_straight = [int(np.round(ny_s / 2))] * number_of_points
-                iz_straight = linspace(0, end_point_coord[2] - start_point_coord[2], number_of_points)
-                dx_straight = [0.0] * number_of_points
-                dy_straight = [0.0] * number_of_points
-                dz_straight = [1.0] * number_of_points
-                coord_straight = np.array(zip(ix_straight, iy_straight, iz_straight))
-                coord_phys_straight = np.asarray(image_centerline_straight.transfo_pix2phys(coord_straight))
-
-                centerline_straight = Centerline(coord_phys_straight[:, 0], coord_phys_straight[:, 1], coord_phys_straight[:, 2],
-                                                 dx_straight, dy_straight, dz_straight)
-
-                time_centerlines = time.time() - time_centerlines
-                sct.printv('Time to generate centerline: ' + str(np.round(time_centerlines * 1000.0)) + ' ms', verbose)
-
-            """ 
-            import matplotlib.pyplot as plt
-            curved_points = centerline.progressive_length
-            straight_points = centerline_straight.progressive_length
-            range_points = np.linspace(0, 1, number_of_points)
-            dist_curved = np.zeros(number_of_points)
-            dist_straight = np.zeros(number_of_points)
-            for i in range(1, number_of_points):
-                dist_curved[i] = dist_curved[i - 1] + curved_points[i - 1] / centerline.length
-                dist_straight[i] = dist_straight[i - 1] + straight_points[i - 1] / centerline_straight.length
-            plt.plot(range_points, dist_curved)
-            plt.plot(range_points, dist_straight)
-            plt.grid(True)
-            plt.show()
-            """
-
-            #alignment_mode = 'length'
-            alignment_mode = 'levels'
-
-            lookup_curved2straight = range(centerline.number_of_points)
-            if self.disks_input_filename != "":
-                # create look-up table curved to straight
-                for index in range(centerline.number_of_points):
-                    disk_label = centerline.l_points[index]
-                    if alignment_mode == 'length':
-                        relative_position = centerline.dist_points[index]
+                    sct.run('sct_crop_image -i tmp.centerline_pad.nii.gz -o tmp.centerline_pad_crop.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord[2] - start_point_coord[2] + offset_z))
+
+                    image_centerline_straight = Image('tmp.centerline_pad_crop.nii.gz')
+                    nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
+                    hdr_warp_s = image_centerline_straight.hdr.copy()
+                    hdr_warp_s.set_data_dtype('float32')
+                    #origin = [(nx_s * px_s)/2.0, -(ny_s * py_s)/2.0, -(nz_s * pz_s)/2.0]
+                    #hdr_warp_s.structarr['qoffset_x'] = origin[0]
+                    #hdr_warp_s.structarr['qoffset_y'] = origin[1]
+                    #hdr_warp_s.structarr['qoffset_z'] = origin[2]
+                    #hdr_warp_s.structarr['srow_x'][-1] = origin[0]
+                    #hdr_warp_s.structarr['srow_y'][-1] = origin[1]
+                    #hdr_warp_s.structarr['srow_z'][-1] = origin[2]
+
+                    if self.template_orientation == 1:
+                        hdr_warp_s.structarr['quatern_b'] = 0.0
+                        hdr_warp_s.structarr['quatern_c'] = 1.0
+                        hdr_warp_s.structarr['quatern_d'] = 0.0
+                        hdr_warp_s.structarr['srow_x'][0] = -px_s
+                        hdr_warp_s.structarr['srow_x'][1] = 0.0
+                        hdr_warp_s.structarr['srow_x'][2] = 0.0
+                        hdr_warp_s.structarr['srow_y'][0] = 0.0
+                        hdr_warp_s.structarr['srow_y'][1] = py_s
+                        hdr_warp_s.structarr['srow_y'][2] = 0.0
+                        hdr_warp_s.structarr['srow_z'][0] = 0.0
+                        hdr_warp_s.structarr['srow_z'][1] = 0.0
+                        hdr_warp_s.structarr['srow_z'][2] = pz_s
+
+                    image_centerline_straight.hdr = hdr_warp_s
+                    image_centerline_straight.compute_transform_matrix()
+                    image_centerline_straight.save()
+
+                    start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
+                    end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+
+                    number_of_voxel = nx * ny * nz
+                    sct.printv("Number of voxel = " + str(number_of_voxel))
+
+                    time_centerlines = time.time()
+
+                    from numpy import linspace
+                    ix_straight = [int(np.round(nx_s / 2))] * number_of_points
+                    iy_straight = [int(np.round(ny_s / 2))] * number_of_points
+                    iz_straight = linspace(0, end_point_coord[2] - start_point_coord[2], number_of_points)
+                    dx_straight = [0.0] * number_of_points
+                    dy_straight = [0.0] * number_of_points
+                    dz_straight = [1.0] * number_of_points
+                    coord_straight = np.array(zip(ix_straight, iy_straight, iz_straight))
+                    coord_phys_straight = image_centerline_straight.transfo_pix2phys_array(coord_straight)
+
+                    centerline_straight = Centerline(coord_phys_straight[:, 0], coord_phys_straight[:, 1], coord_phys_straight[:, 2],
+                                                     dx_straight, dy_straight, dz_straight)
+
+                    time_centerlines = time.time() - time_centerlines
+                    sct.printv('Time to generate centerline: ' + str(np.round(time_centerlines * 1000.0)) + ' ms', verbose)
+
+                """ 
+                import matplotlib.pyplot as plt
+                curved_points = centerline.progressive_length
+                straight_points = centerline_straight.progressive_length
+                range_points = np.linspace(0, 1, number_of_points)
+                dist_curved = np.zeros(number_of_points)
+                dist_straight = np.zeros(number_of_points)
+                for i in range(1, number_of_points):
+                    dist_curved[i] = dist_curved[i - 1] + curved_points[i - 1] / centerline.length
+                    dist_straight[i] = dist_straight[i - 1] + straight_points[i - 1] / centerline_straight.length
+                plt.plot(range_points, dist_curved)
+                plt.plot(range_points, dist_straight)
+                plt.grid(True)
+                plt.show()
+                """
+
+                #alignment_mode = 'length'
+                alignment_mode = 'levels'
+
+                lookup_curved2straight = range(centerline.number_of_points)
+                if self.disks_input_filename != "":
+                    # create look-up table curved to straight
+                    for index in range(centerline.number_of_points):
+                        disk_label = centerline.l_points[index]
+                        if alignment_mode == 'length':
+                            relative_position = centerline.dist_points[index]
+                        else:
+                            relative_position = centerline.dist_points_rel[index]
+                        idx_closest = centerline_straight.get_closest_to_absolute_position(disk_label, relative_position, backup_index=index, backup_centerline=centerline_straight, mode=alignment_mode)
+                        if idx_closest is not None:
+                            lookup_curved2straight[index] = idx_closest
+                        else:
+                            lookup_curved2straight[index] = 0
+                for p in range(0, len(lookup_curved2straight)/2):
+                    if lookup_curved2straight[p] == lookup_curved2straight[p + 1]:
+                        lookup_curved2straight[p] = 0
                     else:
-                        relative_position = centerline.dist_points_rel[index]
-                    idx_closest = centerline_straight.get_closest_to_absolute_position(disk_label, relative_position, backup_index=index, backup_centerline=centerline_straight, mode=alignment_mode)
-                    if idx_closest is not None:
-                        lookup_curved2straight[index] = idx_closest
+                        break
+                for p in range(len(lookup_curved2straight)-1, len(lookup_curved2straight)/2, -1):
+                    if lookup_curved2straight[p] == lookup_curved2straight[p - 1]:
+                        lookup_curved2straight[p] = 0
                     else:
-                        lookup_curved2straight[index] = 0
-            for p in range(0, len(lookup_curved2straight)/2):
-                if lookup_curved2straight[p] == lookup_curved2straight[p + 1]:
-                    lookup_curved2straight[p] = 0
-                else:
-                    break
-            for p in range(len(lookup_curved2straight)-1, len(lookup_curved2straight)/2, -1):
-                if lookup_curved2straight[p] == lookup_curved2straight[p - 1]:
-                    lookup_curved2straight[p] = 0
-                else:
-                    break
-            lookup_curved2straight = np.array(lookup_curved2straight)
-
-            lookup_straight2curved = range(centerline_straight.number_of_points)
-            if self.disks_input_filename != "":
-                for index in range(centerline_straight.number_of_points):
-                    disk_label = centerline_straight.l_points[index]
-                    if alignment_mode == 'length':
-                        relative_position = centerline_straight.dist_points[index]
+                        break
+                lookup_curved2straight = np.array(lookup_curved2straight)
+
+                lookup_straight2curved = range(centerline_straight.number_of_points)
+                if self.disks_input_filename != "":
+                    for index in range(centerline_straight.number_of_points):
+                        disk_label = centerline_straight.l_points[index]
+                        if alignment_mode == 'length':
+                            relative_position = centerline_straight.dist_points[index]
+                        else:
+                            relative_position = centerline_straight.dist_points_rel[index]
+                        idx_closest = centerline.get_closest_to_absolute_position(disk_label, relative_position, backup_index=index, backup_centerline=centerline_straight, mode=alignment_mode)
+                        if idx_closest is not None:
+                            lookup_straight2curved[index] = idx_closest
+                for p in range(0, len(lookup_straight2curved)/2):
+                    if lookup_straight2curved[p] == lookup_straight2curved[p + 1]:
+                        lookup_straight2curved[p] = 0
                     else:
-                        relative_position = centerline_straight.dist_points_rel[index]
-                    idx_closest = centerline.get_closest_to_absolute_position(disk_label, relative_position, backup_index=index, backup_centerline=centerline_straight, mode=alignment_mode)
-                    if idx_closest is not None:
-                        lookup_straight2curved[index] = idx_closest
-            for p in range(0, len(lookup_straight2curved)/2):
-                if lookup_straight2curved[p] == lookup_straight2curved[p + 1]:
-                    lookup_straight2curved[p] = 0
-                else:
-                    break
-            for p in range(len(lookup_straight2curved)-1, len(lookup_straight2curved)/2, -1):
-                if lookup_straight2curved[p] == lookup_straight2curved[p - 1]:
-                    lookup_straight2curved[p] = 0
-                else:
-                    break
-            lookup_straight2curved = np.array(lookup_straight2curved)
-
-            # Create volumes containing curved and straight warping fields
-            time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
-
-            # 5. compute transformations
-            # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
-            # b. determine which plane of spinal cord centreline it is included
-            # sct.printv(nx * ny * nz, nx_s * ny_s * nz_s)
-
-            if self.curved2straight:
-                timer_straightening = sct.Timer(nz_s)
-                timer_straightening.start()
-                for u in range(nz_s):
-                    timer_straightening.add_iteration()
-                    x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                    indexes_straight = np.array(zip(x_s.ravel(), y_s.ravel(), z_s.ravel()))
-                    physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                    nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                    distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    lookup = lookup_straight2curved[nearest_indexes_straight]
-                    indexes_out_distance_straight = np.logical_or(np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance), lookup == 0)
-                    projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-
-                    coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup)
-                    displacements_straight = coord_straight2curved - physical_coordinates_straight
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
-                    #displacements_straight[:, 0] = -displacements_straight[:, 0]
-                    displacements_straight[:, 2] = -displacements_straight[:, 2]
-                    displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
-                timer_straightening.stop()
+                        break
+                for p in range(len(lookup_straight2curved)-1, len(lookup_straight2curved)/2, -1):
+                    if lookup_straight2curved[p] == lookup_straight2curved[p - 1]:
+                        lookup_straight2curved[p] = 0
+                    else:
+                        break
+                lookup_straight2curved = np.array(lookup_straight2curved)
 
-            if self.straight2curved:
-                timer_straightening = sct.Timer(nz)
+                # Create volumes containing curved and straight warping fields
+                # Fields are allocated once, in float32, either in memory or directly on disk as memory-mapped nifti files.
+                time_generation_volumes = time.time()
+                hdr_warp_s.set_intent('vector', (), '')
+                hdr_warp_s.set_data_dtype('float32')
+                hdr_warp.set_intent('vector', (), '')
+                hdr_warp.set_data_dtype('float32')
+                data_warp_curved2straight, data_warp_straight2curved = None, None
+                if self.warp_memmap:
+                    from msct_image import create_nifti_memmap
+                    if self.curved2straight:
+                        data_warp_curved2straight = create_nifti_memmap(fname_warp_curve2straight, hdr_warp_s, (nx_s, ny_s, nz_s, 1, 3))
+                    if self.straight2curved:
+                        data_warp_straight2curved = create_nifti_memmap(fname_warp_straight2curve, hdr_warp, (nx, ny, nz, 1, 3))
+                else:
+                    if self.curved2straight:
+                        data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3), dtype=np.float32)
+                    if self.straight2curved:
+                        data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32)
+
+                # 5. compute transformations
+                # Both warping fields are computed by chunks of slices (bounded memory), written in place in the
+                # preallocated fields. Chunks are independent, so they are dispatched on a pool of threads.
+                jobs = []
+                kwargs = {'threshold_distance': self.threshold_distance}
+                if self.curved2straight:
+                    kwargs_c2s = dict(kwargs, mode='curved2straight')
+                    jobs += [((data_warp_curved2straight, image_centerline_straight, centerline_straight, centerline,
+                               lookup_straight2curved, z_start, z_end), kwargs_c2s)
+                             for z_start, z_end in get_chunks(nx_s, ny_s, nz_s, self.nb_voxels_chunk)]
+                if self.straight2curved:
+                    kwargs_s2c = dict(kwargs, mode='straight2curved')
+                    jobs += [((data_warp_straight2curved, image_centerline_pad, centerline, centerline_straight,
+                               lookup_curved2straight, z_start, z_end), kwargs_s2c)
+                             for z_start, z_end in get_chunks(nx, ny, nz, self.nb_voxels_chunk)]
+
+                timer_straightening = sct.Timer(len(jobs))
                 timer_straightening.start()
-                for u in range(nz):
-                    timer_straightening.add_iteration()
-                    x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                    indexes = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-                    physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                    nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                    distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-                    lookup = lookup_curved2straight[nearest_indexes_curved]
-                    indexes_out_distance_curved = np.logical_or(np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance), lookup == 0)
-                    projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-                    coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-
-                    coord_curved2straight = centerline_straight.points[lookup]
-                    coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                    coord_curved2straight[:, 2] += distances_curved
-
-                    displacements_curved = coord_curved2straight - physical_coordinates
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-hended definition of referential.
-                    #displacements_curved[:, 0] = -displacements_curved[:, 0]
-                    displacements_curved[:, 2] = -displacements_curved[:, 2]
-                    displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+                if self.cpu_number > 1 and len(jobs) > 1:
+                    from multiprocessing.pool import ThreadPool
+                    pool = ThreadPool(min(self.cpu_number, len(jobs)))
+                    try:
+                        for _ in pool.imap_unordered(compute_displacements_job, jobs):
+                            timer_straightening.add_iteration()
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    for job in jobs:
+                        compute_displacements_job(job)
+                        timer_straightening.add_iteration()
                 timer_straightening.stop()
 
-            # Creation of the safe zone based on pre-calculated safe boundaries
-            coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
-            coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
-
-            if radius_safe > 0:
-                data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
-                data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
-                data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
-                data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
-
-            # Generate warp files as a warping fields
-            hdr_warp_s.set_intent('vector', (), '')
-            hdr_warp_s.set_data_dtype('float32')
-            hdr_warp.set_intent('vector', (), '')
-            hdr_warp.set_data_dtype('float32')
-            if self.curved2straight:
-                img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
-                save(img, 'tmp.curve2straight.nii.gz')
-                sct.printv('\nDONE ! Warping field generated: tmp.curve2straight.nii.gz', verbose)
-
-            if self.straight2curved:
-                img = Nifti1Image(data_warp_straight2curved, None, hdr_warp)
-                save(img, 'tmp.straight2curve.nii.gz')
-                sct.printv('\nDONE ! Warping field generated: tmp.straight2curve.nii.gz', verbose)
+                # Creation of the safe zone based on pre-calculated safe boundaries
+                coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
+                coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
+
+                if radius_safe > 0:
+                    if self.curved2straight:
+                        data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
+                        data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
+                    if self.straight2curved:
+                        data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
+                        data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
+
+                # Generate warp files as a warping fields
+                if self.curved2straight:
+                    if self.warp_memmap:
+                        data_warp_curved2straight.flush()
+                    else:
+                        img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
+                        save(img, fname_warp_curve2straight)
+                    del data_warp_curved2straight
+                    sct.printv('\nDONE ! Warping field generated: ' + fname_warp_curve2straight, verbose)
+
+                if self.straight2curved:
+                    if self.warp_memmap:
+                        data_warp_straight2curved.flush()
+                    else:
+                        img = Nifti1Image(data_warp_straight2curved, None, hdr_warp)
+                        save(img, fname_warp_straight2curve)
+                    del data_warp_straight2curved
+                    sct.printv('\nDONE ! Warping field generated: ' + fname_warp_straight2curve, verbose)
+
+            if cache is not None and path_entry is None:
+                files = {fname_ref: fname_ref}
+                if self.curved2straight:
+                    files[fname_warp_curve2straight] = fname_warp_curve2straight
+                if self.straight2curved:
+                    files[fname_warp_straight2curve] = fname_warp_straight2curve
+                cache.put(key_warp, files, info={'fname_ref': fname_ref, 'number_of_points': number_of_points,
+                                                 'fname_warp_curve2straight': fname_warp_curve2straight,
+                                                 'fname_warp_straight2curve': fname_warp_straight2curve})
 
             if self.curved2straight:
                 # Apply transformation to input image
                 sct.printv('\nApply transformation to input image...', verbose)
-                sct.run('sct_apply_transfo -i data.nii -d ' + fname_ref + ' -o tmp.anat_rigid_warp.nii.gz -w tmp.curve2straight.nii.gz -x ' + interpolation_warp, verbose)
+                sct.run('sct_apply_transfo -i data.nii -d ' + fname_ref + ' -o tmp.anat_rigid_warp.nii.gz -w ' + fname_warp_curve2straight + ' -x ' + interpolation_warp, verbose)
 
             if self.accuracy_results:
                 time_accuracy_results = time.time()
@@ -710,7 +864,7 @@ class SpinalCordStraightener(object):
                 sct.printv('\nApply transformation to centerline image...', verbose)
                 Transform(input_filename='centerline.nii.gz', fname_dest=fname_ref,
                           output_filename="tmp.centerline_straight.nii.gz", interp="nn",
-                          warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
+                          warp=fname_warp_curve2straight, verbose=verbose).apply()
                 from msct_image import Image
                 file_centerline_straight = Image('tmp.centerline_straight.nii.gz', verbose=verbose)
                 coordinates_centerline = file_centerline_straight.getNonZeroCoordinates(sorting='z')
@@ -752,10 +906,20 @@ class SpinalCordStraightener(object):
         # Generate output file (in current folder)
         # TODO: do not uncompress the warping field, it is too time consuming!
         sct.printv("\nGenerate output file (in current folder)...", verbose)
-        if self.curved2straight:
-            sct.generate_output_file(path_tmp + "/tmp.curve2straight.nii.gz", self.path_output + "warp_curve2straight.nii.gz", verbose)
-        if self.straight2curved:
-            sct.generate_output_file(path_tmp + "/tmp.straight2curve.nii.gz", self.path_output + "warp_straight2curve.nii.gz", verbose)
+        if self.warp_memmap:
+            # compress the memory-mapped fields without squeezing their (x, y, z, 1, 3) shape
+            from nibabel import load
+            if self.curved2straight:
+                save(load(path_tmp + fname_warp_curve2straight), self.path_output + "warp_curve2straight.nii.gz")
+                sct.printv('  File created: ' + self.path_output + "warp_curve2straight.nii.gz", verbose)
+            if self.straight2curved:
+                save(load(path_tmp + fname_warp_straight2curve), self.path_output + "warp_straight2curve.nii.gz")
+                sct.printv('  File created: ' + self.path_output + "warp_straight2curve.nii.gz", verbose)
+        else:
+            if self.curved2straight:
+                sct.generate_output_file(path_tmp + fname_warp_curve2straight, self.path_output + "warp_curve2straight.nii.gz", verbose)
+            if self.straight2curved:
+                sct.generate_output_file(path_tmp + fname_warp_straight2curve, self.path_output + "warp_straight2curve.nii.gz", verbose)
 
         # create ref_straight.nii.gz file that can be used by other SCT functions that need a straight reference space
         if self.curved2straight:
@@ -892,7 +1056,10 @@ def get_parser():
                                   "\nprecision: [1.0,inf[. Precision factor of straightening, related to the number of slices. Increasing this parameter increases the precision along with increased computational time. Not taken into account with hanning fitting method. Default=2"
                                   "\nthreshold_distance: [0.0,inf[. Threshold at which voxels are not considered into displacement. Increase this threshold if the image is blackout around the spinal cord too much. Default=10"
                                   "\naccuracy_results: {0, 1} Disable/Enable computation of accuracy results after straightening. Default=0"
-                                  "\ntemplate_orientation: {0, 1} Disable/Enable orientation of the straight image to be the same as the template. Default=0",
+                                  "\ntemplate_orientation: {0, 1} Disable/Enable orientation of the straight image to be the same as the template. Default=0"
+                                  "\nnb_voxels_chunk: [1,inf[. Maximum number of voxels processed at once (per CPU) when computing the warping fields. Decrease this parameter to reduce memory usage. Default=500000"
+                                  "\nmemmap: {0, 1} Write the warping fields directly into memory-mapped files on disk instead of keeping them in memory. Reduces memory usage on large images. Default=0"
+                                  "\ncache: {0, 1} Reuse centerline fits and warping fields computed previously with identical inputs and parameters. The cache is stored in $SCT_CACHE_DIR (default: ~/.sct_cache) and its size is limited to $SCT_CACHE_SIZE MB (default: 5000). Default=1 if SCT_CACHE_DIR is defined, 0 otherwise",
                       mandatory=False,
                       example="algo_fitting=nurbs")
     parser.add_option(name="-params",
@@ -904,6 +1071,12 @@ def get_parser():
                       mandatory=False,
                       deprecated_by='-param')
 
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for computing the warping fields. 0 or 1: no parallel computation. "
+                                  "By default, uses all the available cores.",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name='-qc',
                       type_value='multiple_choice',
                       description='Output images for quality control.',
@@ -959,8 +1132,8 @@ def main(args=None):
         sc_straight.path_output = './'
     if "-v" in arguments:
         sc_straight.verbose = int(arguments["-v"])
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-cpu-nb" in arguments:
+        sc_straight.cpu_number = int(arguments["-cpu-nb"])
     if '-qc' in arguments:
         sc_straight.qc = int(arguments['-qc'])
 
@@ -990,6 +1163,12 @@ def main(args=None):
                 sc_straight.accuracy_results = int(param_split[1])
             if param_split[0] == 'template_orientation':
                 sc_straight.template_orientation = int(param_split[1])
+            if param_split[0] == 'nb_voxels_chunk':
+                sc_straight.nb_voxels_chunk = int(param_split[1])
+            if param_split[0] == 'memmap':
+                sc_straight.warp_memmap = bool(int(param_split[1]))
+            if param_split[0] == 'cache':
+                sc_straight.use_cache = bool(int(param_split[1]))
 
     sc_straight.straighten()
 
@@ -542,7 +542,7 @@ def check_if_3d(fname):
     :return: True or False
     """
     from msct_image import Image
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname, lazy=True).dim
     if not nt == 1:
         printv('\nERROR: ' + fname + ' is not a 3D volume. Exit program.\n', 1, 'error')
     else:
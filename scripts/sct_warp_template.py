@@ -18,6 +18,7 @@ import time
 from msct_parser import Parser
 import sct_utils as sct
 from sct_extract_metric import read_label_file
+from sct_apply_transfo import apply_transfo_to_files
 
 
 # get path of the script and the toolbox
@@ -74,19 +75,23 @@ class WarpTemplate:
         if not os.path.exists(self.folder_out):
             os.makedirs(self.folder_out)
 
-        # Warp template objects
-        sct.printv('\nWARP TEMPLATE:', self.verbose)
-        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
-
-        # Warp atlas
+        # List template objects, atlas of white matter tracts and spinal levels
+        folder_label_list = [self.folder_template]
         if self.warp_atlas == 1:
-            sct.printv('\nWARP ATLAS OF WHITE MATTER TRACTS:', self.verbose)
-            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
-
-        # Warp spinal levels
+            folder_label_list.append(self.folder_atlas)
         if self.warp_spinal_levels == 1:
-            sct.printv('\nWARP SPINAL LEVELS:', self.verbose)
-            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            folder_label_list.append(self.folder_spinal_levels)
+        fname_label_list, fname_out_list, interp_list = [], [], []
+        for folder_label in folder_label_list:
+            fname_label, fname_out, interp = get_label_files(self.path_template, folder_label, param.file_info_label, self.folder_out)
+            fname_label_list += fname_label
+            fname_out_list += fname_out
+            interp_list += interp
+
+        # Warp template, atlas and spinal levels at once: the warping field is read and the sampling coordinates are
+        # computed only once
+        sct.printv('\nWARP TEMPLATE:', self.verbose)
+        apply_transfo_to_files(fname_label_list, fname_out_list, self.fname_src, [self.fname_transfo], interp_list, verbose=self.verbose)
 
         # to view results
         sct.printv('\nDone! To view results, type:', self.verbose)
@@ -104,19 +109,19 @@ class WarpTemplate:
             im.save_quality_control(plane='axial', n_slices=4, seg=im_wm, thr=0.5, cmap_col='blue-cyan', path_output=self.folder_out)
 
 
-# Warp labels
+# Get label files
 # ==========================================================================================
-def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
+def get_label_files(path_label, folder_label, file_label, path_out):
     """
-    Warp label files according to info_label.txt file
+    List label files according to info_label.txt file, create the output folder and copy info_label.txt into it.
     :param path_label:
     :param folder_label:
     :param file_label:
-    :param fname_src:
-    :param fname_transfo:
     :param path_out:
-    :return:
+    :return: list of label files, list of output files, list of interpolation methods (empty lists if the label file
+             cannot be read)
     """
+    fname_label_list, fname_out_list, interp_list = [], [], []
     # read label file and check if file exists
     sct.printv('\nRead label file...', param.verbose)
     try:
@@ -133,15 +138,14 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
         # create output folder
         if not os.path.exists(path_out + folder_label):
             os.makedirs(path_out + folder_label)
-        # Warp label
+        # List labels
         for i in xrange(0, len(template_label_file)):
-            fname_label = path_label + folder_label + template_label_file[i]
-            # check if file exists
-            # sct.check_file_exist(fname_label)
-            # apply transfo
-            sct.run('sct_apply_transfo -i ' + fname_label + ' -o ' + path_out + folder_label + template_label_file[i] + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
+            fname_label_list.append(path_label + folder_label + template_label_file[i])
+            fname_out_list.append(path_out + folder_label + template_label_file[i])
+            interp_list.append(get_interp(template_label_file[i]))
         # Copy list.txt
         sct.run('cp ' + path_label + folder_label + param.file_info_label + ' ' + path_out + folder_label, 0)
+    return fname_label_list, fname_out_list, interp_list
 
 
 # Get file label
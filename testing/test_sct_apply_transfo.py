@@ -12,6 +12,12 @@
 
 # TODO: generate warping field for dmri that makes sense (dmri --> T2).
 
+import numpy as np
+import sct_utils as sct
+from msct_image import Image
+from sct_apply_transfo import apply_transfo_to_files
+
+
 def init(param_test):
     """
     Initialize class: param_test
@@ -27,9 +33,51 @@ def init(param_test):
     return param_test
 
 
+def compare_to_ants(data, data_ants, threshold=0.05):
+    """
+    Relative mean absolute difference between an image warped by the native resampling of sct_apply_transfo and the
+    same image warped by isct_antsApplyTransforms, within the non-zero voxels of the latter.
+    :return: difference, and True if it is below the threshold
+    """
+    mask = data_ants != 0
+    diff = np.mean(np.abs(data[mask] - data_ants[mask])) / np.mean(np.abs(data_ants[mask]))
+    return diff, diff < threshold
+
+
 def test_integrity(param_test):
     """
-    Test integrity of function
+    Test integrity of function: the output of isct_antsApplyTransforms is compared to the native resampling of the
+    displacement fields (orientation of the ITK displacements, geometry of the images).
     """
-    param_test.output += '\nNot implemented.'
+    index_args = param_test.default_args.index(param_test.args)
+    fname_src = param_test.dict_args_with_path['-i']
+    fname_dest = param_test.dict_args_with_path['-d']
+    fname_warp_list = param_test.dict_args_with_path['-w']
+    path_src, file_src, ext_src = sct.extract_fname(fname_src)
+    fname_out = param_test.path_output + file_src + '_reg' + ext_src
+
+    # 3D image: warped by isct_antsApplyTransforms, compared to apply_transfo_to_files (used by sct_warp_template)
+    if index_args == 0:
+        fname_native = param_test.path_output + file_src + '_reg_native' + ext_src
+        apply_transfo_to_files([fname_src], [fname_native], fname_dest, fname_warp_list, ['spline'], verbose=0)
+        diff, is_equal = compare_to_ants(Image(fname_native).data, Image(fname_out).data)
+        param_test.output += '\nRelative difference with the native resampling: ' + str(diff)
+        if not is_equal:
+            param_test.status = 99
+            param_test.output += '\nResulting image differs from the native resampling of the warping field.'
+
+    # 4D image: warped by apply_transfo_4d, first volume compared to isct_antsApplyTransforms
+    elif index_args == 1:
+        im_src = Image(fname_src)
+        fname_vol = param_test.path_output + file_src + '_T0000.nii.gz'
+        fname_vol_ants = param_test.path_output + file_src + '_T0000_reg_ants.nii.gz'
+        im_vol = Image(im_src.data[..., 0], hdr=im_src.hdr.copy(), absolutepath=fname_vol)
+        im_vol.save()
+        sct.run('isct_antsApplyTransforms -d 3 -i ' + fname_vol + ' -o ' + fname_vol_ants + ' -t ' + ' '.join(fname_warp_list[::-1]) + ' -r ' + fname_dest + sct.get_interpolation('isct_antsApplyTransforms', 'spline'), 0)
+        diff, is_equal = compare_to_ants(Image(fname_out).data[..., 0], Image(fname_vol_ants).data)
+        param_test.output += '\nRelative difference with isct_antsApplyTransforms (first volume): ' + str(diff)
+        if not is_equal:
+            param_test.status = 99
+            param_test.output += '\nFirst volume of the resulting image differs from isct_antsApplyTransforms.'
+
     return param_test
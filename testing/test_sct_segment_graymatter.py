@@ -14,9 +14,14 @@
 # import commands
 # import sys
 import os
+import numpy as np
 from pandas import DataFrame
 import sct_segment_graymatter
-# from msct_image import Image
+import sct_apply_transfo
+from msct_image import Image
+from msct_gmseg_utils import get_slice_image, register_images, warp_segmentations
+from msct_multiatlas_seg import ParamData
+from sct_image import set_orientation
 import sct_utils as sct
 from numpy import sum, mean
 # import time
@@ -105,8 +110,8 @@ def test_integrity(param_test):
     hd_lines = hd.readlines()
     hd.close()
 
-    # remove title of columns and last empty/non important lines
-    hd_lines = hd_lines[1:-4]
+    # keep the results by slice (the title of columns, the 3D results and the input files are not used)
+    hd_lines = [line for line in hd_lines if line.startswith('Slice ')]
 
     hausdorff = []
     max_med = []
@@ -114,7 +119,8 @@ def test_integrity(param_test):
         slice_id, res = line.split(':')
         slice, n_slice = slice_id.split(' ')
         if n_slice not in null_slices:
-            hd, med1, med2 = res[:-1].split(' - ')
+            # first columns: Hausdorff's distance and medians of the relative distances
+            hd, med1, med2 = res[:-1].split(' - ')[0:3]
             hd, med1, med2 = float(hd), float(med1), float(med2)
             hausdorff.append(hd)
             max_med.append(max(med1, med2))
@@ -129,9 +135,48 @@ def test_integrity(param_test):
                              'WM dice: ' + str(result_dice_wm) + '\n' \
                              'Hausdorff distance: ' + str(result_hausdorff) + '\n'
 
+    # check the warping of the segmentations of the model slices
+    param_test = test_warp_segmentations(param_test)
+
     # transform results into Pandas structure
     results = DataFrame(data={'status': param_test.status, 'output': param_test.output, 'dice_gm': result_dice_gm, 'dice_wm': result_dice_wm,
                               'hausdorff': result_hausdorff, 'med_dist': result_median_dist, 'duration_[s]': param_test.duration},
                         index=[param_test.path_data])
 
     return param_test
+
+
+def test_warp_segmentations(param_test):
+    """
+    Check warp_segmentations (used to warp the segmentations of the model slices) against sct_apply_transfo -x nn: two
+    axial slices of the spinal cord segmentation are registered, and the manual GM segmentation of the first slice is
+    warped by both.
+    """
+    try:
+        im_sc_seg = set_orientation(Image(param_test.dict_args_with_path['-s']), 'RPI')
+        im_gm_seg = set_orientation(Image(param_test.dict_args_with_path['-ref']), 'RPI')
+        # slice with the largest GM segmentation, registered on a neighbouring slice
+        z = int(np.argmax(np.sum(im_gm_seg.data, axis=(0, 1))))
+        z_dest = z + 1 if z + 1 < im_sc_seg.data.shape[2] else z - 1
+        path_reg = param_test.path_output + 'warp_segmentations/'
+        sct.create_folder(path_reg)
+        im_src_reg, fname_src2dest, fname_dest2src = register_images(get_slice_image(im_sc_seg.data[:, :, z]), get_slice_image(im_sc_seg.data[:, :, z_dest]), ParamData().register_param, path_reg)
+
+        data_gm = np.asarray(im_gm_seg.data[:, :, z], dtype=np.float32)
+        data_gm_reg = warp_segmentations([data_gm], path_reg + 'src.nii.gz', path_reg + 'dest.nii.gz', path_reg + fname_src2dest, interp='nn')[0]
+        im_gm = get_slice_image(data_gm)
+        im_gm.setFileName(path_reg + 'gm.nii.gz')
+        im_gm.save()
+        sct_apply_transfo.main(args=['-i', path_reg + 'gm.nii.gz', '-d', path_reg + 'dest.nii.gz', '-w', path_reg + fname_src2dest, '-x', 'nn', '-o', path_reg + 'gm_reg.nii.gz'])
+        data_gm_reg_ants = Image(path_reg + 'gm_reg.nii.gz').data
+
+        nb_diff = np.sum(data_gm_reg.reshape(data_gm_reg_ants.shape) != data_gm_reg_ants)
+        param_test.output += '\nwarp_segmentations vs sct_apply_transfo: ' + str(nb_diff) + ' different voxels'
+        if nb_diff > 0.001 * data_gm_reg_ants.size:
+            param_test.status = 99
+            param_test.output += '\nSegmentation warped by warp_segmentations differs from sct_apply_transfo -x nn.'
+    except Exception as e:
+        param_test.status = 99
+        param_test.output += 'ERROR: ' + str(e.message) + str(e.args)
+
+    return param_test